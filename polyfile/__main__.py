@@ -2,19 +2,28 @@ import argparse
 from contextlib import ExitStack
 import json
 import logging
+import os
 import re
 import signal
 import sys
 from textwrap import dedent
-from typing import ContextManager, Optional, TextIO
+from pathlib import Path
+from typing import ContextManager, Optional, TextIO, Union
 
+from . import columnar
 from . import html
+from . import batch
+from .cache import CorpusIndex, DEFAULT_INDEX_NAME, DEFAULT_MAX_CACHE_SIZE, ResultCache
 from . import logger
-from .fileutils import PathOrStdin, PathOrStdout
+from .fileutils import PathOrStdout, SpooledInput
 from .magic import MagicMatcher
+from .manifest import default_mimetypes
 from .debugger import Debugger
-from .polyfile import __version__, Analyzer
+from .polyfile import __version__, Analyzer, ContentsMode
+from .quotas import Quota
 from .repl import ExitREPL
+from . import server
+from .workers import EmbeddedScheduler, ParserPool
 
 
 log = logger.getStatusLogger("polyfile")
@@ -57,7 +66,7 @@ class KeyboardInterruptHandler:
 
 
 class FormatOutput:
-    valid_formats = ("mime", "html", "json", "sbud", "explain")
+    valid_formats = ("mime", "html", "json", "sbud", "explain", "ndjson", "columnar")
     default_format = "file"
 
     def __init__(self, output_format: Optional[str] = None, output_path: Optional[str] = None):
@@ -113,14 +122,187 @@ class ValidateOutput(argparse.Action):
         ValidateOutput.add_output(args, values)
 
 
+def run_batch(args: argparse.Namespace, magic_matcher: Optional[MagicMatcher]) -> int:
+    if args.debugger:
+        log.error("The `--debugger` cannot be used with `--batch`")
+        return 1
+    if args.embedded_workers is not None:
+        log.warning("Ignoring `--embedded-workers`; `--batch` already analyzes files concurrently")
+    if args.snapshot is not None:
+        log.warning("Ignoring `--snapshot` in batch mode; see `--incremental` instead")
+    if args.max_nodes_in_memory is not None:
+        log.warning("Ignoring `--max-nodes-in-memory` in batch mode")
+    sources = list(args.batch)
+    if args.FILE != "-":
+        sources.append(args.FILE)
+    formats = []
+    for output_format in args.format:
+        if output_format.output_path is not None:
+            log.warning(f"Ignoring `--output {output_format.output_path}` in batch mode; use `--output-dir` instead")
+        if output_format.output_format not in batch.BATCH_FORMATS:
+            log.error(f"`--format {output_format.output_format}` is not supported with `--batch`")
+            return 1
+        if output_format.output_format not in formats:
+            formats.append(output_format.output_format)
+    inputs = batch.batch_inputs(sources)
+    log.info(f"Analyzing {len(inputs)} files")
+    cache: Optional[ResultCache] = None
+    if args.cache is not None:
+        if magic_matcher is not None:
+            log.warning("Ignoring `--cache`; results are not cached with custom magic definitions")
+        else:
+            cache = ResultCache(args.cache, max_size=args.cache_size)
+    index: Optional[CorpusIndex] = None
+    if args.incremental is not None:
+        index_path = args.incremental
+        if not index_path:
+            if args.output_dir is None:
+                log.error("`--incremental` requires either an INDEX path or an `--output-dir`")
+                return 1
+            index_path = str(Path(args.output_dir) / DEFAULT_INDEX_NAME)
+        index = CorpusIndex(index_path)
+    num_errors = 0
+    with batch.BatchAnalyzer(
+            formats=formats,
+            jobs=args.jobs,
+            output_dir=args.output_dir,
+            try_all_offsets=args.try_all_offsets,
+            parse=not args.only_match,
+            magic_matcher=magic_matcher,
+            contents=args.contents,
+            quota_limits={
+                "max_depth": args.max_depth,
+                "max_decompressed_bytes": args.max_decompressed_bytes,
+                "max_nodes": args.max_nodes,
+                "max_embedded_size": args.max_embedded_size
+            },
+            parser_timeout=args.parser_timeout,
+            parser_max_memory=args.parser_max_memory,
+            isolate_parsers=args.isolate_parsers,
+            cache=cache,
+            index=index
+    ) as batch_analyzer, KeyboardInterruptHandler():
+        for result in batch_analyzer.run(inputs):
+            if "error" in result:
+                num_errors += 1
+                log.error(f"Error analyzing {result['path']!r}: {result['error']}")
+            if args.output_dir is None:
+                sys.stdout.write(json.dumps(result))
+                sys.stdout.write("\n")
+                sys.stdout.flush()
+            elif result.get("deleted", False):
+                log.info(f"{result['path']!r} was deleted since the last run")
+            elif "outputs" in result and not result.get("unchanged", False):
+                log.debug(f"Saved the output for {result['path']!r} to {', '.join(result['outputs'])}")
+    if cache is not None:
+        cache.close()
+    if index is not None:
+        index.close()
+    if num_errors:
+        return 1
+    return 0
+
+
+def serve(argv) -> int:
+    parser = argparse.ArgumentParser(prog="polyfile serve", description=dedent("""\
+        Run PolyFile as a long-running analysis daemon.
+
+        The magic definitions and parsers are loaded once, and analysis requests are then served over HTTP:
+        `POST /analyze` analyzes the request body and streams the results as NDJSON. See `polyfile.server` for the
+        API."""), formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                        help="the address on which to listen (default is 127.0.0.1)")
+    parser.add_argument("--port", "-p", type=int, default=8080, help="the port on which to listen (default is 8080)")
+    parser.add_argument("--unix-socket", type=str, default=None,
+                        help="listen on this Unix domain socket instead of on a TCP port")
+    parser.add_argument("--max-concurrent", type=int, default=None,
+                        help="the maximum number of analyses to run at once (default is the number of CPUs); "
+                             "further requests wait for a slot")
+    parser.add_argument("--allow-path", action="append", default=[],
+                        help="allow requests to analyze files on the server beneath this directory by `path` "
+                             "rather than by uploading them; may be repeated")
+    parser.add_argument("--max-body-size", type=int, default=server.DEFAULT_MAX_BODY_SIZE,
+                        help="reject uploads larger than this many bytes, since they are analyzed in memory (default is "
+                             f"{server.DEFAULT_MAX_BODY_SIZE})")
+    parser.add_argument('--isolate-parsers', action='store_true',
+                        help='run each parser in a separate worker process so that a misbehaving parser cannot hang or '
+                             'crash the server; implied by --parser-timeout and --parser-max-memory')
+    parser.add_argument('--parser-timeout', type=float, default=None,
+                        help='kill any parser that runs for longer than this many seconds (implies --isolate-parsers)')
+    parser.add_argument('--parser-max-memory', type=int, default=None,
+                        help='limit the memory of each parser worker process to this many bytes (implies '
+                             '--isolate-parsers)')
+    verbosity_group = parser.add_mutually_exclusive_group()
+    verbosity_group.add_argument('--quiet', '-q', action='store_true', help='suppress all log output')
+    verbosity_group.add_argument('--debug', '-d', action='store_true', help='print debug information')
+    args = parser.parse_args(argv)
+
+    if args.quiet:
+        logger.setLevel(logging.CRITICAL)
+    elif args.debug:
+        logger.setLevel(logging.DEBUG)
+    else:
+        # the per-match log messages of concurrent requests would be interleaved and unreadable
+        logger.setLevel(logging.WARNING)
+
+    def announce(message: str):
+        if not args.quiet:
+            sys.stderr.write(f"{message}\n")
+            sys.stderr.flush()
+
+    announce("Loading the magic definitions and parsers...")
+    server.warm_up()
+
+    with ExitStack() as stack:
+        if args.isolate_parsers or args.parser_timeout is not None or args.parser_max_memory is not None:
+            parser_pool: Optional[ParserPool] = stack.enter_context(ParserPool(
+                max_workers=args.max_concurrent, timeout=args.parser_timeout, max_memory=args.parser_max_memory
+            ))
+        else:
+            parser_pool = None
+        analysis_server = server.AnalysisServer(
+            max_concurrent=args.max_concurrent, allowed_paths=tuple(args.allow_path), parser_pool=parser_pool,
+            max_body_size=args.max_body_size
+        )
+        try:
+            http_server = server.make_server(
+                analysis_server, host=args.host, port=args.port, unix_socket=args.unix_socket
+            )
+        except (OSError, ValueError) as e:
+            log.error(f"Could not start the server: {e!s}")
+            return 1
+        with http_server:
+            if args.unix_socket is not None:
+                announce(f"Listening on {args.unix_socket}")
+            else:
+                announce(f"Listening on http://{args.host}:{http_server.server_address[1]}/")
+
+            def sigterm_handler(signum, frame):
+                raise KeyboardInterrupt()
+
+            signal.signal(signal.SIGTERM, sigterm_handler)
+            try:
+                http_server.serve_forever()
+            except KeyboardInterrupt:
+                announce("Shutting down")
+    return 0
+
+
 def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    if argv[1:2] == ["serve"]:
+        exit(serve(argv[2:]))
+
     parser = argparse.ArgumentParser(description='A utility to recursively map the structure of a file.',
                                      formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('FILE', nargs='?', default='-',
-                        help='the file to analyze; pass \'-\' or omit to read from STDIN')
+                        help='the file to analyze; pass \'-\' or omit to read from STDIN (run `polyfile serve --help` '
+                             'for the analysis daemon)')
 
     parser.add_argument('--format', '-r', type=FormatOutput, action="append", choices=[
-        FormatOutput(f) for f in FormatOutput.valid_formats + ("json",)
+        FormatOutput(f) for f in (FormatOutput.default_format,) + FormatOutput.valid_formats
     ], help=dedent("""PolyFile's output format
 
 Output formats are:
@@ -133,6 +315,11 @@ explain ... like 'mime', but adds a human-readable explanation
 html ...... an interactive HTML-based hex viewer
 json ...... a modified version of the SBUD format in JSON syntax
 sbud ...... equivalent to 'json'
+ndjson .... one JSON object per line for each match, streamed
+            as the matches are found
+columnar .. a compact binary equivalent of 'sbud' that can be
+            loaded quickly; convert it back to 'json' or 'html'
+            with `python -m polyfile.columnar`
 
 Multiple formats can be output at once:
 
@@ -165,6 +352,16 @@ If an `--output` is omitted for a format,
 then it will implicitly be printed to STDOUT.
 """))
 
+    parser.add_argument('--contents', type=ContentsMode, default=ContentsMode.EMBED,
+                        choices=list(ContentsMode), metavar="{" + ",".join(c.value for c in ContentsMode) + "}",
+                        help=dedent("""how the contents of the input file are included in
+SBUD/JSON output (default is `embed`):
+
+embed ...... base64 encode the entire file in `b64contents`
+reference .. replace `b64contents` with `contentsPath`,
+             the absolute path to the input file
+omit ....... do not include the file contents at all"""))
+
     parser.add_argument('--filetype', '-f', action='append',
                         help='explicitly match against the given filetype or filetype wildcard (default is to match '
                              'against all filetypes)')
@@ -176,9 +373,9 @@ then it will implicitly be printed to STDOUT.
                        help=dedent("""path to write an interactive HTML file for exploring the PDF;
 equivalent to `--format html --output HTML`"""))
     group.add_argument("--explain", action="store_true", help="equivalent to `--format explain")
-    # parser.add_argument('--try-all-offsets', '-a', action='store_true',
-    #                     help='Search for a file match at every possible offset; this can be very slow for larger '
-    #                     'files')
+    parser.add_argument('--try-all-offsets', '-a', action='store_true',
+                        help='also search for files embedded at nonzero offsets (e.g., in a firmware image) by '
+                             'carving at every offset where the signature of a file type occurs')
     group.add_argument('--only-match-mime', '-I', action='store_true',
                        help=dedent(""""just print out the matching MIME types for the file, one on each line;
 equivalent to `--format mime`"""))
@@ -187,6 +384,60 @@ equivalent to `--format mime`"""))
     parser.add_argument('--require-match', action='store_true', help='if no matches are found, exit with code 127')
     parser.add_argument('--max-matches', type=int, default=None,
                         help='stop scanning after having found this many matches')
+    parser.add_argument('--max-depth', type=int, default=None,
+                        help='do not recursively match embedded files nested more than this deep')
+    parser.add_argument('--max-decompressed-bytes', type=int, default=None,
+                        help='truncate decompressed data once parsers have decompressed this many bytes in total')
+    parser.add_argument('--max-nodes', type=int, default=None,
+                        help='stop parsing after having created this many matches and submatches')
+    parser.add_argument('--max-embedded-size', type=int, default=None,
+                        help='do not recursively match embedded files larger than this many bytes')
+    parser.add_argument('--max-nodes-in-memory', type=int, default=None, metavar="N",
+                        help='keep at most about N matches in memory, spilling the rest of the match tree to a '
+                             'temporary file on disk; bounds the memory needed to output the JSON of very large '
+                             'files (the HTML output still loads the whole tree)')
+    parser.add_argument('--snapshot', type=str, default=None, metavar="PATH",
+                        help='save a snapshot of the analysis to PATH; if PATH already has a snapshot of an earlier '
+                             'version of the file that has since only been appended to, resume from it, only parsing '
+                             'the appended data')
+    parser.add_argument('--isolate-parsers', action='store_true',
+                        help='run each parser in a separate worker process so that a misbehaving parser cannot hang or '
+                             'crash PolyFile; implied by --parser-timeout and --parser-max-memory')
+    parser.add_argument('--parser-timeout', type=float, default=None,
+                        help='kill any parser that runs for longer than this many seconds (implies --isolate-parsers)')
+    parser.add_argument('--parser-max-memory', type=int, default=None,
+                        help='limit the memory of each parser worker process to this many bytes (implies '
+                             '--isolate-parsers)')
+    parser.add_argument('--embedded-workers', type=int, default=None,
+                        help='match embedded files (e.g., the members of an archive) concurrently in this many worker '
+                             'processes')
+    parser.add_argument('--deduplicate', action='store_true',
+                        help='only analyze identical embedded files (e.g., the same font in every page of a PDF) once, '
+                             'at the cost of keeping their matches in memory')
+    parser.add_argument('--batch', action='append', metavar='DIR|@LIST',
+                        help=dedent("""analyze many files in one run: a directory is walked
+recursively, and @LIST reads one file or directory per line
+from LIST (or from STDIN if LIST is '-'); may be repeated
+
+The results of each file are written to STDOUT as one JSON
+object per line containing its `path` and its output in
+each requested `--format`, or are saved in `--output-dir`"""))
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='the number of worker processes to use with `--batch` (default is the number of CPUs)')
+    parser.add_argument('--output-dir', type=str, default=None,
+                        help='with `--batch`, save the output of each file in each format to this directory as '
+                             'NAME.FORMAT, mirroring the structure of the input directories')
+    parser.add_argument('--incremental', type=str, nargs='?', const='', default=None, metavar='INDEX',
+                        help='with `--batch`, only analyze the files that are new or have changed since the last '
+                             'incremental run, according to their inode, size, and modification times recorded in '
+                             'the INDEX database (default is `polyfile-index.sqlite3` in the `--output-dir`); '
+                             'unchanged files are reported from the index, and deleted files are reported as such')
+    parser.add_argument('--cache', type=str, default=None, metavar='DB',
+                        help='with `--batch`, reuse the results of files whose content was already analyzed with the '
+                             'same options, storing new results in this SQLite database')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_CACHE_SIZE,
+                        help='the maximum size of the `--cache` in bytes; the least recently used results are evicted '
+                             'beyond it (default is %(default)s)')
     parser.add_argument('--debugger', '-db', action='store_true', help='drop into an interactive debugger for libmagic '
                                                                        'file definition matching and PolyFile parsing')
     parser.add_argument('--eval-command', '-ex', type=str, action='append', help='execute the given debugger command')
@@ -203,9 +454,6 @@ equivalent to `--format mime`"""))
     group.add_argument('-dumpversion', action='store_true',
                        help='print PolyFile\'s raw version information to STDOUT and exit')
 
-    if argv is None:
-        argv = sys.argv
-
     try:
         args = parser.parse_args(argv[1:])
     except ValueError as e:
@@ -224,7 +472,7 @@ equivalent to `--format mime`"""))
         exit(1)
 
     if args.list:
-        for mimetype in sorted(MagicMatcher.DEFAULT_INSTANCE.mimetypes):
+        for mimetype in sorted(default_mimetypes()):
             print(mimetype)
         exit(0)
 
@@ -264,7 +512,7 @@ equivalent to `--format mime`"""))
     if args.filetype:
         regex = r'|'.join(fr"({ f.replace('*', '.*').replace('?', '.?') })" for f in args.filetype)
         matcher = re.compile(regex)
-        mimetypes = [mimetype for mimetype in MagicMatcher.DEFAULT_INSTANCE.mimetypes if matcher.fullmatch(mimetype)]
+        mimetypes = [mimetype for mimetype in default_mimetypes() if matcher.fullmatch(mimetype)]
         if not mimetypes:
             log.error(f"Filetype argument(s) { args.filetype } did not match any known definitions!")
             exit(1)
@@ -273,19 +521,31 @@ equivalent to `--format mime`"""))
     else:
         magic_matcher = None
 
+    if args.batch:
+        exit(run_batch(args, magic_matcher))
+    elif args.cache is not None or args.incremental is not None:
+        log.warning("Ignoring `--cache` and `--incremental`, which only apply to `--batch`")
+
     sigterm_handler = SIGTERMHandler()
 
-    try:
-        path_or_stdin = PathOrStdin(args.FILE)
-    except FileNotFoundError:
+    if args.FILE == '-':
+        # buffer STDIN in memory (spilling to disk only if it is large) rather than copying it to a temporary file
+        input_file: Union[str, SpooledInput] = SpooledInput(sys.stdin.buffer)
+        try:
+            # read it now, before the debugger might need STDIN
+            len(input_file)
+        except KeyboardInterrupt:
+            # this will happen if the user presses ^C wile reading from STDIN
+            exit(1)
+            return  # this is here because linters are dumb and will complain about the next line without it
+    elif not Path(args.FILE).exists():
         log.error(f"Cannot open {args.FILE!r} (No such file or directory)")
         exit(1)
-    except KeyboardInterrupt:
-        # this will happen if the user presses ^C wile reading from STDIN
-        exit(1)
-        return  # this is here because linters are dumb and will complain about the next line without it
+        return
+    else:
+        input_file = args.FILE
 
-    with path_or_stdin as file_path, ExitStack() as stack:
+    with ExitStack() as stack:
         if args.debugger:
             debugger = Debugger(break_on_parsing=not args.no_debug_python)
             if args.eval_command:
@@ -303,12 +563,66 @@ equivalent to `--format mime`"""))
         elif args.no_debug_python:
             log.warning("Ignoring `--no-debug-python`; it can only be used with the --debugger option.")
 
-        analyzer = Analyzer(file_path, parse=not args.only_match, magic_matcher=magic_matcher)
-
-        needs_sbud = any(output_format.output_format in {"html", "json", "sbud"} for output_format in args.format)
+        if args.isolate_parsers or args.parser_timeout is not None or args.parser_max_memory is not None:
+            if args.debugger:
+                log.warning("Ignoring `--isolate-parsers`; parsers cannot be debugged out of process.")
+                parser_pool: Optional[ParserPool] = None
+            else:
+                parser_pool = stack.enter_context(ParserPool(
+                    timeout=args.parser_timeout, max_memory=args.parser_max_memory
+                ))
+        else:
+            parser_pool = None
+
+        if args.embedded_workers is not None and args.max_nodes_in_memory is not None:
+            log.warning("Ignoring `--embedded-workers`; the match tree cannot be spilled to disk while embedded files "
+                        "are matched concurrently")
+            args.embedded_workers = None
+        if args.embedded_workers is not None and (magic_matcher is not None or parser_pool is not None):
+            log.warning("Ignoring `--embedded-workers`; embedded files are only matched concurrently against all "
+                        "filetypes and with parsers run in process, so it cannot be used with `--filetype` or "
+                        "`--isolate-parsers`")
+            args.embedded_workers = None
+        if args.embedded_workers is not None and args.embedded_workers > 1 and not args.debugger:
+            scheduler: Optional[EmbeddedScheduler] = stack.enter_context(
+                EmbeddedScheduler(max_workers=args.embedded_workers)
+            )
+        else:
+            scheduler = None
+
+        # the output formats other than `file` share a single pass that only matches tests with a MIME type; the `file`
+        # format needs every match, so it runs a full pass
+        only_match_mime = all(output_format.output_format != "file" for output_format in args.format)
+        analyzer = Analyzer(input_file, try_all_offsets=args.try_all_offsets, parse=not args.only_match,
+                            magic_matcher=magic_matcher,
+                            only_match_mime=only_match_mime, quota=Quota(
+                                max_depth=args.max_depth,
+                                max_decompressed_bytes=args.max_decompressed_bytes,
+                                max_nodes=args.max_nodes,
+                                max_embedded_size=args.max_embedded_size
+                            ), parser_pool=parser_pool, scheduler=scheduler,
+                            name="STDIN" if args.FILE == '-' else None,
+                            max_nodes_in_memory=args.max_nodes_in_memory, deduplicate=args.deduplicate)
+        stack.callback(analyzer.close)
+        file_path = analyzer.file_stream
+
+        if args.snapshot is not None and args.max_matches is not None:
+            log.warning("Ignoring `--snapshot`; a snapshot requires the complete analysis, but `--max-matches` was set")
+            args.snapshot = None
+        if args.snapshot is not None and Path(args.snapshot).exists():
+            try:
+                analyzer.resume(args.snapshot)
+            except (OSError, columnar.ColumnarFormatError) as e:
+                log.warning(f"Ignoring the snapshot at {args.snapshot}: {e!s}")
+
+        # the JSON is written one match at a time, so only the HTML needs the whole SBUD in memory
+        needs_sbud = any(output_format.output_format == "html" for output_format in args.format)
+        needs_matches = args.snapshot is not None or any(
+            output_format.output_format in {"html", "json", "sbud", "columnar"} for output_format in args.format
+        )
         with KeyboardInterruptHandler():
             # do we need to do a full match? if so, do that up front:
-            if needs_sbud:
+            if needs_matches:
                 if args.max_matches is None or args.max_matches > 0:
                     for match in analyzer.matches():
                         if sigterm_handler.terminated:
@@ -317,12 +631,14 @@ equivalent to `--format mime`"""))
                             if args.max_matches is not None and len(analyzer.matches_so_far) >= args.max_matches:
                                 log.info(f"Found {args.max_matches} matches; stopping early")
                                 break
+        # if matching stopped early, the matches found so far still need to be spilled
+        analyzer.stop()
         if needs_sbud:
-            sbud = analyzer.sbud(matches=analyzer.matches_so_far)
+            sbud = analyzer.sbud(matches=analyzer.matches_so_far, contents=args.contents)
 
-            if args.require_match and not analyzer.matches_so_far:
-                log.info("No matches found, exiting")
-                exit(127)
+        if needs_matches and args.require_match and not analyzer.matches_so_far:
+            log.info("No matches found, exiting")
+            exit(127)
 
         for output_format in args.format:
             with output_format.output_stream as output:
@@ -365,7 +681,7 @@ equivalent to `--format mime`"""))
                                 output.write("\n")
                             if output_format.output_format == "explain":
                                 output.write(match.explain(ansi_color=output.isatty(), file=file_path))
-                    if args.require_match and not found_match and not needs_sbud:
+                    if args.require_match and not found_match and not needs_matches:
                         log.info("No matches found, exiting")
                         exit(127)
                     if omm:
@@ -373,19 +689,57 @@ equivalent to `--format mime`"""))
                     elif not output_format.output_to_stdout:
                         log.info(f"Saved MIME output to {output_format.output_path}")
                 elif output_format.output_format == "json" or output_format.output_format == "sbud":
-                    assert needs_sbud
-                    json.dump(sbud, output)
+                    assert needs_matches
+                    analyzer.write_sbud(output, matches=analyzer.matches_so_far, contents=args.contents)
                     if not output_format.output_to_stdout:
                         log.info(f"Saved {output_format.output_format.upper()} output to {output_format.output_path}")
+                elif output_format.output_format == "ndjson":
+                    def write_event(event):
+                        output.write(json.dumps(event))
+                        output.write("\n")
+
+                    num_matches = 0
+                    with KeyboardInterruptHandler():
+                        if args.max_matches is None or args.max_matches > 0:
+                            # if the matches were not already computed for another format, this will stream them
+                            for _ in analyzer.stream(write_event, release=not needs_matches):
+                                output.flush()
+                                num_matches += 1
+                                if sigterm_handler.terminated:
+                                    break
+                                if args.max_matches is not None and num_matches >= args.max_matches:
+                                    log.info(f"Found {args.max_matches} matches; stopping early")
+                                    break
+                    output.flush()
+                    if args.require_match and not num_matches and not needs_matches:
+                        log.info("No matches found, exiting")
+                        exit(127)
+                    if not output_format.output_to_stdout:
+                        log.info(f"Saved NDJSON output to {output_format.output_path}")
                 elif output_format.output_format == "html":
                     assert needs_sbud
                     output.write(html.generate(file_path, sbud))
                     if not output_format.output_to_stdout:
                         log.info(f"Saved HTML output to {output_format.output_path}")
+                elif output_format.output_format == "columnar":
+                    assert needs_matches
+                    output.flush()
+                    columnar.dump(analyzer, output.buffer, matches=analyzer.matches_so_far, contents=args.contents)
+                    output.buffer.flush()
+                    if not output_format.output_to_stdout:
+                        log.info(f"Saved columnar output to {output_format.output_path}")
                 else:
                     # This should never happen because the output formats are constrained by argparse
                     raise NotImplementedError(f"TODO: Add support for output format {output_format!r}")
 
+        if args.snapshot is not None and not sigterm_handler.terminated:
+            # write the snapshot alongside the old one and then replace it, so that it is never left incomplete
+            partial_path = f"{args.snapshot}.partial"
+            with open(partial_path, "wb") as snapshot_file:
+                analyzer.snapshot(snapshot_file)
+            os.replace(partial_path, args.snapshot)
+            log.info(f"Saved a snapshot of the analysis to {args.snapshot}")
+
         if sigterm_handler.terminated:
             sys.exit(128 + signal.SIGTERM)
 
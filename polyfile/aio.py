@@ -0,0 +1,227 @@
+"""
+An asyncio API for PolyFile.
+
+`Analyzer.matches` is a synchronous generator that blocks on CPU and file I/O. An `AsyncAnalyzer` runs the same
+matching in an executor instead and delivers the matches to the event loop incrementally:
+
+    async for match in AsyncAnalyzer(path).amatches():
+        ...
+
+With a `concurrent.futures.ThreadPoolExecutor` (or the event loop's default executor), the matches are found in a
+worker thread. With a `concurrent.futures.ProcessPoolExecutor`, the whole analysis runs in a worker process, which
+sends each match tree back to be reconstructed in this process, as `polyfile.workers.ParserPool` does for parsers.
+
+"""
+
+import asyncio
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+import multiprocessing
+from multiprocessing.connection import Connection
+from pathlib import Path
+import threading
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple, Union
+
+from .magic import MagicMatcher
+from .polyfile import Analyzer, Match, Matcher
+from .quotas import Quota
+from .workers import _merge_quota, _MatchRecorder, _quota_limits, _reconstruct, MatchRecord, ROOT_ID
+
+
+def complete_matches(analyzer: Analyzer, cancelled: Optional[threading.Event] = None) -> Iterator[Match]:
+    """
+    Yields each of `analyzer`'s top-level matches once its subtree is complete.
+
+    Matching stops as soon as `cancelled` is set, even in the middle of a top-level match.
+
+    """
+    previous: Optional[Match] = None
+    for match in analyzer.matcher.match_magic(analyzer.mime_matches(), analyzer.context, analyzer.file_stream):
+        if cancelled is not None and cancelled.is_set():
+            return
+        if match.parent is None:
+            if previous is not None:
+                yield previous
+            previous = match
+    if previous is not None:
+        yield previous
+
+
+RootRecord = Tuple[str, str, int, Optional[int], Optional[str], Optional[str], Optional[bytes], Optional[str]]
+"""A top-level match sent from a worker: (name, value, offset, fixed length, display name, image data, decoded data,
+extension)"""
+
+
+def _analyze_in_process(conn: Connection, path: str, try_all_offsets: bool, parse: bool,
+                        limits: Dict[str, Optional[int]]):
+    """Runs an analysis in a worker process, sending each complete top-level match tree over `conn`"""
+    quota = Quota(**limits)
+    analyzer = Analyzer(path, try_all_offsets=try_all_offsets, parse=parse, only_match_mime=True, quota=quota)
+    try:
+        for match in complete_matches(analyzer):
+            root: RootRecord = (
+                match.name, str(match.match), match.offset, match._length, match._display_name, match.img_data,
+                match.decoded, match.extension
+            )
+            conn.send(("match", root, _MatchRecorder(match).record_remaining()))
+        conn.send(("done", list(quota.limits_reached), quota.decompressed_bytes))
+    except (BrokenPipeError, ConnectionResetError):
+        # the analysis was cancelled
+        pass
+    except Exception as e:
+        try:
+            conn.send(("error", f"{e.__class__.__name__}: {e!s}"))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+    finally:
+        conn.close()
+
+
+async def _wait_readable(conn: Connection, worker: "asyncio.Future[Any]"):
+    """Waits until `conn` has data to receive or `worker` has finished"""
+    loop = asyncio.get_running_loop()
+    readable = loop.create_future()
+
+    def on_readable():
+        if not readable.done():
+            readable.set_result(None)
+
+    try:
+        loop.add_reader(conn.fileno(), on_readable)
+    except NotImplementedError:
+        # event loops without `add_reader` (e.g., the proactor on Windows) poll in a thread instead
+        poll = loop.run_in_executor(None, conn.poll, None)
+        await asyncio.wait((poll, worker), return_when=asyncio.FIRST_COMPLETED)
+        return
+    try:
+        await asyncio.wait((readable, worker), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        loop.remove_reader(conn.fileno())
+        readable.cancel()
+
+
+class AsyncAnalyzer:
+    """
+    Analyzes a single file without blocking the event loop.
+
+    The matching runs in `executor`, or in the event loop's default executor if it is None. If `limiter` is not None,
+    an analysis holds it for as long as it runs, so sharing one `asyncio.Semaphore` between many analyzers bounds how
+    many of them run at once. Cancelling the task iterating `amatches` (or breaking out of the loop) stops the
+    analysis: a worker thread stops at the next match, and a worker process stops when it next tries to send one.
+
+    """
+    def __init__(
+            self,
+            path: Union[str, Path],
+            executor: Optional[Executor] = None,
+            limiter: Optional[asyncio.Semaphore] = None,
+            try_all_offsets: bool = False,
+            parse: bool = True,
+            magic_matcher: Optional[MagicMatcher] = None,
+            quota: Optional[Quota] = None
+    ):
+        if magic_matcher is not None and isinstance(executor, ProcessPoolExecutor):
+            raise ValueError("A custom `magic_matcher` cannot be used with a process executor")
+        self.path: Union[str, Path] = path
+        self.executor: Optional[Executor] = executor
+        self.limiter: Optional[asyncio.Semaphore] = limiter
+        self.try_all_offsets: bool = try_all_offsets
+        self.parse: bool = parse
+        self.magic_matcher: Optional[MagicMatcher] = magic_matcher
+        if quota is None:
+            quota = Quota()
+        self.quota: Quota = quota
+        self.matches_so_far: List[Match] = []
+
+    async def amatches(self) -> AsyncIterator[Match]:
+        """Yields each top-level match once its subtree is complete"""
+        if self.limiter is not None:
+            await self.limiter.acquire()
+        try:
+            if isinstance(self.executor, ProcessPoolExecutor):
+                matches = self._process_matches()
+            else:
+                matches = self._thread_matches()
+            try:
+                async for match in matches:
+                    self.matches_so_far.append(match)
+                    yield match
+            finally:
+                await matches.aclose()
+        finally:
+            if self.limiter is not None:
+                self.limiter.release()
+
+    async def _thread_matches(self) -> AsyncIterator[Match]:
+        loop = asyncio.get_running_loop()
+        analyzer = Analyzer(
+            self.path, try_all_offsets=self.try_all_offsets, parse=self.parse, magic_matcher=self.magic_matcher,
+            only_match_mime=True, quota=self.quota
+        )
+        cancelled = threading.Event()
+        iterator = complete_matches(analyzer, cancelled)
+        running = threading.Lock()
+
+        def step() -> Optional[Match]:
+            with running:
+                if cancelled.is_set():
+                    return None
+                return next(iterator, None)
+
+        try:
+            while True:
+                match = await loop.run_in_executor(self.executor, step)
+                if match is None:
+                    break
+                yield match
+        finally:
+            cancelled.set()
+            # if a step is still running in the worker thread, it will stop at the next match since `cancelled` is set
+            if running.acquire(blocking=False):
+                try:
+                    iterator.close()
+                finally:
+                    running.release()
+
+    async def _process_matches(self) -> AsyncIterator[Match]:
+        limits = _quota_limits(self.quota)
+        conn, child_conn = multiprocessing.Pipe(duplex=False)
+        future: Future = self.executor.submit(
+            _analyze_in_process, child_conn, str(self.path), self.try_all_offsets, self.parse, limits
+        )
+        worker = asyncio.wrap_future(future)
+        # the matches are reconstructed in this process, but count against the same quota
+        matcher = Matcher(try_all_offsets=self.try_all_offsets, parse=self.parse, quota=self.quota)
+        try:
+            while True:
+                await _wait_readable(conn, worker)
+                if not conn.poll():
+                    # the worker finished without sending anything else, so it must have died
+                    await worker
+                    raise RuntimeError(f"The worker analyzing {self.path!s} exited unexpectedly")
+                message: Tuple[Any, ...] = conn.recv()
+                if message[0] == "match":
+                    yield self._reconstruct_tree(message[1], message[2], matcher)
+                elif message[0] == "done":
+                    _merge_quota(self.quota, message[1], message[2])
+                    break
+                else:
+                    raise RuntimeError(f"Error analyzing {self.path!s}: {message[1]}")
+        finally:
+            # closing our end makes the worker stop the next time that it tries to send a match
+            conn.close()
+            child_conn.close()
+            future.cancel()
+            if not worker.done():
+                worker.cancel()
+
+    @staticmethod
+    def _reconstruct_tree(root: RootRecord, records: List[MatchRecord], matcher: Matcher) -> Match:
+        name, value, offset, length, display_name, img_data, decoded, extension = root
+        match = Match(
+            name, value, offset, length=length, matcher=matcher, display_name=display_name, img_data=img_data,
+            decoded=decoded, extension=extension
+        )
+        matches: Dict[int, Match] = {ROOT_ID: match}
+        for record in records:
+            _reconstruct(record, matches)
+        return match
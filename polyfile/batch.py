@@ -0,0 +1,580 @@
+"""
+Batch analysis of many files.
+
+Analyzing a corpus with one PolyFile process per file reloads the magic definitions and re-imports every parser for
+each file. A `BatchAnalyzer` loads them once and then forks a pool of worker processes that share them copy-on-write.
+Files are dispatched largest first to cut the tail latency of the batch, and the operating system is asked to read the
+next files ahead while the current ones are being analyzed.
+
+"""
+
+import base64
+import gc
+import json
+from multiprocessing.connection import Connection, wait
+import os
+from pathlib import Path
+import queue
+import sys
+import threading
+from typing import Any, Dict, IO, Iterable, Iterator, List, Optional, Tuple
+
+from . import html
+from . import logger
+from .cache import content_sha256, CorpusIndex, file_signature, FileSignature, ResultCache
+from .magic import MagicMatcher
+from .polyfile import Analyzer, ContentsMode, SBUD_CHUNK_SIZE
+from .quotas import Quota
+from .workers import _multiprocessing_context, ParserPool
+
+log = logger.getStatusLogger("polyfile")
+
+
+BATCH_FORMATS: Tuple[str, ...] = ("file", "mime", "explain", "json", "sbud", "html", "ndjson")
+
+OUTPUT_EXTENSIONS: Dict[str, str] = {
+    "file": ".file",
+    "mime": ".mime",
+    "explain": ".explain",
+    "json": ".json",
+    "sbud": ".json",
+    "html": ".html",
+    "ndjson": ".ndjson"
+}
+"""The extension appended to the name of each input file for each format in an output directory"""
+
+
+class BatchInput:
+    """A file to be analyzed in a batch"""
+
+    __slots__ = ("path", "name", "size", "signature")
+
+    def __init__(self, path: str, name: str, size: int, signature: Optional[FileSignature] = None):
+        self.path: str = path
+        self.name: str = name
+        """The relative path under which this file's results are saved in an output directory"""
+        self.size: int = size
+        self.signature: Optional[FileSignature] = signature
+        """The file's signature when it was listed, which a `CorpusIndex` uses to detect whether it has changed"""
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(path={self.path!r}, name={self.name!r}, size={self.size!r})"
+
+
+def _walk(directory: Path) -> Iterator[Path]:
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(files):
+            yield Path(root) / filename
+
+
+def batch_inputs(sources: Iterable[str]) -> List[BatchInput]:
+    """
+    Expands the sources of a batch into the files to analyze.
+
+    Each source is either a directory, which is walked recursively, a path to a single file, or `@LIST` where `LIST`
+    is the path to a file (or '-' for STDIN) listing one source per line. Symbolic links to files are followed, but
+    files that cannot be read are skipped with a warning.
+
+    """
+    inputs: List[BatchInput] = []
+    names = set()
+
+    def add(path: Path, name: str):
+        try:
+            st = path.stat()
+        except OSError as e:
+            log.warning(f"Skipping {str(path)!r}: {e.strerror}")
+            return
+        if name in names:
+            # two inputs would be saved to the same place, so disambiguate the later one
+            stem = name
+            suffix = 1
+            while name in names:
+                name = f"{stem}.{suffix}"
+                suffix += 1
+        names.add(name)
+        inputs.append(BatchInput(path=str(path), name=name, size=st.st_size, signature=file_signature(st)))
+
+    def expand(source: str):
+        if source.startswith("@"):
+            list_path = source[1:]
+            if list_path == "-":
+                lines = sys.stdin.read().splitlines()
+            else:
+                with open(list_path, "r") as f:
+                    lines = f.read().splitlines()
+            for line in lines:
+                line = line.strip()
+                if line:
+                    expand(line)
+            return
+        path = Path(source)
+        if path.is_dir():
+            for file_path in _walk(path):
+                if file_path.is_file():
+                    add(file_path, str(file_path.relative_to(path)))
+        elif path.exists():
+            add(path, path.name)
+        else:
+            log.warning(f"Skipping {source!r}: No such file or directory")
+
+    for s in sources:
+        expand(s)
+    return inputs
+
+
+def schedule(inputs: Iterable[BatchInput]) -> List[BatchInput]:
+    """Orders the inputs largest first, so that the longest analyses are not left until the end of the batch"""
+    return sorted(inputs, key=lambda batch_input: batch_input.size, reverse=True)
+
+
+class Prefetcher:
+    """
+    Asks the operating system to read files into its page cache in a background thread.
+
+    Where `os.posix_fadvise` is available the reads are asynchronous hints; elsewhere the files are read and discarded.
+
+    """
+    def __init__(self):
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    def prefetch(self, path: str):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="polyfile-prefetch", daemon=True)
+            self._thread.start()
+        self._queue.put(path)
+
+    def _run(self):
+        while True:
+            path = self._queue.get()
+            if path is None:
+                break
+            try:
+                with open(path, "rb") as f:
+                    if hasattr(os, "posix_fadvise"):
+                        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                    else:
+                        while f.read(1024 * 1024):
+                            pass
+            except OSError:
+                # the file will be reported when it is analyzed
+                pass
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self) -> "Prefetcher":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+_SBUD_FILE_FIELDS: Tuple[str, ...] = ("b64contents", "contentsPath", "fileName")
+"""The fields of an SBUD that depend on the file's name or on the contents mode rather than on its content"""
+
+
+def _strip_sbud(sbud: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in sbud.items() if key not in _SBUD_FILE_FIELDS}
+
+
+def _restore_sbud(stripped: Dict[str, Any], path: str, contents: ContentsMode) -> Dict[str, Any]:
+    """The inverse of `_strip_sbud` for the file at `path`, with its fields in the same order as `Analyzer.sbud`"""
+    sbud: Dict[str, Any] = {name: stripped[name] for name in ("MD5", "SHA1", "SHA256")}
+    if contents == ContentsMode.EMBED:
+        # SBUD_CHUNK_SIZE is a multiple of three, so the encoded chunks can be concatenated
+        b64chunks: List[str] = []
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(SBUD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                b64chunks.append(base64.b64encode(chunk).decode("utf-8"))
+        sbud["b64contents"] = "".join(b64chunks)
+    elif contents == ContentsMode.REFERENCE:
+        sbud["contentsPath"] = str(Path(path).absolute())
+    sbud["fileName"] = path
+    sbud.update((key, value) for key, value in stripped.items() if key not in sbud)
+    return sbud
+
+
+class BatchAnalyzer:
+    """
+    Analyzes many files, optionally in a pool of `jobs` forked worker processes.
+
+    Each file is analyzed by its own `Analyzer` with a fresh `Quota` built from `quota_limits`. The result of a file
+    is a dict with its `path` and, for each of the requested `formats`, its output: a list of lines for `file` and
+    `mime`, a list of events for `ndjson`, the SBUD object for `json` and `sbud`, and text for `explain` and `html`.
+    If `output_dir` is set, the outputs are instead saved to `output_dir`/NAME.EXT by the workers (see
+    `OUTPUT_EXTENSIONS`) and the result lists the saved paths in `outputs`; unless the outputs are also cached, the
+    `ndjson` events are then written as they are produced rather than collected. A file that could not be analyzed has
+    an `error` instead. Results are produced in the order in which the files finish.
+
+    If `cache` is not None, the outputs of a file whose content was already analyzed with the same options are read
+    from the cache rather than recomputed (see `polyfile.cache.ResultCache`), and the result has `"cached": true`.
+    Files analyzed with a custom `magic_matcher` are never cached, since its definitions cannot be fingerprinted.
+
+    If `index` is not None, the batch is incremental (see `polyfile.cache.CorpusIndex`): a file whose inode, size, and
+    modification and status change times are the same as when it was last analyzed with the same options is not
+    opened at all, and its previous result is reported with `"unchanged": true`. Every other file is analyzed and its
+    result is recorded in the index, unless it is an error. Once all of the files have finished, each file in the
+    index that is no longer among the inputs is removed from it and reported as `{"path": ..., "deleted": true}`.
+
+    """
+    def __init__(
+            self,
+            formats: Iterable[str] = ("mime",),
+            jobs: Optional[int] = None,
+            output_dir: Optional[str] = None,
+            try_all_offsets: bool = False,
+            parse: bool = True,
+            magic_matcher: Optional[MagicMatcher] = None,
+            contents: ContentsMode = ContentsMode.EMBED,
+            quota_limits: Optional[Dict[str, Optional[int]]] = None,
+            parser_timeout: Optional[float] = None,
+            parser_max_memory: Optional[int] = None,
+            isolate_parsers: bool = False,
+            cache: Optional[ResultCache] = None,
+            index: Optional[CorpusIndex] = None
+    ):
+        self.formats: Tuple[str, ...] = tuple(formats)
+        for output_format in self.formats:
+            if output_format not in BATCH_FORMATS:
+                raise ValueError(f"Unsupported batch output format {output_format!r}")
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        self.jobs: int = max(jobs, 1)
+        self.output_dir: Optional[str] = output_dir
+        self.try_all_offsets: bool = try_all_offsets
+        self.parse: bool = parse
+        self.magic_matcher: Optional[MagicMatcher] = magic_matcher
+        self.contents: ContentsMode = contents
+        if quota_limits is None:
+            quota_limits = {}
+        self.quota_limits: Dict[str, Optional[int]] = quota_limits
+        self.isolate_parsers: bool = isolate_parsers or parser_timeout is not None or parser_max_memory is not None
+        self.parser_timeout: Optional[float] = parser_timeout
+        self.parser_max_memory: Optional[int] = parser_max_memory
+        self.cache: Optional[ResultCache] = cache
+        self.index: Optional[CorpusIndex] = index
+        self._parser_pool: Optional[ParserPool] = None
+
+    def preload(self):
+        """Loads the magic definitions (the parsers are imported with this module) so that forked workers inherit them"""
+        magic_matcher = self.magic_matcher
+        if magic_matcher is None:
+            magic_matcher = MagicMatcher.DEFAULT_INSTANCE
+        if self.try_all_offsets:
+            magic_matcher.carving_index()
+
+    def analyze(self, batch_input: BatchInput) -> Dict[str, Any]:
+        """Analyzes a single file in this process"""
+        result: Dict[str, Any] = {"path": batch_input.path}
+        try:
+            if self.cache is not None and self.magic_matcher is None:
+                outputs = self._cached_analyze(batch_input.path, result)
+            elif self.output_dir is not None and "ndjson" in self.formats:
+                with open(self._output_path(batch_input, "ndjson"), "w") as ndjson:
+                    outputs, _ = self._analyze(batch_input.path, ndjson=ndjson)
+            else:
+                outputs, _ = self._analyze(batch_input.path)
+            if self.output_dir is None:
+                result.update(outputs)
+            else:
+                result["outputs"] = self._save(batch_input, outputs)
+        except Exception as e:
+            result["error"] = f"{e.__class__.__name__}: {e!s}"
+        return result
+
+    def _parser_options(self) -> Dict[str, Any]:
+        """The parser isolation options, which affect the results since a parser that is killed leaves them partial"""
+        return {
+            "isolate_parsers": self.isolate_parsers,
+            "parser_timeout": self.parser_timeout,
+            "parser_max_memory": self.parser_max_memory
+        }
+
+    def _cache_options(self) -> Dict[str, Any]:
+        """The options that affect the cached outputs; the SBUD is cached without its name and contents"""
+        formats = sorted({"sbud" if output_format in ("json", "sbud", "html") else output_format
+                          for output_format in self.formats})
+        return {
+            "formats": formats,
+            "try_all_offsets": self.try_all_offsets,
+            "parse": self.parse,
+            "quota": self.quota_limits,
+            "parsers": self._parser_options()
+        }
+
+    def _cached_analyze(self, path: str, result: Dict[str, Any]) -> Dict[str, Any]:
+        key = self.cache.key(content_sha256(path), self._cache_options())
+        cached = self.cache.get(key)
+        if cached is None:
+            outputs, sbud = self._analyze(path)
+            cached = {
+                output_format: output for output_format, output in outputs.items()
+                if output_format not in ("json", "sbud", "html")
+            }
+            if sbud is not None:
+                cached["sbud"] = _strip_sbud(sbud)
+            self.cache.put(key, cached)
+            return outputs
+        result["cached"] = True
+        sbud = None
+        if "sbud" in cached:
+            sbud = _restore_sbud(cached["sbud"], path, self.contents)
+        outputs = {}
+        for output_format in self.formats:
+            if output_format == "html":
+                outputs[output_format] = html.generate(path, sbud)
+            elif output_format in ("json", "sbud"):
+                outputs[output_format] = sbud
+            else:
+                outputs[output_format] = cached[output_format]
+        return outputs
+
+    def _analyze(
+            self, path: str, ndjson: Optional[IO[str]] = None
+    ) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+        """
+        Returns the outputs of analyzing `path` in each format, along with its SBUD if any format needed it.
+
+        If `ndjson` is not None, the `ndjson` events are written to it as they are produced, and their output is None.
+
+        """
+        if self.isolate_parsers and self._parser_pool is None:
+            self._parser_pool = ParserPool(
+                max_workers=1, timeout=self.parser_timeout, max_memory=self.parser_max_memory
+            )
+        analyzer = Analyzer(
+            path, try_all_offsets=self.try_all_offsets, parse=self.parse, magic_matcher=self.magic_matcher,
+            only_match_mime="file" not in self.formats, quota=Quota(**self.quota_limits),
+            parser_pool=self._parser_pool
+        )
+        outputs: Dict[str, Any] = {}
+        sbud: Optional[Dict[str, Any]] = None
+        for output_format in self.formats:
+            if output_format == "file":
+                lines: List[str] = []
+                for match in analyzer.magic_matches():
+                    line = str(match)
+                    if line not in lines:
+                        lines.append(line)
+                outputs[output_format] = lines
+            elif output_format == "mime":
+                outputs[output_format] = [mimetype for mimetype, _ in analyzer.mime_types()]
+            elif output_format == "explain":
+                outputs[output_format] = "".join(
+                    f"{mimetype}\n{match.explain(ansi_color=False, file=path)}"
+                    for mimetype, match in analyzer.mime_types()
+                )
+            elif output_format == "ndjson":
+                if ndjson is None:
+                    events: List[Dict[str, Any]] = []
+                    for _ in analyzer.stream(events.append):
+                        pass
+                    outputs[output_format] = events
+                else:
+                    for _ in analyzer.stream(lambda event: ndjson.write(f"{json.dumps(event)}\n")):
+                        pass
+                    outputs[output_format] = None
+            else:
+                if sbud is None:
+                    sbud = analyzer.sbud(contents=self.contents)
+                if output_format == "html":
+                    outputs[output_format] = html.generate(path, sbud)
+                else:
+                    outputs[output_format] = sbud
+        return outputs, sbud
+
+    def _output_path(self, batch_input: BatchInput, output_format: str) -> Path:
+        output_path = Path(self.output_dir) / f"{batch_input.name}{OUTPUT_EXTENSIONS[output_format]}"
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        return output_path
+
+    def _save(self, batch_input: BatchInput, outputs: Dict[str, Any]) -> List[str]:
+        """Saves the outputs to `output_dir`; an output of None was already written there while it was produced"""
+        saved = []
+        for output_format, output in outputs.items():
+            output_path = self._output_path(batch_input, output_format)
+            if output is None:
+                saved.append(str(output_path))
+                continue
+            with open(output_path, "w") as f:
+                if output_format in ("file", "mime"):
+                    f.writelines(f"{line}\n" for line in output)
+                elif output_format == "ndjson":
+                    f.writelines(f"{json.dumps(event)}\n" for event in output)
+                elif output_format in ("json", "sbud"):
+                    json.dump(output, f)
+                else:
+                    f.write(output)
+            saved.append(str(output_path))
+        return saved
+
+    def close(self):
+        if self._parser_pool is not None:
+            self._parser_pool.close()
+            self._parser_pool = None
+
+    def _index_options(self) -> Dict[str, Any]:
+        """The options that affect the results recorded in the `index`"""
+        return {
+            "formats": list(self.formats),
+            "output_dir": None if self.output_dir is None else os.path.abspath(self.output_dir),
+            "try_all_offsets": self.try_all_offsets,
+            "parse": self.parse,
+            "custom_magic": self.magic_matcher is not None,
+            "contents": self.contents.name,
+            "quota": self.quota_limits,
+            "parsers": self._parser_options()
+        }
+
+    def run(self, inputs: Iterable[BatchInput]) -> Iterator[Dict[str, Any]]:
+        """Analyzes the inputs, largest first, yielding the result of each file as soon as it is finished"""
+        if self.index is None:
+            yield from self._run(inputs)
+        else:
+            yield from self._run_incremental(inputs)
+
+    def _run_incremental(self, inputs: Iterable[BatchInput]) -> Iterator[Dict[str, Any]]:
+        options_key = self.index.options_key(self._index_options())
+        listed = set()
+        changed: Dict[str, Tuple[BatchInput, FileSignature]] = {}
+        for batch_input in inputs:
+            listed.add(batch_input.path)
+            signature = batch_input.signature
+            if signature is None:
+                try:
+                    signature = file_signature(os.stat(batch_input.path))
+                except OSError:
+                    # the error will be reported when the file is analyzed
+                    signature = (-1, -1, -1, -1)
+            result = self.index.lookup(batch_input.path, signature, options_key)
+            if result is None:
+                changed[batch_input.path] = (batch_input, signature)
+            else:
+                result["unchanged"] = True
+                yield result
+        log.info(f"{len(listed) - len(changed)} files are unchanged since the last run; analyzing {len(changed)}")
+        for result in self._run(batch_input for batch_input, _ in changed.values()):
+            if "error" not in result:
+                recorded = {key: value for key, value in result.items() if key != "cached"}
+                self.index.update(result["path"], changed[result["path"]][1], options_key, recorded)
+            yield result
+        deleted = [path for path in self.index.paths() if path not in listed]
+        self.index.remove(deleted)
+        for path in deleted:
+            yield {"path": path, "deleted": True}
+
+    def _run(self, inputs: Iterable[BatchInput]) -> Iterator[Dict[str, Any]]:
+        inputs = schedule(inputs)
+        if not inputs:
+            return
+        self.preload()
+        with Prefetcher() as prefetcher:
+            for batch_input in inputs[:self.jobs + 1]:
+                prefetcher.prefetch(batch_input.path)
+            if self.jobs == 1 or len(inputs) == 1:
+                try:
+                    for i, batch_input in enumerate(inputs):
+                        if i + 2 < len(inputs):
+                            prefetcher.prefetch(inputs[i + 2].path)
+                        yield self.analyze(batch_input)
+                finally:
+                    self.close()
+            else:
+                yield from self._run_pool(inputs, prefetcher)
+
+    def _run_pool(self, inputs: List[BatchInput], prefetcher: Prefetcher) -> Iterator[Dict[str, Any]]:
+        context = _multiprocessing_context()
+        workers: Dict[Connection, Tuple[Any, Optional[BatchInput]]] = {}
+        next_input = 0
+
+        def dispatch(conn: Connection, process) -> bool:
+            nonlocal next_input
+            if next_input >= len(inputs):
+                workers[conn] = (process, None)
+                return False
+            batch_input = inputs[next_input]
+            next_input += 1
+            # by the time this worker finishes, the file after the next `jobs` files will be needed
+            if next_input + self.jobs < len(inputs):
+                prefetcher.prefetch(inputs[next_input + self.jobs].path)
+            workers[conn] = (process, batch_input)
+            conn.send(batch_input)
+            return True
+
+        def start_worker():
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=_batch_worker_main, args=(self, child_conn), name="polyfile-batch")
+            process.start()
+            child_conn.close()
+            if not dispatch(conn, process):
+                conn.send(None)
+
+        # move everything allocated so far (notably the magic definitions) out of the collector's reach, so that the
+        # workers do not write to the shared pages when they collect garbage, which would copy them
+        gc.freeze()
+        try:
+            for _ in range(min(self.jobs, len(inputs))):
+                start_worker()
+            while any(batch_input is not None for _, batch_input in workers.values()):
+                busy = [conn for conn, (_, batch_input) in workers.items() if batch_input is not None]
+                for conn in wait(busy):
+                    process, batch_input = workers[conn]
+                    try:
+                        result = conn.recv()
+                    except (EOFError, OSError):
+                        # the worker died
+                        process.join()
+                        del workers[conn]
+                        conn.close()
+                        yield {
+                            "path": batch_input.path,
+                            "error": f"the worker analyzing this file died with exit code {process.exitcode}"
+                        }
+                        if next_input < len(inputs):
+                            start_worker()
+                        continue
+                    if not dispatch(conn, process):
+                        conn.send(None)
+                    yield result
+        finally:
+            for conn, (process, _) in workers.items():
+                try:
+                    conn.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+            for conn, (process, _) in workers.items():
+                process.join(timeout=1.0)
+                if process.is_alive():
+                    process.kill()
+                    process.join()
+                conn.close()
+            gc.unfreeze()
+
+    def __enter__(self) -> "BatchAnalyzer":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _batch_worker_main(batch_analyzer: BatchAnalyzer, conn: Connection):
+    try:
+        while True:
+            try:
+                batch_input = conn.recv()
+            except EOFError:
+                break
+            if batch_input is None:
+                break
+            conn.send(batch_analyzer.analyze(batch_input))
+    finally:
+        batch_analyzer.close()
@@ -0,0 +1,295 @@
+"""
+Persistent caches of analysis results: a content-addressed `ResultCache` and a stat-based `CorpusIndex`.
+
+Corpora are often analyzed more than once: files are re-uploaded, pipelines are re-run after a failure, and mirrors
+contain the same files under different names. A `ResultCache` stores the result of each analysis in a SQLite database
+keyed by the SHA-256 of the file's content, PolyFile's version, a fingerprint of the magic definitions (see
+`polyfile.manifest.fingerprint`), and the options of the analysis, so a file whose result is already cached does not
+need to be matched at all.
+
+The database is bounded to `max_size` bytes of (compressed) results by evicting the least recently used ones. Any
+number of processes, such as the workers of a `polyfile.batch.BatchAnalyzer`, may share a cache: readers rely on
+SQLite's own locking, and writers are serialized by a lock file next to the database.
+
+Even a cache hit requires reading and hashing the whole file. A `CorpusIndex` instead records the result of each path
+along with the file's inode, size, modification time, and status change time, so that rescanning a corpus can skip
+the files that have not changed without opening them (see `polyfile.batch.BatchAnalyzer`).
+
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple, Union
+import zlib
+
+from filelock import FileLock
+
+from . import logger
+
+log = logger.getStatusLogger("polyfile")
+
+
+DEFAULT_MAX_CACHE_SIZE: int = 1024 * 1024 * 1024
+"""The default maximum total size of the results stored in a `ResultCache`, in bytes"""
+
+DEFAULT_ACCESS_INTERVAL: float = 60.0
+"""The default age, in seconds, at which a hit updates the recorded last access of a `ResultCache` entry"""
+
+_HASH_CHUNK_SIZE: int = 1024 * 1024
+
+_MAGIC_FINGERPRINT: Optional[str] = None
+
+
+def magic_fingerprint() -> str:
+    """A digest of PolyFile's version and its default magic definitions; computed once per process"""
+    global _MAGIC_FINGERPRINT
+    if _MAGIC_FINGERPRINT is None:
+        from .manifest import fingerprint
+        from .polyfile import __version__
+        # the manifest's fingerprint only covers the definitions, but the parsers also change between versions
+        _MAGIC_FINGERPRINT = hashlib.sha256(f"{__version__}:{fingerprint()}".encode("utf-8")).hexdigest()
+    return _MAGIC_FINGERPRINT
+
+
+def content_sha256(path: Union[str, Path]) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(_HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class _Database:
+    """
+    A SQLite database shared by any number of processes.
+
+    Each process opens its own connection the first time that it uses the database, so a database object can be sent
+    to (or inherited by) worker processes. Writes must be made while holding `_file_lock`.
+
+    """
+    SCHEMA: Tuple[str, ...] = ()
+
+    def __init__(self, path: Union[str, Path]):
+        self.path: Path = Path(path)
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+        self._lock: threading.Lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_connection"] = None
+        state["_pid"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def _file_lock(self) -> FileLock:
+        return FileLock(str(self.path) + ".lock")
+
+    def _db(self) -> sqlite3.Connection:
+        if self._connection is None or self._pid != os.getpid():
+            # a connection inherited from a parent process must not be used after a fork
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.path), timeout=60.0, check_same_thread=False)
+            with self._file_lock:
+                connection.execute("PRAGMA journal_mode=WAL")
+                for statement in self.SCHEMA:
+                    connection.execute(statement)
+                connection.commit()
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+            self._pid = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ResultCache(_Database):
+    """
+    A size-bounded, least recently used cache of JSON-serializable analysis results.
+
+    Recording the access of every hit would make every reader take the writers' lock file and commit, so a hit only
+    updates the recorded last access of an entry if it is at least `access_interval` seconds old; entries that were
+    used within `access_interval` seconds of each other may therefore be evicted in either order.
+
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS results ("
+        "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)"
+    )
+
+    def __init__(
+            self,
+            path: Union[str, Path],
+            max_size: int = DEFAULT_MAX_CACHE_SIZE,
+            access_interval: float = DEFAULT_ACCESS_INTERVAL
+    ):
+        super().__init__(path)
+        self.max_size: int = max_size
+        self.access_interval: float = access_interval
+
+    @staticmethod
+    def key(sha256: str, options: Dict[str, Any]) -> str:
+        """The key of the result of analyzing content with the given SHA-256 digest with the given options"""
+        return hashlib.sha256(json.dumps({
+            "content": sha256,
+            "magic": magic_fingerprint(),
+            "options": options
+        }, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT value, last_access FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if now - row[1] >= self.access_interval:
+                with self._file_lock:
+                    db.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+                    db.commit()
+        try:
+            return json.loads(zlib.decompress(row[0]))
+        except (ValueError, zlib.error) as e:
+            log.warning(f"Ignoring the corrupt cache entry {key} in {self.path!s}: {e!s}")
+            return None
+
+    def put(self, key: str, value: Any):
+        data = zlib.compress(json.dumps(value).encode("utf-8"))
+        if len(data) > self.max_size:
+            log.debug(f"Not caching a result of {len(data)} bytes, which is larger than the cache")
+            return
+        with self._lock:
+            db = self._db()
+            with self._file_lock:
+                db.execute(
+                    "INSERT OR REPLACE INTO results (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                    (key, data, len(data), time.time())
+                )
+                self._evict(db)
+                db.commit()
+
+    def _evict(self, db: sqlite3.Connection):
+        """Deletes the least recently used results until the total size is at most `max_size`"""
+        excess = db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0] - self.max_size
+        if excess <= 0:
+            return
+        evicted = []
+        for key, size in db.execute("SELECT key, size FROM results ORDER BY last_access"):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        db.executemany("DELETE FROM results WHERE key = ?", evicted)
+        log.debug(f"Evicted {len(evicted)} results from the cache in {self.path!s}")
+
+    @property
+    def size(self) -> int:
+        """The total size of the stored results, in bytes"""
+        with self._lock:
+            return self._db().execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._db().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return self._db().execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone() is not None
+
+
+DEFAULT_INDEX_NAME: str = "polyfile-index.sqlite3"
+"""The name of the `CorpusIndex` that `polyfile --batch --incremental` keeps in its output directory by default"""
+
+FileSignature = Tuple[int, int, int, int]
+"""(inode, size, modification time, status change time), the latter two in nanoseconds"""
+
+
+def file_signature(st: os.stat_result) -> FileSignature:
+    return st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns
+
+
+class CorpusIndex(_Database):
+    """
+    The results of the files in a corpus, keyed by path, along with each file's signature when it was analyzed.
+
+    A stored result is only returned for a file whose `FileSignature` and analysis options are unchanged.
+
+    """
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS files ("
+        "path TEXT PRIMARY KEY, inode INTEGER NOT NULL, size INTEGER NOT NULL, mtime INTEGER NOT NULL, "
+        "ctime INTEGER NOT NULL, options TEXT NOT NULL, result BLOB NOT NULL)",
+    )
+
+    @staticmethod
+    def options_key(options: Dict[str, Any]) -> str:
+        return hashlib.sha256(json.dumps({
+            "magic": magic_fingerprint(),
+            "options": options
+        }, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def lookup(self, path: str, signature: FileSignature, options_key: str) -> Optional[Dict[str, Any]]:
+        """Returns the stored result of `path` if neither the file nor the options have changed since"""
+        with self._lock:
+            row = self._db().execute(
+                "SELECT inode, size, mtime, ctime, options, result FROM files WHERE path = ?", (path,)
+            ).fetchone()
+        if row is None or tuple(row[:4]) != tuple(signature) or row[4] != options_key:
+            return None
+        try:
+            return json.loads(zlib.decompress(row[5]))
+        except (ValueError, zlib.error) as e:
+            log.warning(f"Ignoring the corrupt index entry for {path!r} in {self.path!s}: {e!s}")
+            return None
+
+    def update(self, path: str, signature: FileSignature, options_key: str, result: Dict[str, Any]):
+        data = zlib.compress(json.dumps(result).encode("utf-8"))
+        with self._lock:
+            db = self._db()
+            with self._file_lock:
+                db.execute(
+                    "INSERT OR REPLACE INTO files (path, inode, size, mtime, ctime, options, result) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", (path, *signature, options_key, data)
+                )
+                db.commit()
+
+    def remove(self, paths: Iterable[str]):
+        with self._lock:
+            db = self._db()
+            with self._file_lock:
+                db.executemany("DELETE FROM files WHERE path = ?", ((path,) for path in paths))
+                db.commit()
+
+    def paths(self) -> Iterator[str]:
+        with self._lock:
+            rows = self._db().execute("SELECT path FROM files ORDER BY path").fetchall()
+        return (row[0] for row in rows)
+
+    def __len__(self):
+        with self._lock:
+            return self._db().execute("SELECT COUNT(*) FROM files").fetchone()[0]
@@ -0,0 +1,425 @@
+"""
+A compact, columnar alternative to the SBUD format.
+
+The SBUD format nests the dict of every match inside its parent's `subEls`, repeating the same keys, type names, and
+values for every node, so large match trees are slow to produce and slow to load. The columnar format instead stores
+the tree as parallel arrays with one entry per match, in pre-order, so a match's index is its id:
+
+    parent .......... the index of the match's parent, or -1 for a top-level match
+    relative_offset . the offset of the match relative to its parent
+    offset .......... the offset of the match within the file
+    size ............ the length of the match
+    type ............ the match's type (`Match.name`), as an index into the string table
+    name ............ the match's display name, as an index into the string table
+    value ........... the match's value, as an index into the value table
+    extension ....... the match's extension, as an index into the string table, or -1 if it has none
+    embedded ........ whether the match is an embedded file (a `Match`) or a subregion of its parent (a `Submatch`)
+
+The rarely used image data and decoded contents of a match are stored separately, keyed by index. The remaining fields
+of the SBUD (the file's digests, name, length, contents, and so on) are stored in a JSON header.
+
+A file in this format is written in a single pass over the matches by `dump` and loaded by `ColumnarSBUD.load`, which
+can answer queries about the tree directly from the arrays, convert it back to an SBUD (e.g., to render it with
+`polyfile.html.generate`), or rebuild the `Match` objects without re-running the analysis.
+
+"""
+
+from array import array
+import base64
+import json
+from pathlib import Path
+import struct
+import sys
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from . import html
+from .polyfile import Analyzer, ContentsMode, Match, Matcher, Submatch
+
+MAGIC: bytes = b"PFCOL"
+FORMAT_VERSION: int = 1
+
+COLUMNS: Tuple[Tuple[str, str], ...] = (
+    ("parent", "q"),
+    ("relative_offset", "q"),
+    ("offset", "q"),
+    ("size", "q"),
+    ("type", "i"),
+    ("name", "i"),
+    ("value", "i"),
+    ("extension", "i"),
+    ("embedded", "b")
+)
+"""The name and `array` type code of each column, in the order that they are stored"""
+
+_SECTION_LENGTH = struct.Struct("<Q")
+
+
+class ColumnarFormatError(ValueError):
+    pass
+
+
+def _write_section(stream: BinaryIO, data: Union[bytes, memoryview]):
+    stream.write(_SECTION_LENGTH.pack(len(data)))
+    stream.write(data)
+
+
+def _write_json(stream: BinaryIO, obj: Any):
+    _write_section(stream, json.dumps(obj).encode("utf-8"))
+
+
+class ColumnarWriter:
+    """Accumulates match trees into columns, interning their strings"""
+
+    def __init__(self):
+        self.columns: Dict[str, array] = {name: array(typecode) for name, typecode in COLUMNS}
+        self.strings: List[str] = []
+        self.values: List[str] = []
+        self.extras: Dict[str, Dict[str, str]] = {}
+        self._string_ids: Dict[str, int] = {}
+        self._value_ids: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.columns["parent"])
+
+    def _string(self, string: str) -> int:
+        string_id = self._string_ids.get(string)
+        if string_id is None:
+            string_id = len(self.strings)
+            self._string_ids[string] = string_id
+            self.strings.append(string)
+        return string_id
+
+    def _value(self, value: str) -> int:
+        value_id = self._value_ids.get(value)
+        if value_id is None:
+            value_id = len(self.values)
+            self._value_ids[value] = value_id
+            self.values.append(value)
+        return value_id
+
+    def add_tree(self, root: Match):
+        """Adds `root` and all of its descendants, in pre-order"""
+        columns = self.columns
+        parents, relative_offsets, offsets, sizes = (
+            columns["parent"], columns["relative_offset"], columns["offset"], columns["size"]
+        )
+        types, names, values, extensions, embedded = (
+            columns["type"], columns["name"], columns["value"], columns["extension"], columns["embedded"]
+        )
+        stack: List[Tuple[Match, int]] = [(root, -1)]
+        while stack:
+            match, parent_index = stack.pop()
+            index = len(parents)
+            parents.append(parent_index)
+            relative_offsets.append(match.relative_offset)
+            offsets.append(match.offset)
+            sizes.append(match.length)
+            types.append(self._string(match.name))
+            names.append(self._string(match.display_name))
+            values.append(self._value(str(match.match)))
+            extension = match.extension
+            if extension is None:
+                extensions.append(-1)
+            else:
+                extensions.append(self._string(extension))
+            embedded.append(not isinstance(match, Submatch))
+            if match.img_data is not None or match.decoded is not None:
+                extra: Dict[str, str] = {}
+                if match.img_data is not None:
+                    extra["img_data"] = match.img_data
+                if match.decoded is not None:
+                    extra["decoded"] = base64.b64encode(match.decoded).decode("utf-8")
+                self.extras[str(index)] = extra
+            stack.extend((child, index) for child in reversed(match.children))
+
+    def write(self, stream: BinaryIO, header: Dict[str, Any]):
+        """Writes the columns to `stream`, along with the SBUD fields in `header`"""
+        stream.write(MAGIC)
+        stream.write(bytes((FORMAT_VERSION,)))
+        _write_json(stream, header)
+        for name, typecode in COLUMNS:
+            column = self.columns[name]
+            if sys.byteorder != "little":
+                column = array(typecode, column)
+                column.byteswap()
+            _write_section(stream, column.tobytes())
+        _write_json(stream, self.strings)
+        _write_json(stream, self.values)
+        _write_json(stream, self.extras)
+
+
+def dump(
+        analyzer: Analyzer,
+        stream: BinaryIO,
+        matches: Optional[Iterable[Match]] = None,
+        contents: ContentsMode = ContentsMode.EMBED,
+        metadata: Optional[Dict[str, Any]] = None
+):
+    """The columnar equivalent of `Analyzer.sbud`, written to `stream`, with any `metadata` added to its header"""
+    if matches is None:
+        matches = analyzer.matches()
+    writer = ColumnarWriter()
+    for match in matches:
+        writer.add_tree(match)
+    header = analyzer.sbud(matches=(), contents=contents)
+    del header["struc"]
+    if metadata is not None:
+        header.update(metadata)
+    writer.write(stream, header)
+
+
+class ColumnarSBUD:
+    """A match tree loaded from the columnar format"""
+
+    def __init__(
+            self,
+            header: Dict[str, Any],
+            columns: Dict[str, array],
+            strings: List[str],
+            values: Union[List[str], bytes],
+            extras: Dict[str, Dict[str, str]]
+    ):
+        self.header: Dict[str, Any] = header
+        """The fields of the SBUD other than its matches"""
+        self.columns: Dict[str, array] = columns
+        self.strings: List[str] = strings
+        self._values: Union[List[str], bytes] = values
+        self.extras: Dict[str, Dict[str, str]] = extras
+        self._ends: Optional[array] = None
+
+    @staticmethod
+    def loads(data: Union[bytes, bytearray, memoryview]) -> "ColumnarSBUD":
+        data = memoryview(data)
+        if bytes(data[:len(MAGIC)]) != MAGIC:
+            raise ColumnarFormatError("Not a columnar PolyFile output")
+        version = data[len(MAGIC)] if len(data) > len(MAGIC) else None
+        if version != FORMAT_VERSION:
+            raise ColumnarFormatError(f"Unsupported columnar format version {version!r}")
+        position = len(MAGIC) + 1
+
+        def section() -> memoryview:
+            nonlocal position
+            if position + _SECTION_LENGTH.size > len(data):
+                raise ColumnarFormatError("Truncated columnar output")
+            length, = _SECTION_LENGTH.unpack_from(data, position)
+            position += _SECTION_LENGTH.size
+            if position + length > len(data):
+                raise ColumnarFormatError("Truncated columnar output")
+            ret = data[position:position + length]
+            position += length
+            return ret
+
+        header = json.loads(bytes(section()))
+        columns: Dict[str, array] = {}
+        for name, typecode in COLUMNS:
+            column = array(typecode)
+            column.frombytes(section())
+            if sys.byteorder != "little":
+                column.byteswap()
+            columns[name] = column
+        if len({len(column) for column in columns.values()}) > 1:
+            raise ColumnarFormatError("The columns have different lengths")
+        strings = json.loads(bytes(section()))
+        # the values are by far the largest part of the output, so only decode them if they are needed
+        values = bytes(section())
+        extras = json.loads(bytes(section()))
+        return ColumnarSBUD(header=header, columns=columns, strings=strings, values=values, extras=extras)
+
+    @staticmethod
+    def load(path_or_stream: Union[str, Path, BinaryIO]) -> "ColumnarSBUD":
+        if isinstance(path_or_stream, (str, Path)):
+            with open(path_or_stream, "rb") as f:
+                return ColumnarSBUD.loads(f.read())
+        return ColumnarSBUD.loads(path_or_stream.read())
+
+    def __len__(self):
+        return len(self.columns["parent"])
+
+    @property
+    def values(self) -> List[str]:
+        if isinstance(self._values, bytes):
+            self._values = json.loads(self._values)
+        return self._values
+
+    @property
+    def roots(self) -> Iterator[int]:
+        """The indices of the top-level matches"""
+        return self.children(-1)
+
+    @property
+    def ends(self) -> array:
+        """For each match, one past the index of its last descendant"""
+        if self._ends is None:
+            parents = self.columns["parent"]
+            ends = array("q", range(1, len(parents) + 1))
+            # in pre-order, a subtree ends where its last child's subtree ends
+            for index in range(len(parents) - 1, -1, -1):
+                parent = parents[index]
+                if parent >= 0 and ends[index] > ends[parent]:
+                    ends[parent] = ends[index]
+            self._ends = ends
+        return self._ends
+
+    def children(self, index: int) -> Iterator[int]:
+        """The indices of the children of the match at `index`, or of the top-level matches if `index` is -1"""
+        ends = self.ends
+        if index < 0:
+            child, end = 0, len(self)
+        else:
+            child, end = index + 1, ends[index]
+        while child < end:
+            yield child
+            child = ends[child]
+
+    def parent(self, index: int) -> Optional[int]:
+        parent = self.columns["parent"][index]
+        if parent < 0:
+            return None
+        return parent
+
+    def type(self, index: int) -> str:
+        return self.strings[self.columns["type"][index]]
+
+    def name(self, index: int) -> str:
+        return self.strings[self.columns["name"][index]]
+
+    def value(self, index: int) -> str:
+        return self.values[self.columns["value"][index]]
+
+    def extension(self, index: int) -> Optional[str]:
+        extension = self.columns["extension"][index]
+        if extension < 0:
+            return None
+        return self.strings[extension]
+
+    def offset(self, index: int) -> int:
+        return self.columns["offset"][index]
+
+    def size(self, index: int) -> int:
+        return self.columns["size"][index]
+
+    def find(self, match_type: str) -> Iterator[int]:
+        """The indices of the matches of the given type"""
+        try:
+            type_id = self.strings.index(match_type)
+        except ValueError:
+            return
+        for index, t in enumerate(self.columns["type"]):
+            if t == type_id:
+                yield index
+
+    def at(self, offset: int) -> Iterator[int]:
+        """The indices of the matches that contain the byte at `offset`"""
+        for index, (start, size) in enumerate(zip(self.columns["offset"], self.columns["size"])):
+            if start <= offset < start + size:
+                yield index
+
+    def to_obj(self, index: int) -> Dict[str, Any]:
+        """The equivalent of `Match.to_obj` for the match at `index`"""
+        columns = self.columns
+        ret = {
+            "relative_offset": columns["relative_offset"][index],
+            "offset": columns["offset"][index],
+            "size": columns["size"][index],
+            "type": self.type(index),
+            "name": self.name(index),
+            "value": self.value(index),
+            "subEls": [self.to_obj(child) for child in self.children(index)]
+        }
+        ret.update(self.extras.get(str(index), ()))
+        extension = self.extension(index)
+        if extension is not None:
+            ret["extension"] = extension
+        return ret
+
+    def to_sbud(self) -> Dict[str, Any]:
+        """The SBUD that this was converted from, as returned by `Analyzer.sbud`"""
+        sbud = {key: value for key, value in self.header.items() if key not in ("limitsReached", "snapshot")}
+        sbud["struc"] = [self.to_obj(root) for root in self.roots]
+        if "limitsReached" in self.header:
+            sbud["limitsReached"] = self.header["limitsReached"]
+        return sbud
+
+    def matches(self, matcher: Optional[Matcher] = None) -> Iterator[Match]:
+        """
+        Rebuilds the top-level matches, one tree at a time, with their values as strings.
+
+        The matches are counted against `matcher`'s quota; by default, a matcher that does not parse is used.
+
+        """
+        if matcher is None:
+            matcher = Matcher(parse=False)
+        columns = self.columns
+        ends = self.ends
+        for root in self.roots:
+            rebuilt: Dict[int, Match] = {}
+            for index in range(root, ends[root]):
+                extra = self.extras.get(str(index), {})
+                decoded: Optional[bytes] = None
+                if "decoded" in extra:
+                    decoded = base64.b64decode(extra["decoded"])
+                if columns["embedded"][index]:
+                    match_type = Match
+                else:
+                    match_type = Submatch
+                parent = columns["parent"][index]
+                rebuilt[index] = match_type(
+                    self.type(index), self.value(index), columns["relative_offset"][index],
+                    length=columns["size"][index], parent=rebuilt.get(parent), matcher=matcher,
+                    display_name=self.name(index), img_data=extra.get("img_data"), decoded=decoded,
+                    extension=self.extension(index)
+                )
+            yield rebuilt[root]
+
+    def contents(self) -> Optional[bytes]:
+        """The contents of the analyzed file, if they were embedded or the referenced file still exists"""
+        if "b64contents" in self.header:
+            return base64.b64decode(self.header["b64contents"])
+        elif "contentsPath" in self.header:
+            try:
+                return Path(self.header["contentsPath"]).read_bytes()
+            except OSError:
+                return None
+        return None
+
+
+def main(argv: List[str]) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="converts the columnar output of PolyFile to another format")
+    parser.add_argument("INPUT", type=Path, help="the columnar output to convert")
+    parser.add_argument("--format", "-r", choices=("json", "html"), default="json",
+                        help="the output format (default: %(default)s)")
+    parser.add_argument("--file", "-f", type=Path, default=None,
+                        help="the analyzed file, for HTML output of an analysis whose contents were omitted")
+    parser.add_argument("--output", "-o", type=str, default="-", help="where to save the output (default: STDOUT)")
+
+    args = parser.parse_args(argv[1:])
+
+    try:
+        loaded = ColumnarSBUD.load(args.INPUT)
+    except (OSError, ColumnarFormatError) as e:
+        sys.stderr.write(f"Error loading {args.INPUT!s}: {e!s}\n")
+        return 1
+    sbud = loaded.to_sbud()
+    if args.format == "json":
+        output = json.dumps(sbud)
+    else:
+        if args.file is not None:
+            file_path: Union[Path, bytes, None] = args.file
+        else:
+            file_path = loaded.contents()
+        if file_path is None:
+            sys.stderr.write("The contents of the analyzed file were omitted; provide the file with `--file`\n")
+            return 1
+        output = html.generate(file_path, sbud)
+    if args.output == "-":
+        sys.stdout.write(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
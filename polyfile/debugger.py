@@ -446,7 +446,7 @@ class Debugger(REPL):
                 # this class actually implements the test() function
                 self.instrumented_tests.append(InstrumentedTest(test, self))
         if self.break_on_submatching.value:
-            for parsers in PARSERS.values():
+            for parsers in list(PARSERS.values()):
                 for parser in parsers:
                     self.instrumented_parsers.append(InstrumentedParser(parser, self))
 
@@ -1,14 +1,28 @@
-from io import BytesIO, SEEK_END, UnsupportedOperation
+from io import BytesIO, UnsupportedOperation
 import mmap
 import os
 from pathlib import Path
 import tempfile as tf
 import shutil
+import stat
 import sys
-from typing import AnyStr, ContextManager, IO, Iterator, Iterable, List, Optional, TextIO, Union
+import threading
+from typing import AnyStr, ContextManager, Dict, IO, Iterator, Iterable, List, Optional, TextIO, Tuple, Union
 
 
-Streamable = Union[str, Path, IO, "FileStream", bytes]
+Streamable = Union[str, Path, IO, "FileStream", bytes, bytearray, memoryview, mmap.mmap]
+
+
+def _as_bytes(data: Union[bytes, bytearray, memoryview, mmap.mmap]) -> Union[bytes, mmap.mmap]:
+    """Returns `data` as bytes (or a memory map), copying it only if it is mutable or a partial view"""
+    if isinstance(data, memoryview):
+        if isinstance(data.obj, bytes) and data.contiguous and data.nbytes == len(data.obj):
+            # a view of an entire bytes object does not need to be copied
+            return data.obj
+        return data.tobytes()
+    elif isinstance(data, bytearray):
+        return bytes(data)
+    return data
 
 
 def make_stream(path_or_stream: Streamable, mode: str = 'rb',
@@ -59,6 +73,120 @@ class ExactNamedTempfile(Tempfile):
             self._path = None
 
 
+DEFAULT_SPOOL_THRESHOLD: int = 64 * 1024 * 1024
+"""Streamed input larger than this is spilled to disk rather than kept in memory"""
+
+SPOOL_CHUNK_SIZE: int = 1024 * 1024
+
+
+class SpooledInput:
+    """
+    Input that has no path, such as bytes, a stream, or a pipe like STDIN, buffered so that it can be analyzed.
+
+    Bytes-like inputs are used as they are. A regular file that is already open is memory-mapped. Any other stream,
+    including a non-seekable pipe, is read once in chunks of `SPOOL_CHUNK_SIZE` bytes and kept in memory, unless it
+    grows larger than `max_memory` bytes, in which case it is spilled to an anonymous temporary file that is then
+    memory-mapped.
+
+    `data` is the entire content, as bytes or as a memory map, and `stream` is what to hand to a `FileStream`. The
+    content is read on first access.
+
+    """
+    def __init__(self, source: Union[bytes, bytearray, memoryview, IO[bytes]], max_memory: int = DEFAULT_SPOOL_THRESHOLD):
+        self.source: Union[bytes, bytearray, memoryview, IO[bytes]] = source
+        self.max_memory: int = max_memory
+        self._data: Optional[Union[bytes, mmap.mmap]] = None
+        self._stream: Optional[Union[bytes, IO[bytes]]] = None
+        self._spill_file: Optional[IO[bytes]] = None
+
+    @staticmethod
+    def _is_regular_file(stream: IO[bytes]) -> bool:
+        try:
+            return stream.seekable() and stat.S_ISREG(os.fstat(stream.fileno()).st_mode)
+        except (AttributeError, OSError, UnsupportedOperation, ValueError):
+            return False
+
+    def _load(self):
+        source = self.source
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = _as_bytes(source)
+            self._data = source
+            self._stream = source
+            return
+        if isinstance(source, BytesIO):
+            # getvalue() does not copy an unmodified buffer
+            self._data = source.getvalue()
+            self._stream = self._data
+            return
+        if self._is_regular_file(source):
+            source.seek(0)
+            self._stream = source
+            size = os.fstat(source.fileno()).st_size
+            if size == 0:
+                self._data = b""
+            else:
+                self._data = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+            return
+        chunks: List[bytes] = []
+        size = 0
+        while True:
+            chunk = source.read(SPOOL_CHUNK_SIZE)
+            if not chunk:
+                break
+            if self._spill_file is not None:
+                self._spill_file.write(chunk)
+                continue
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > self.max_memory:
+                self._spill_file = tf.TemporaryFile()
+                self._spill_file.writelines(chunks)
+                del chunks[:]
+        if self._spill_file is None:
+            self._data = b"".join(chunks)
+            self._stream = self._data
+        else:
+            self._spill_file.flush()
+            self._spill_file.seek(0)
+            self._data = mmap.mmap(self._spill_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._stream = self._spill_file
+
+    @property
+    def data(self) -> Union[bytes, mmap.mmap]:
+        if self._data is None:
+            self._load()
+        return self._data
+
+    @property
+    def stream(self) -> Union[bytes, IO[bytes]]:
+        if self._stream is None:
+            self._load()
+        return self._stream
+
+    @property
+    def spilled(self) -> bool:
+        """Whether the content was spilled to a temporary file"""
+        return self._spill_file is not None
+
+    def __len__(self):
+        return len(self.data)
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data = None
+        self._stream = None
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def __enter__(self) -> "SpooledInput":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 class PathOrStdin:
     def __init__(self, path: str):
         self.path: str = path
@@ -101,7 +229,82 @@ class PathOrStdout(ContextManager[TextIO]):
         return None
 
 
+class _MappedFile:
+    """
+    A read-only memory map of a file that is shared by every `FileStream` of that file.
+
+    Mappings are cached by the file's device, inode, size, and modification time, so a file that is modified while
+    it is being analyzed gets a new mapping rather than one that changes underneath its readers. Empty files, which
+    cannot be memory-mapped, and files that are not regular files (e.g., named pipes) are read into memory instead.
+
+    """
+    _CACHE: Dict[Tuple[int, int, int, int], "_MappedFile"] = {}
+    _LOCK: threading.Lock = threading.Lock()
+
+    def __init__(self, key: Tuple[int, int, int, int], file: IO[bytes], data: Union[bytes, mmap.mmap]):
+        self.key: Tuple[int, int, int, int] = key
+        self.file: IO[bytes] = file
+        self.data: Union[bytes, mmap.mmap] = data
+        self.references: int = 0
+
+    @staticmethod
+    def acquire(path: str) -> "_MappedFile":
+        file = open(path, "rb")
+        try:
+            st = os.fstat(file.fileno())
+            key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+            with _MappedFile._LOCK:
+                mapped = _MappedFile._CACHE.get(key)
+                if mapped is not None:
+                    mapped.references += 1
+                    file.close()
+                    return mapped
+                if not stat.S_ISREG(st.st_mode):
+                    data: Union[bytes, mmap.mmap] = file.read()
+                elif st.st_size == 0:
+                    data = b""
+                else:
+                    data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                mapped = _MappedFile(key, file, data)
+                mapped.references = 1
+                if stat.S_ISREG(st.st_mode):
+                    _MappedFile._CACHE[key] = mapped
+                return mapped
+        except BaseException:
+            file.close()
+            raise
+
+    def release(self):
+        with _MappedFile._LOCK:
+            self.references -= 1
+            if self.references > 0:
+                return
+            if _MappedFile._CACHE.get(self.key) is self:
+                del _MappedFile._CACHE[self.key]
+        _close_data(self.data)
+        self.file.close()
+
+
+def _close_data(data: Union[bytes, mmap.mmap]):
+    if isinstance(data, mmap.mmap):
+        try:
+            data.close()
+        except BufferError:
+            # a memoryview of the mapping (e.g., from `FileStream.content`) is still alive; the mapping will be
+            # unmapped once it is garbage collected
+            pass
+
+
 class FileStream(IO):
+    """
+    A read-only, seekable window into a file or bytes.
+
+    The content is accessed through a single read-only memory map that is shared by every `FileStream` of the same
+    file (or directly, for bytes), so slicing a `FileStream` returns an O(1) view of the same data rather than a copy.
+    Each view tracks its own position, so reading from one view never moves another. `content` is a `memoryview` of
+    the view's window, which parsers can index, slice, and search without copying.
+
+    """
     def __init__(
             self,
             path_or_stream: Streamable,
@@ -110,47 +313,61 @@ class FileStream(IO):
             mode: str = "rb",
             close_on_exit: Optional[bool] = None
     ):
+        self._parent: Optional[FileStream] = None
+        self._stream: Optional[IO] = None
+        self._mapped: Optional[_MappedFile] = None
+        self._private_mmap: Optional[mmap.mmap] = None
         if isinstance(path_or_stream, Path):
             path_or_stream = str(path_or_stream)
-        if isinstance(path_or_stream, str):
-            self._stream: IO = open(path_or_stream, mode)
-            if close_on_exit is None:
-                close_on_exit = True
+        if isinstance(path_or_stream, FileStream):
+            self._parent = path_or_stream
+            self._data: Union[bytes, mmap.mmap] = path_or_stream._data
+            self._name = path_or_stream.name
+            parent_offset = path_or_stream._offset
+            parent_length = len(path_or_stream)
         else:
-            if isinstance(path_or_stream, bytes):
-                path_or_stream = BytesIO(path_or_stream)
-                setattr(path_or_stream, "name", "bytes")
+            if isinstance(path_or_stream, str):
+                self._mapped = _MappedFile.acquire(path_or_stream)
+                self._data = self._mapped.data
+                self._name = path_or_stream
+                if close_on_exit is None:
+                    close_on_exit = True
+            elif isinstance(path_or_stream, (bytes, bytearray, memoryview, mmap.mmap)):
+                self._data = _as_bytes(path_or_stream)
+                self._name = "bytes"
+            elif isinstance(path_or_stream, BytesIO):
+                # getvalue() does not copy an unmodified buffer
+                self._data = path_or_stream.getvalue()
+                self._stream = path_or_stream
+                self._name = getattr(path_or_stream, "name", "bytes")
             elif not path_or_stream.seekable():
                 raise ValueError('FileStream can only wrap streams that are seekable')
             elif not path_or_stream.readable():
                 raise ValueError('FileStream can only wrap streams that are readable')
-            self._stream = path_or_stream
-        if isinstance(path_or_stream, FileStream):
-            if length is None:
-                self._length = len(path_or_stream) - start
             else:
-                self._length = min(length, len(path_or_stream))
+                self._stream = path_or_stream
+                self._name = getattr(path_or_stream, "name", None)
+                if SpooledInput._is_regular_file(path_or_stream) and os.fstat(path_or_stream.fileno()).st_size > 0:
+                    self._private_mmap = mmap.mmap(path_or_stream.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._data = self._private_mmap
+                else:
+                    path_or_stream.seek(0)
+                    self._data = path_or_stream.read()
+            parent_offset = 0
+            parent_length = len(self._data)
+        start = min(max(start, 0), parent_length)
+        if length is None:
+            self._length: int = parent_length - start
         else:
-            if isinstance(path_or_stream, BytesIO):
-                orig_pos = path_or_stream.tell()
-                path_or_stream.seek(0, SEEK_END)
-                try:
-                    filesize = path_or_stream.tell()
-                finally:
-                    path_or_stream.seek(orig_pos)
-            else:
-                filesize = os.path.getsize(self._stream.name)
-            if length is None:
-                self._length = filesize - start
-            else:
-                self._length = min(filesize, length) - start
+            self._length = max(min(length, parent_length - start), 0)
+        self._offset: int = parent_offset + start
+        """The offset of this view's first byte in the root stream"""
+        self._pos: int = 0
         if close_on_exit is None:
             close_on_exit = False
-        self._name = self._stream.name
         self.start = start
         self.close_on_exit = close_on_exit
         self._entries = 0
-        self._root = None
 
     def __len__(self):
         return self._length
@@ -169,91 +386,90 @@ class FileStream(IO):
         return self._name
 
     @property
-    def root(self):
-        if self._root is None:
-            if isinstance(self._stream, FileStream):
-                self._root = self._stream.root
-            else:
-                self._root = self._stream
-        return self._root
+    def root(self) -> "FileStream":
+        if self._parent is None:
+            return self
+        return self._parent.root
 
     def save_pos(self):
         f = self
 
         class SP:
             def __init__(self):
-                self.pos = f.root.tell()
+                self.pos = f._pos
 
             def __enter__(self, *args, **kwargs) -> FileStream:
                 return f
 
             def __exit__(self, *args, **kwargs):
-                f.root.seek(self.pos)
+                f._pos = self.pos
 
         return SP()
 
     def fileno(self):
-        return self._stream.fileno()
+        if self._parent is not None:
+            return self._parent.fileno()
+        elif self._mapped is not None:
+            return self._mapped.file.fileno()
+        elif self._stream is not None:
+            return self._stream.fileno()
+        raise UnsupportedOperation(f"{self.name} is not backed by a file")
 
     def offset(self):
-        if isinstance(self._stream, FileStream):
-            return self._stream.offset() + self.start
-        else:
-            return self.start
+        return self._offset
 
     def seek(self, offset, from_what=0):
+        # offsets are often int subclasses (e.g., struct fields), which should not leak out of `tell`
+        offset = int(offset)
         if from_what == 1:
-            offset = self.tell() + offset
+            offset = self._pos + offset
         elif from_what == 2:
             offset = len(self) + offset
-        if offset - self.start > self._length:
+        if offset < 0 or offset > self._length:
             raise IndexError(f"{self!r} is {len(self)} bytes long, but seek was requested for byte {offset}")
-        self._stream.seek(self.start + offset)
+        self._pos = offset
+        return offset
 
     def tell(self):
-        return min(max(self._stream.tell() - self.start, 0), self._length)
+        return self._pos
 
     def read(self, n=None) -> bytes:
-        if self._stream.tell() - self.start < 0:
-            # another context moved the position, so move it back to our zero index:
-            self.seek(0)
-            pos = 0
+        pos = self._pos
+        if n is None or n < 0:
+            end = self._length
         else:
-            pos = self.tell()
-        ls = len(self)
-        if pos >= ls:
+            end = min(pos + n, self._length)
+        if pos >= end:
             return b''
-        elif n is None:
-            return self._stream.read()[:ls - pos]
-        else:
-            return self._stream.read(min(n, ls - pos))
+        self._pos = end
+        return self._data[self._offset + pos:self._offset + end]
+
+    def _find_all(self, *byte_sequences: bytes) -> Iterator[int]:
+        """Yields the offset of each byte sequence relative to the root stream, or -1 if it does not occur"""
+        start_offset = self._offset
+        end_offset = start_offset + len(self)
+        for byte_sequence in byte_sequences:
+            yield self._data.find(byte_sequence, start_offset, end_offset)
 
     def contains_all(self, *args):
-        if args:
-            with mmap.mmap(self.fileno(), 0, access=mmap.ACCESS_READ) as filecontent:
-                for string in args:
-                    if filecontent.find(string, self.offset(), self.offset() + len(self)) < 0:
-                        return False
-        return True
+        return all(index >= 0 for index in self._find_all(*args))
 
     def first_index_of(self, byte_sequence: bytes) -> int:
-        with mmap.mmap(self.fileno(), 0, access=mmap.ACCESS_READ) as filecontent:
-            start_offset = self.offset()
-            end_offset = start_offset + len(self)
-            index = filecontent.find(byte_sequence, start_offset, end_offset)
-            if start_offset <= index < end_offset:
-                return index - start_offset
-            else:
-                return -1
+        index = next(self._find_all(byte_sequence))
+        if index >= 0:
+            return index - self._offset
+        else:
+            return -1
 
     @property
-    def content(self) -> bytes:
-        with self.save_pos():
-            self.seek(0)
-            return self.read(len(self))
+    def content(self) -> memoryview:
+        """A read-only view of this stream's bytes that does not copy them"""
+        return memoryview(self._data)[self._offset:self._offset + self._length]
 
     def __bytes__(self):
-        return self.content
+        if isinstance(self._data, bytes) and self._offset == 0 and self._length == len(self._data):
+            return self._data
+        return self._data[self._offset:self._offset + self._length]
 
     def tempfile(self, prefix=None, suffix=None):
         class FSTempfile:
@@ -263,13 +479,9 @@ class FileStream(IO):
 
             def __enter__(self):
                 self._temp = tf.NamedTemporaryFile(prefix=prefix, suffix=suffix, delete=False)
-                with self._fs.save_pos():
-                    self._fs.seek(0)
-                    while True:
-                        b = self._fs.read(1048576)  # write 1 MiB at a time
-                        if not b:
-                            break
-                        self._temp.write(b)
+                content = self._fs.content
+                for offset in range(0, len(content), 1048576):  # write 1 MiB at a time
+                    self._temp.write(content[offset:offset + 1048576])
                 self._temp.flush()
                 self._temp.close()
                 return self._temp.name
@@ -282,23 +494,19 @@ class FileStream(IO):
 
     def __getitem__(self, index) -> Union[bytes, "FileStream"]:
         if isinstance(index, int):
-            with self.save_pos():
-                self.seek(index)
-                return self.read(1)
+            if index < 0:
+                index += len(self)
+            if index < 0 or index > len(self):
+                raise IndexError(f"{self!r} is {len(self)} bytes long, but byte {index} was requested")
+            elif index == len(self):
+                return b''
+            return self._data[self._offset + index:self._offset + index + 1]
         elif not isinstance(index, slice):
             raise ValueError(f"unexpected argument {index}")
         if index.step is not None and index.step != 1:
             raise ValueError(f"Invalid slice step: {index}")
-        length=None
-        if index.stop is not None:
-            if index.stop < 0 and (
-                    (index.stop < index.start and index.start > 0) or (index.stop > index.start and index.start < 0)):
-                length = len(self) + index.stop - index.start
-            elif index.stop < index.start:
-                length = 0
-            else:
-                length = index.stop - index.start
-        return FileStream(self, start=index.start, length=length, close_on_exit=False)
+        start, stop, _ = index.indices(len(self))
+        return FileStream(self, start=start, length=max(stop - start, 0), close_on_exit=False)
 
     def __enter__(self) -> "FileStream":
         self._entries += 1
@@ -309,17 +517,31 @@ class FileStream(IO):
         assert self._entries >= 0
         if self._entries == 0 and self.close_on_exit:
             self.close_on_exit = False
-            self._stream.close()
+            self._close()
 
     def close(self) -> None:
         if self._entries == 0:
+            self._close()
+
+    def _close(self):
+        if self._parent is not None:
+            # views do not own their data
+            return
+        if self._mapped is not None:
+            self._mapped.release()
+            self._mapped = None
+        if self._private_mmap is not None:
+            _close_data(self._private_mmap)
+            self._private_mmap = None
+        if self._stream is not None:
             self._stream.close()
 
     def flush(self):
-        self._stream.flush()
+        if self._stream is not None:
+            self._stream.flush()
 
     def isatty(self) -> bool:
-        return self._stream.isatty()
+        return self._stream is not None and self._stream.isatty()
 
     def readline(self, limit: int = ...) -> AnyStr:
         raise UnsupportedOperation()
@@ -1,4 +1,6 @@
 import base64
+from contextlib import nullcontext
+from io import BytesIO
 import math
 import mimetypes
 import os
@@ -25,6 +27,7 @@ def assign_ids(sbud):
 
 
 def generate(file_path, sbud):
+    """Renders the HTML viewer for `file_path`, which may also be the contents of the file or a seekable stream"""
     global TEMPLATE, jinja2
     if jinja2 is None:
         # Dynamically load jinja2 at runtime so it is not an installation dependency for setup.py
@@ -37,7 +40,15 @@ def generate(file_path, sbud):
     matches = assign_ids(sbud)
 
     input_bytes = sbud['length']
-    with open(file_path, 'rb') as input_file:
+    if isinstance(file_path, (str, os.PathLike)):
+        input_context = open(file_path, 'rb')
+    else:
+        if isinstance(file_path, (bytes, bytearray, memoryview)):
+            file_path = BytesIO(file_path)
+        # the caller owns the stream, so do not close it
+        input_context = nullcontext(file_path)
+        file_path = sbud.get('fileName', 'input')
+    with input_context as input_file:
         class ReadUnicode():
             def __init__(self):
                 self.reset = False
@@ -114,9 +125,15 @@ def generate(file_path, sbud):
             for m in matches:
                 yield from _decoded_matches(m)
 
+        encoded = sbud.get('b64contents')
+        if encoded is None:
+            # the SBUD was generated without embedding the file contents, but the HTML viewer needs them
+            input_file.seek(0)
+            encoded = base64.b64encode(input_file.read()).decode('utf-8')
+
         return TEMPLATE.render(
             filename=os.path.split(file_path)[-1],
-            encoded=sbud['b64contents'],
+            encoded=encoded,
             matches=matches,
             input_file=input_file,
             input_bytes=input_bytes,
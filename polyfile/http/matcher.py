@@ -1,28 +1,18 @@
-from pathlib import Path
-
 from ..ast import Node as ASTNode
-from ..fileutils import ExactNamedTempfile, FileStream
-from ..magic import MagicMatcher
-from ..polyfile import register_parser, Match
+from ..fileutils import FileStream
+from ..plugins import HTTP_11_MAGIC, HTTP_11_MIME_TYPE, HTTP_MIME_TYPE
+from ..polyfile import Match
 
 
 Http11RequestGrammar = None
 
-HTTP_MIME_TYPE: str = "message/x-http"
-HTTP_11_MIME_TYPE: str = f"{HTTP_MIME_TYPE}; version=1.1"
-
 
-# Register a magic matcher for HTTP 1.1 headers:
-with ExactNamedTempfile(b"""0 regex/s [^\\\\n]*?\\\\s+HTTP/1.1\\\\s*$ HTTP 1.1
-!:mime """ + HTTP_11_MIME_TYPE.encode("utf-8") + b"""
->0 string GET GET request header
->0 string POST POST request header
->0 string PUT PUT request header
-""", name="HTTP1.1Matcher") as t:
-    http_11_matcher = MagicMatcher.DEFAULT_INSTANCE.add(Path(t))[0]
+def __getattr__(name: str):
+    if name == "http_11_matcher":
+        return HTTP_11_MAGIC.tests[0]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
-@register_parser(HTTP_11_MIME_TYPE)
 def parse_http_11(file_stream: FileStream, parent: Match):
     offset = file_stream.tell()
     file_stream.seek(0)
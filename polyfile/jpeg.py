@@ -1,8 +1,8 @@
 import base64
 from io import BytesIO
 
-from .fileutils import FileStream, Tempfile
-from .polyfile import Match, register_parser, Submatch
+from .fileutils import FileStream
+from .polyfile import Match, Submatch
 
 
 def _get_pil_image():
@@ -11,14 +11,13 @@ def _get_pil_image():
     return Image
 
 
-@register_parser("image/jp2")
 def parse_jpeg2000(file_stream: FileStream, parent: Match):
     Image = _get_pil_image()
-    with Tempfile(file_stream.read(parent.length)) as input_bytes:
+    with BytesIO(file_stream.read(parent.length)) as input_bytes:
         img = Image.open(input_bytes)
         with BytesIO() as img_data:
             img.save(img_data, "PNG")
-            b64data = f"data:image/png;base64,{base64.b64encode(img_data).decode('utf-8')}"
+            b64data = f"data:image/png;base64,{base64.b64encode(img_data.getvalue()).decode('utf-8')}"
     yield Submatch(
         name='ImageData',
         img_data=b64data,
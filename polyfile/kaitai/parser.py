@@ -8,6 +8,7 @@ from io import BufferedReader, BytesIO
 import json
 from pathlib import Path
 import sys
+import threading
 from typing import Any, Dict, Iterator, List, Optional, Set, Type, Union
 
 from . import parsers
@@ -40,6 +41,7 @@ del MANIFEST
 
 _IMPORTED_SPECS: Set[Path] = set()
 _PARSERS_BY_KSY: Dict[str, Type[KaitaiStruct]] = {}
+_IMPORT_LOCK = threading.RLock()
 
 
 def import_spec(compiled: CompiledKSY) -> Optional[Type[KaitaiStruct]]:
@@ -243,12 +245,12 @@ class ArrayNode(CompoundNode):
 
 
 class RootNode(StructNode):
-    def __init__(self, buffer: bytes, obj: KaitaiStruct):
-        self.buffer: bytes = buffer
+    def __init__(self, buffer: Union[bytes, memoryview], obj: KaitaiStruct):
+        self.buffer: Union[bytes, memoryview] = buffer
         super().__init__(obj, name=obj.__class__.__name__, segment=Segment(0, len(self.buffer)), offset=0)
 
     def get_value(self, start, end):
-        return self.buffer[start:end]
+        return bytes(self.buffer[start:end])
 
 
 class KaitaiInspector:
@@ -294,8 +296,11 @@ class KaitaiParser:
         if ksy_path not in _PARSERS_BY_KSY:
             if ksy_path not in COMPILED_INFO_BY_KSY:
                 raise KeyError(ksy_path)
-            info = COMPILED_INFO_BY_KSY[ksy_path]
-            _PARSERS_BY_KSY[ksy_path] = import_spec(info)  # type: ignore
+            with _IMPORT_LOCK:
+                # check again, since another thread might have imported the spec while we were waiting for the lock
+                if ksy_path not in _PARSERS_BY_KSY:
+                    info = COMPILED_INFO_BY_KSY[ksy_path]
+                    _PARSERS_BY_KSY[ksy_path] = import_spec(info)  # type: ignore
         return KaitaiParser(_PARSERS_BY_KSY[ksy_path])
 
     def parse(self, input_file_path_or_content: Union[str, Path, bytes, BytesIO]) -> KaitaiInspector:
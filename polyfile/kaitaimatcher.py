@@ -1,52 +1,18 @@
 import base64
 import re
-from typing import Dict, Iterator, List, Tuple, Type
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Type
 
 from kaitaistruct import KaitaiStruct, KaitaiStructError
 
-from .kaitai.parser import ASTNode, KaitaiParser, RootNode
+from .kaitai.parser import ASTNode, CompoundNode, KaitaiParser, RootNode
 from .logger import getStatusLogger
-from .polyfile import register_parser, InvalidMatch, Match, Parser, Submatch
+from .fileutils import FileStream
+from .plugins import KAITAI_MIME_MAPPING, KAITAI_RECORD_ARRAYS
+from .polyfile import InvalidMatch, Match, Submatch
 
 
 log = getStatusLogger(__name__)
 
-KAITAI_MIME_MAPPING: Dict[str, str] = {
-    "image/gif": "image/gif.ksy",
-    "image/png": "image/png.ksy",
-    "image/jpeg": "image/jpeg.ksy",
-    "image/vnd.microsoft.icon": "image/ico.ksy",
-#    "image/wmf": "image/wmf.ksy",  # there is currently a problem with this parser in Python
-    "application/vnd.nitf": "image/nitf.ksy",
-    "application/vnd.tcpdump.pcap": "network/pcap.ksy",
-    "application/x-sqlite3": "database/sqlite3.ksy",
-    "application/x-rar": "archive/rar.ksy",
-    "font/sfnt": "font/ttf.ksy",
-    "application/x-pie-executable": "executable/elf.ksy",
-    "application/gzip": "archive/gzip.ksy",
-    "application/x-xar": "archive/xar.ksy",
-    "application/x-python-code": "executable/python_pyc_27.ksy",
-    "application/x-shockwave-flash": "executable/swf.ksy",
-    "application/x-doom": "game/doom_wad.ksy",
-    "image/x-dcx": "image/pcx_dcx.ksy",
-    "model/gltf-binary": "3d/gltf_binary.ksy",
-    "application/x-rpm": "archive/rpm.ksy",
-    "application/x-cpio": "archive/cpio_old_le.ksy",
-    "image/x-gimp-gbr": "image/gimp_brush.ksy",
-#    "application/dicom": "image/dicom.ksy",  # there is currently a problem with this parser in Python
-    "image/bmp": "image/bmp.ksy",
-    "application/x-blender": "media/blender_blend.ksy",
-    "audio/x-voc": "media/creative_voice_file.ksy",
-    "audio/midi": "media/standard_midi_file.ksy",
-    "application/dime": "network/dime_message.ksy",
-    "application/bson": "serialization/bson.ksy",
-    "application/x-ms-shortcut": "windows/windows_lnk_file.ksy",
-    "application/x-java-applet": "executable/java_class.ksy",
-    # Uncomment this when/if Kaitai fixes its upstream compilation bug for ICC
-# (https://github.com/kaitai-io/kaitai_struct_formats/issues/347#ref-commit-fde2866)
-#    "application/vnd.iccprofile": "image/icc_4.ksy"
-}
-
 IMAGE_MIMETYPES = {
     "image/gif",
     "image/jpeg",
@@ -57,15 +23,22 @@ IMAGE_MIMETYPES = {
 MIME_BY_PARSER: Dict[Type[KaitaiStruct], str] = {}
 
 
-def ast_to_matches(ast: RootNode, parent: Match) -> Iterator[Submatch]:
+def ast_to_matches(ast: ASTNode, parent: Match, shift: int = 0, name: Optional[str] = None) -> Iterator[Submatch]:
+    """
+    Converts `ast` and its descendants to submatches of `parent`.
+
+    `shift` is added to the offset of every node, for an AST that was parsed from data that was moved, and `name`
+    overrides the name of the root of the AST.
+
+    """
     stack: List[Tuple[Match, ASTNode]] = [(parent, ast)]
     while stack:
         parent, node = stack.pop()
 
         new_node = Submatch(
-            name=node.name,
+            name=node.name if node is not ast or name is None else name,
             match_obj=node.raw_value,
-            relative_offset=node.start - parent.offset,
+            relative_offset=node.start + shift - parent.offset,
             length=len(node.segment),
             parent=parent
         )
@@ -77,7 +50,12 @@ def ast_to_matches(ast: RootNode, parent: Match) -> Iterator[Submatch]:
                 new_node.img_data = f"data:{mtype};base64,{base64.b64encode(ast.raw_value).decode('utf-8')}"
 
         yield new_node
-        stack.extend(reversed([(new_node, c) for c in node.children]))
+        if isinstance(node, CompoundNode):
+            # explore rather than use `children`, which would cache every node of the AST until it is all converted
+            children: Iterable[ASTNode] = node.explore()
+        else:
+            children = node.children
+        stack.extend(reversed([(new_node, c) for c in children]))
 
 
 class LazyKaitaiParser:
@@ -107,12 +85,66 @@ class LazyKaitaiParser:
         yield from ast_to_matches(ast, parent=match)
 
 
+class KaitaiRecordResumer:
+    """
+    Resumes parsing a format that ends with an array of records that repeats until the end of the file, like a pcap.
+
+    Rather than parsing the whole grown file, the Kaitai parser is run on the data preceding the array (e.g., the
+    file's header) followed by only the appended records, and the new records are added to the existing array.
+
+    """
+
+    def __init__(self, parser: LazyKaitaiParser, array_name: str):
+        self.parser: LazyKaitaiParser = parser
+        self.array_name: str = array_name
+
+    def __call__(self, stream: FileStream, match: Match, previous_length: int) -> bool:
+        if len(match) != 1 or match.offset != 0:
+            return False
+        struct_match = match[0]
+        if struct_match.offset != 0 or struct_match.length != previous_length or not len(struct_match):
+            return False
+        records = struct_match[-1]
+        if records.name != self.array_name or records.offset + records.length != previous_length:
+            return False
+        stream.seek(0)
+        header = stream.read(records.offset)
+        stream.seek(previous_length)
+        try:
+            ast = self.parser.kaitai_parser.parse(header + stream.read()).ast
+            new_records = ast.children[-1]
+        except Exception as e:
+            log.debug(f"Unable to resume parsing {stream.name} using {self.parser.kaitai_parser}: {e!s}")
+            return False
+        if new_records.name != self.array_name or new_records.start != len(header) or \
+                new_records.end != len(ast.buffer):
+            return False
+        # the arrays and the structs that contain them now extend to the end of the file
+        length = len(stream)
+        match._length = length
+        for container in (struct_match, records):
+            container._length = length - container.offset
+            stream.seek(container.offset)
+            container.match = stream.read()
+        num_records = len(records)
+        for i, record in enumerate(new_records.children):
+            for _ in ast_to_matches(
+                    record, parent=records, shift=previous_length - len(header),
+                    name=f"{self.array_name}[{num_records + i}]"
+            ):
+                pass
+        return True
+
+
 for mimetype, kaitai_path in KAITAI_MIME_MAPPING.items():
     func_name = mimetype.replace("/", "_").replace("-", "_")
     parser = LazyKaitaiParser(kaitai_path, mimetype)
     parser.__name__ = f"parse_{func_name}"
     parser.__qualname__ = f"parse_{func_name}"
-    register_parser(mimetype)(parser)
+    # `polyfile.plugins` registers each parser lazily by this name
+    globals()[parser.__name__] = parser
+    if mimetype in KAITAI_RECORD_ARRAYS:
+        globals()[f"resume_{func_name}"] = KaitaiRecordResumer(parser, KAITAI_RECORD_ARRAYS[mimetype])
 
 del func_name
 del kaitai_path
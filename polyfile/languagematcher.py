@@ -2,8 +2,8 @@ from enum import Enum
 from typing import List, Optional, Sequence
 
 from .logger import StatusLogger
-from .polyfile import Match, Submatch, register_parser
-from .magic import AbsoluteOffset, FailedTest, MagicMatcher, MagicTest, MatchedTest, TestResult, TestType
+from .polyfile import Match, Submatch
+from .magic import AbsoluteOffset, FailedTest, MagicTest, MatchedTest, TestResult, TestType
 
 
 log = StatusLogger("polyfile")
@@ -162,10 +162,6 @@ class BFMatcher(MagicTest):
                                length=last_command - first_command)
 
 
-MagicMatcher.DEFAULT_INSTANCE.add(BFMatcher())
-
-
-@register_parser("application/x-brainfuck")
 def parse_bf(file_stream, match):
     commands = {
         ord('['): "LoopStart",
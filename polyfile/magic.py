@@ -9,7 +9,8 @@ details about the file.
 
 """
 from abc import ABC, abstractmethod
-from collections import defaultdict
+from collections import Counter, defaultdict
+from copy import copy
 import csv
 import functools
 from datetime import datetime
@@ -22,6 +23,7 @@ from pathlib import Path
 import re
 import struct
 import sys
+import threading
 from time import gmtime, localtime, strftime
 from typing import (
     Any, BinaryIO, Callable, Dict, Generic, Iterable, Iterator, List, Optional, Set, Tuple, Type, TypeVar, Union
@@ -67,7 +69,7 @@ else:
 MAGIC_DEFS: List[Path] = sorted([
     get_resource_path(resource_name)
     for resource_name in get_resource_contents(magic_defs)
-    if resource_name not in ("COPYING", "magic.mgc", "__pycache__") and not resource_name.startswith(".")
+    if resource_name not in ("COPYING", "magic.mgc", "manifest.json", "__pycache__") and not resource_name.startswith(".")
 ], key=lambda p: p.name)
 
 
@@ -82,6 +84,25 @@ ESCAPES = {
 }
 
 
+@functools.lru_cache(maxsize=None)
+def _literal_pattern(sub: bytes) -> Pattern[bytes]:
+    return re.compile(re.escape(sub))
+
+
+def find(data: Union[bytes, memoryview], sub: bytes, start: int = 0, end: Optional[int] = None) -> int:
+    """Equivalent to `data.find(sub, start, end)`, but also works on memoryviews, which do not have a `find` method"""
+    if not isinstance(data, memoryview):
+        if end is None:
+            return data.find(sub, start)
+        return data.find(sub, start, end)
+    if end is None:
+        end = len(data)
+    m = _literal_pattern(sub).search(data, start, end)
+    if m is None:
+        return -1
+    return m.start()
+
+
 def unescape(to_unescape: Union[str, bytes]) -> bytes:
     """Processes unicode escape sequences. Also handles libmagic's support for single digit `\\x#` hex escapes."""
     # first, process single digit hex escapes:
@@ -299,6 +320,10 @@ def parse_numeric(text: Union[str, bytes]) -> int:
         return int(text) * factor
 
 
+OFFSETS_BY_SPECIFICATION: Dict[str, "Offset"] = {}
+"""Interned offsets parsed from definition files, keyed by their specification"""
+
+
 class Offset(ABC):
     @abstractmethod
     def to_absolute(self, data: bytes, last_match: Optional[TestResult], allow_invalid: bool = False) -> int:
@@ -436,7 +461,7 @@ class IndirectOffset(Offset):
             value: Optional[int] = None
             if octal_string_end > offset:
                 try:
-                    value = int(data[:octal_string_end], 8)
+                    value = int(bytes(data[:octal_string_end]), 8)
                 except ValueError:
                     pass
             if value is None:
@@ -566,19 +591,33 @@ class SourceInfo:
 
 
 class MatchContext:
-    def __init__(self, data: bytes, path: Optional[Path] = None, only_match_mime: bool = False):
+    def __init__(
+            self,
+            data: bytes,
+            path: Optional[Path] = None,
+            only_match_mime: bool = False,
+            executable: Optional[bool] = None
+    ):
         self.data: bytes = data
         self.path: Optional[Path] = path
         self.only_match_mime: bool = only_match_mime
+        self.executable: Optional[bool] = executable
+        """Whether the data are executable; if None, this is determined from the permissions of `path`"""
+        self.evaluations: Dict[Tuple["MagicTest", int, bool], TestResult] = {}
+        """Memoized results of shared evaluation nodes, keyed by (node, absolute offset, flipped endianness)"""
 
     def __getitem__(self, s: slice) -> "MatchContext":
         if not isinstance(s, slice):
             raise ValueError("Match contexts can only be sliced")
-        return MatchContext(data=self.data[s], path=self.path, only_match_mime=self.only_match_mime)
+        return MatchContext(
+            data=self.data[s], path=self.path, only_match_mime=self.only_match_mime, executable=self.executable
+        )
 
     @property
     def is_executable(self) -> bool:
-        if self.path is None:
+        if self.executable is not None:
+            return self.executable
+        elif self.path is None:
             log.warning("Unable to determine if the input data is executable; assuming it is not.")
             return False
         try:
@@ -693,6 +732,8 @@ class TestType(IntFlag):
 
 class MagicTest(ABC):
     AUTO_REGISTER_TEST: bool = True
+    MEMOIZE_RESULTS: bool = False
+    """Whether the result of `test` depends only on the data and absolute offset, and can therefore be memoized"""
 
     def __init__(
             self,
@@ -736,6 +777,12 @@ class MagicTest(ABC):
         This is currently set after parsing all of the definition files.
         Any custom implementation should set it manually after this object is created.
 
+        """
+        self.evaluation_node: Optional[MagicTest] = None
+        """
+        The canonical test whose results this test shares because their subtrees are structurally identical.
+        This is set by `MagicMatcher.share_evaluation_nodes` and is None if this test's subtree is unique.
+
         """
         self.mime = mime
         self.source_info: Optional[SourceInfo] = None
@@ -965,6 +1012,54 @@ class MagicTest(ABC):
     def calculate_absolute_offset(self, data: bytes, parent_match: Optional[TestResult] = None) -> int:
         return self.offset.to_absolute(data, parent_match)
 
+    def node_key(self) -> Optional[Tuple[Any, ...]]:
+        """
+        Returns a hashable key for the parts of this test, other than its offset, message, MIME type, extensions, and
+        children, that determine what it matches.
+
+        Tests with equal subtrees of node keys are interchangeable when evaluated at the same absolute offset. The
+        default implementation returns None, meaning that this test is never considered structurally identical to any
+        other test.
+
+        """
+        return None
+
+    def carving_signature(self) -> Optional[Tuple[int, bytes]]:
+        """
+        Returns a tuple `(offset, literal)` if this test can only match data containing `literal` at `offset`.
+
+        Carving (see `MagicMatcher.carve`) uses these signatures to find the offsets at which level zero tests might
+        match. The default implementation returns None, meaning that this test has no such signature.
+
+        """
+        return None
+
+    def _evaluate(
+            self,
+            context: MatchContext,
+            absolute_offset: int,
+            parent_match: Optional[TestResult],
+            flip_endianness: bool
+    ) -> TestResult:
+        if self.evaluation_node is None:
+            if flip_endianness:
+                return self.test_flip_endianness(context.data, absolute_offset, parent_match)
+            return self.test(context.data, absolute_offset, parent_match)
+        key = (self.evaluation_node, absolute_offset, flip_endianness)
+        result = context.evaluations.get(key, None)
+        if result is None:
+            if flip_endianness:
+                result = self.test_flip_endianness(context.data, absolute_offset, parent_match)
+            else:
+                result = self.test(context.data, absolute_offset, parent_match)
+            context.evaluations[key] = result
+            return result
+        # re-bind the memoized result to this test and its parent match
+        if isinstance(result, MatchedTest):
+            return MatchedTest(self, value=result.value, offset=result.offset, length=result.length,
+                               parent=parent_match)
+        return FailedTest(self, offset=result.offset, message=result.message, parent=parent_match)
+
     def _match(
             self,
             context: MatchContext,
@@ -977,10 +1072,7 @@ class MagicTest(ABC):
             absolute_offset = self.calculate_absolute_offset(context.data, parent_match)
         except InvalidOffsetError:
             return
-        if flip_endianness:
-            m = self.test_flip_endianness(context.data, absolute_offset, parent_match)
-        else:
-            m = self.test(context.data, absolute_offset, parent_match)
+        m = self._evaluate(context, absolute_offset, parent_match, flip_endianness)
         if logging.root.level <= TRACE and (bool(m) or self.level > 0):
             log.trace(
                 f"{self.source_info!s}\t{bool(m)}\t{absolute_offset}\t"
@@ -1051,6 +1143,8 @@ class DynamicMagicTest(MagicTest, ABC):
 
 
 TYPES_BY_NAME: Dict[str, "DataType"] = {}
+CONSTANTS_BY_SPECIFICATION: Dict[Tuple[str, str], Any] = {}
+"""Interned constants parsed from definition files, keyed by (data type name, specification)"""
 
 
 T = TypeVar("T")
@@ -1108,6 +1202,10 @@ class DataType(ABC, Generic[T]):
     def match(self, data: bytes, expected: T) -> DataTypeMatch:
         raise NotImplementedError()
 
+    def literal(self, expected: T) -> Optional[bytes]:
+        """Returns the bytes that data must start with in order to match `expected`, or None if that is not fixed"""
+        return None
+
     @staticmethod
     def parse(fmt: str) -> "DataType":
         if fmt in TYPES_BY_NAME:
@@ -1173,11 +1271,11 @@ class GUIDType(DataType[Union[UUID, UUIDWildcard]]):
         if len(data) < 16:
             return DataTypeMatch.INVALID
         try:
-            uuid = UUID(bytes_le=data[:16])
+            uuid = UUID(bytes_le=bytes(data[:16]))
         except ValueError:
             return DataTypeMatch.INVALID
         if isinstance(expected, UUIDWildcard) or uuid == expected:
-            return DataTypeMatch(data[:16], uuid)
+            return DataTypeMatch(bytes(data[:16]), uuid)
         else:
             return DataTypeMatch.INVALID
 
@@ -1206,7 +1304,7 @@ class UTF16Type(DataType[bytes]):
     def match(self, data: bytes, expected: bytes) -> DataTypeMatch:
         if self.num_bytes is not None:
             data = data[:self.num_bytes]
-        if data.startswith(expected):
+        if data[:len(expected)] == expected:
             if self.endianness == Endianness.LITTLE:
                 return DataTypeMatch(expected, expected.decode("utf-16-le"))
             else:
@@ -1222,6 +1320,8 @@ class StringTest(ABC):
         self.num_bytes: Optional[int] = num_bytes
 
     def post_process(self, data: bytes, initial_offset: int = 0) -> DataTypeMatch:
+        # `data` might be a slice of a memoryview
+        data = bytes(data)
         value = data
         # if self.compact_whitespace:
         #     value = b"".join(c for prev, c in zip(b"\0" + data, data) if c not in WHITESPACE or prev not in WHITESPACE)
@@ -1291,9 +1391,9 @@ class StringTest(ABC):
 class StringWildcard(StringTest):
     def matches(self, data: bytes) -> DataTypeMatch:
         if self.num_bytes is None:
-            first_null = data.find(b"\0")
+            first_null = find(data, b"\0")
         else:
-            first_null = data.find(b"\0", 0, self.num_bytes)
+            first_null = find(data, b"\0", 0, self.num_bytes)
             if first_null < 0:
                 return self.post_process(data[:self.num_bytes])
         if first_null >= 0:
@@ -1548,6 +1648,15 @@ class StringType(DataType[StringTest]):
     def match(self, data: bytes, expected: StringTest) -> DataTypeMatch:
         return expected.matches(data)
 
+    def literal(self, expected: StringTest) -> Optional[bytes]:
+        if not isinstance(expected, StringMatch) or not expected.string or expected.trim \
+                or expected.case_insensitive_lower or expected.case_insensitive_upper \
+                or expected.compact_whitespace or expected.optional_blanks:
+            return None
+        if expected.num_bytes is not None and expected.num_bytes < len(expected.string):
+            return None
+        return expected.string
+
     STRING_TYPE_FORMAT: Pattern[str] = re.compile(r"^u?string(/(?P<numbytes>\d+))?(?P<opts>/[BbCctTWwf]*)?$")
 
     @classmethod
@@ -1620,6 +1729,10 @@ class SearchType(StringType):
     def match(self, data: bytes, expected: StringTest) -> DataTypeMatch:
         return expected.search(data)
 
+    def literal(self, expected: StringTest) -> Optional[bytes]:
+        # a search can match anywhere in its range
+        return None
+
     SEARCH_TYPE_FORMAT: Pattern[str] = re.compile(
         r"^search"
         r"((/(?P<repetitions1>(0[xX][\dA-Fa-f]+|\d+)))(/(?P<flags1>[BbCctTWwsf]*)?)?|"
@@ -1721,9 +1834,9 @@ class PascalStringType(DataType[StringTest]):
         if m:
             # Use strlen (excluding null terminator) for match length to match libmagic behavior
             # for relative offset calculations
-            null_pos = content.find(b'\x00')
+            null_pos = find(content, b'\x00')
             effective_len = null_pos if null_pos != -1 else length
-            m.raw_match = data[:self.byte_length + effective_len]
+            m.raw_match = bytes(data[:self.byte_length + effective_len])
         return m
 
     PSTRING_TYPE_FORMAT: Pattern[str] = re.compile(r"^pstring(/J?[BHhLl]?J?)?$")
@@ -1828,6 +1941,7 @@ class RegexType(DataType[Pattern[bytes]]):
             limit = self.length
             offset = 0
             byte_limit = 80 * self.length  # libmagic uses an implicit byte limit assuming 80 characters per line
+            data = bytes(data[:byte_limit])
             while limit > 0:
                 limit -= 1
                 line_offset = data.find(b"\n", offset, byte_limit)
@@ -1848,7 +1962,7 @@ class RegexType(DataType[Pattern[bytes]]):
         else:
             m = expected.search(data[:self.length])
             if m:
-                match = data[:m.end()]
+                match = bytes(data[:m.end()])
                 try:
                     value = match.decode("utf-8")
                 except UnicodeDecodeError:
@@ -2131,6 +2245,22 @@ class NumericDataType(DataType[NumericValue]):
         else:
             return DataTypeMatch.INVALID
 
+    def literal(self, expected: NumericValue) -> Optional[bytes]:
+        if not isinstance(expected, IntegerValue) or expected.operator != NumericOperator.EQUALS \
+                or self.endianness == Endianness.PDP \
+                or self.base_type in (BaseNumericDataType.FLOAT, BaseNumericDataType.DOUBLE) \
+                or any(symbol in self.name for symbol in "&%+-^/*|"):
+            # the value is preprocessed (e.g., masked) before it is compared
+            return None
+        num_bytes = self.base_type.num_bytes
+        if self.endianness == Endianness.NATIVE:
+            byteorder = sys.byteorder
+        elif self.endianness == Endianness.LITTLE:
+            byteorder = "little"
+        else:
+            byteorder = "big"
+        return (expected.value & ((1 << (num_bytes * 8)) - 1)).to_bytes(num_bytes, byteorder)
+
     def flip_endianness(self) -> "NumericDataType":
         """Return a copy with LITTLE/BIG endianness flipped."""
         if self.endianness == Endianness.LITTLE:
@@ -2198,6 +2328,8 @@ class NumericDataType(DataType[NumericValue]):
 
 
 class ConstantMatchTest(MagicTest, Generic[T]):
+    MEMOIZE_RESULTS = True
+
     def __init__(
             self,
             offset: Offset,
@@ -2212,6 +2344,18 @@ class ConstantMatchTest(MagicTest, Generic[T]):
         self.data_type: DataType[T] = data_type
         self.constant: T = constant
 
+    def node_key(self) -> Optional[Tuple[Any, ...]]:
+        # data types and constants parsed from definition files are interned, so identity suffices
+        return self.data_type.name, id(self.constant)
+
+    def carving_signature(self) -> Optional[Tuple[int, bytes]]:
+        if type(self.offset) is not AbsoluteOffset:
+            return None
+        literal = self.data_type.literal(self.constant)
+        if literal is None:
+            return None
+        return self.offset.offset, literal
+
     def subtest_type(self) -> TestType:
         if self.data_type.is_text(self.constant):
             return TestType.TEXT
@@ -2271,6 +2415,9 @@ class OffsetMatchTest(MagicTest):
         self.subtraction: int = subtraction
         self.modulo: int = modulo
 
+    def node_key(self) -> Optional[Tuple[Any, ...]]:
+        return str(self.value), self.subtraction, self.modulo
+
     def subtest_type(self) -> TestType:
         return TestType.UNKNOWN
 
@@ -2329,6 +2476,9 @@ class IndirectTest(MagicTest):
     def subtest_type(self) -> TestType:
         return TestType.BINARY
 
+    def node_key(self) -> Optional[Tuple[Any, ...]]:
+        return id(self.matcher), self.relative
+
     def test(self, data: bytes, absolute_offset: int, parent_match: Optional[TestResult]) -> TestResult:
         if self.relative:
             if parent_match is None:
@@ -2414,6 +2564,9 @@ class UseTest(MagicTest):
     def subtest_type(self) -> TestType:
         return self.referenced_test.test_type
 
+    def node_key(self) -> Optional[Tuple[Any, ...]]:
+        return self.referenced_test.name, self.flip_endianness
+
     def referenced_tests(self) -> Set[NamedTest]:
         result = super().referenced_tests() | {self.referenced_test}
         if self.named_test is None or self.named_test.name != self.referenced_test.name:
@@ -2458,7 +2611,7 @@ class UseTest(MagicTest):
 class JSONTest(MagicTest):
     def test(self, data: bytes, absolute_offset: int, parent_match: Optional[TestResult]) -> Optional[TestResult]:
         try:
-            parsed = json.loads(data[absolute_offset:])
+            parsed = json.loads(bytes(data[absolute_offset:]))
             return MatchedTest(self, offset=absolute_offset, length=len(data) - absolute_offset, value=parsed,
                                parent=parent_match)
         except (json.JSONDecodeError, UnicodeDecodeError) as e:
@@ -2472,6 +2625,9 @@ class JSONTest(MagicTest):
     def subtest_type(self) -> TestType:
         return TestType.TEXT
 
+    def node_key(self) -> Optional[Tuple[Any, ...]]:
+        return ()
+
     def test_flip_endianness(
             self, data: bytes, absolute_offset: int, parent_match: Optional[TestResult]
     ) -> TestResult:
@@ -2481,7 +2637,7 @@ class JSONTest(MagicTest):
 class CSVTest(MagicTest):
     def test(self, data: bytes, absolute_offset: int, parent_match: Optional[TestResult]) -> TestResult:
         try:
-            text = data[absolute_offset:].decode("utf-8")
+            text = bytes(data[absolute_offset:]).decode("utf-8")
         except UnicodeDecodeError as e:
             return FailedTest(test=self, offset=absolute_offset, parent=parent_match, message=str(e))
         for dialect in csv.list_dialects():
@@ -2516,6 +2672,9 @@ class CSVTest(MagicTest):
     def subtest_type(self) -> TestType:
         return TestType.TEXT
 
+    def node_key(self) -> Optional[Tuple[Any, ...]]:
+        return ()
+
     def test_flip_endianness(
             self, data: bytes, absolute_offset: int, parent_match: Optional[TestResult]
     ) -> TestResult:
@@ -2526,6 +2685,9 @@ class DefaultTest(MagicTest):
     def subtest_type(self) -> TestType:
         return TestType.UNKNOWN
 
+    def node_key(self) -> Optional[Tuple[Any, ...]]:
+        return ()
+
     def test(self, data: bytes, absolute_offset: int, parent_match: Optional[TestResult]) -> TestResult:
         if parent_match is None or not parent_match.child_matched:
             return MatchedTest(self, offset=absolute_offset, length=0, value=True, parent=parent_match)
@@ -2543,6 +2705,9 @@ class ClearTest(MagicTest):
     def subtest_type(self) -> TestType:
         return TestType.UNKNOWN
 
+    def node_key(self) -> Optional[Tuple[Any, ...]]:
+        return ()
+
     def test(self, data: bytes, absolute_offset: int, parent_match: Optional[TestResult]) -> MatchedTest:
         if parent_match is None:
             return MatchedTest(self, offset=absolute_offset, length=0, value=None)
@@ -2560,6 +2725,9 @@ class DERTest(MagicTest):
     def subtest_type(self) -> TestType:
         return TestType.BINARY
 
+    def node_key(self) -> Optional[Tuple[Any, ...]]:
+        return ()
+
     def test(self, data: bytes, absolute_offset: int, parent_match: Optional[TestResult]) -> TestResult:
         raise NotImplementedError(
             "TODO: Implement support for the DER test (e.g., using the Kaitai asn1_der.py parser)"
@@ -2590,25 +2758,26 @@ class PlainTextTest(MagicTest):
         return TestType.TEXT
 
     def test(self, data: bytes, absolute_offset: int, parent_match: Optional[TestResult]) -> TestResult:
-        if not isinstance(self.message, ConstantMessage) or self.message.message:
-            raise ValueError(f"A new PlainTextTest must be constructed for each call to .test")
         detector = UniversalDetector()
         offset = absolute_offset
         while not detector.done and offset < min(len(data), 5000000):
             # feed 1kB at a time until we have high confidence in the classification
             # up to a maximum of 5MiB
-            detector.feed(data[offset:offset+1024])
+            detector.feed(bytes(data[offset:offset+1024]))
             offset += 1024
         detector.close()
         if detector.result["confidence"] >= self.minimum_encoding_confidence:
             encoding = detector.result["encoding"]
             try:
-                value = data[absolute_offset:].decode(encoding)
+                value = bytes(data[absolute_offset:]).decode(encoding)
             except UnicodeDecodeError:
-                value = data[absolute_offset:]
-            self.message = ConstantMessage(f"{encoding} text")
-            return MatchedTest(self, offset=absolute_offset, length=len(data) - absolute_offset, parent=parent_match,
-                               value=value)
+                value = bytes(data[absolute_offset:])
+            # bind the detected encoding to a copy of this test rather than to the test itself so that the same
+            # PlainTextTest can be safely matched against multiple files concurrently
+            text_test = copy(self)
+            text_test.message = ConstantMessage(f"{encoding} text")
+            return MatchedTest(text_test, offset=absolute_offset, length=len(data) - absolute_offset,
+                               parent=parent_match, value=value)
         else:
             return FailedTest(self, offset=absolute_offset, parent=parent_match, message="the data do not appear to "
                                                                                          "be encoded in a text format")
@@ -2778,21 +2947,146 @@ class Match:
     __str__ = message
 
 
+DEFAULT_MIN_SIGNATURE_LENGTH: int = 4
+
+
+class CarvingIndex:
+    """
+    Finds the offsets at which level zero tests might match, using a single pass over the data.
+
+    The literal signatures of the tests are grouped by their first byte, and each group is compiled into a regular
+    expression structured as a trie. Since each expression starts with a literal byte, the regular expression engine
+    can skip directly to the offsets where that byte occurs, which is several times faster than a single expression
+    that must try every signature at every offset.
+
+    """
+    def __init__(self, tests: Iterable[MagicTest], min_signature_length: int = DEFAULT_MIN_SIGNATURE_LENGTH):
+        self.tests_by_literal: Dict[bytes, List[Tuple[int, MagicTest]]] = defaultdict(list)
+        for test in tests:
+            signature = test.carving_signature()
+            if signature is not None and len(signature[1]) >= min_signature_length \
+                    and not CarvingIndex.is_low_entropy(signature[1]):
+                offset, literal = signature
+                self.tests_by_literal[literal].append((offset, test))
+        self.literal_lengths: List[int] = sorted({len(literal) for literal in self.tests_by_literal})
+        literals_by_first_byte: Dict[int, List[bytes]] = defaultdict(list)
+        for literal in self.tests_by_literal:
+            literals_by_first_byte[literal[0]].append(literal)
+        # only the first byte is consumed and the rest of the signature is matched by a lookahead, so that `finditer`
+        # finds overlapping occurrences in a single pass
+        self.patterns: List[Pattern[bytes]] = [
+            re.compile(
+                re.escape(bytes([first_byte])) + b"(?=" +
+                CarvingIndex.trie_pattern(literal[1:] for literal in literals) + b")",
+                flags=re.DOTALL
+            )
+            for first_byte, literals in sorted(literals_by_first_byte.items())
+        ]
+
+    @staticmethod
+    def is_low_entropy(literal: bytes) -> bool:
+        """
+        Returns whether `literal` is mostly a single repeated byte, like padding.
+
+        Such signatures occur at almost every offset of zero-padded or otherwise repetitive data, so carving them would
+        run their tests at nearly every offset.
+
+        """
+        return max(Counter(literal).values()) * 3 > len(literal) * 2
+
+    @staticmethod
+    def trie_pattern(literals: Iterable[bytes]) -> bytes:
+        """Returns a regular expression that matches a prefix of the data if it starts with any of `literals`"""
+        trie: Dict[Optional[int], Any] = {}
+        for literal in literals:
+            node = trie
+            for byte in literal:
+                node = node.setdefault(byte, {})
+            node[None] = {}
+
+        def to_pattern(node: Dict[Optional[int], Any]) -> bytes:
+            if None in node:
+                # a shorter literal ends here, and that is enough to make this offset a candidate
+                return b""
+            alternatives = [
+                re.escape(bytes([byte])) + to_pattern(child) for byte, child in sorted(node.items())
+            ]
+            if len(alternatives) == 1:
+                return alternatives[0]
+            return b"(?:" + b"|".join(alternatives) + b")"
+
+        return to_pattern(trie)
+
+    def candidates(self, data: bytes) -> Dict[int, List[MagicTest]]:
+        """Returns the tests that might match at each nonzero offset of `data`"""
+        positions: Set[int] = set()
+        for pattern in self.patterns:
+            positions.update(m.start() for m in pattern.finditer(data))
+        candidates: Dict[int, List[MagicTest]] = defaultdict(list)
+        for position in sorted(positions):
+            for length in self.literal_lengths:
+                for offset, test in self.tests_by_literal.get(data[position:position + length], ()):
+                    if position - offset > 0:
+                        # matches at offset zero are found by the regular magic pass
+                        candidates[position - offset].append(test)
+        return candidates
+
+
 class DefaultMagicMatcher:
     _DEFAULT_INSTANCE: Optional["MagicMatcher"] = None
+    _LOADING: Optional["MagicMatcher"] = None
+    """The default instance while its loaders are running"""
+    _LOADERS: List[Callable[["MagicMatcher"], Any]] = []
+    _LOCK: threading.RLock = threading.RLock()
+
+    @staticmethod
+    def register_loader(loader: Callable[["MagicMatcher"], Any]):
+        """
+        Registers a function that extends the default instance once its definitions have been parsed.
+
+        Loaders run in the order in which they were registered, before the default instance is published to other
+        threads. If the default instance has already been loaded, `loader` is called on it immediately.
+
+        """
+        with DefaultMagicMatcher._LOCK:
+            DefaultMagicMatcher._LOADERS.append(loader)
+            if DefaultMagicMatcher._DEFAULT_INSTANCE is not None:
+                loader(DefaultMagicMatcher._DEFAULT_INSTANCE)
 
     def __get__(self, instance, owner) -> "MagicMatcher":
-        if DefaultMagicMatcher._DEFAULT_INSTANCE is None:
-            # DefaultMagicMatcher._DEFAULT_INSTANCE = MagicMatcher.parse(*MAGIC_DEFS)
-            # FIXME: skip the DER definition for now because we don't yet support it
-            DefaultMagicMatcher._DEFAULT_INSTANCE = MagicMatcher.parse(*(d for d in MAGIC_DEFS if d.name != "der"))
-        return DefaultMagicMatcher._DEFAULT_INSTANCE
+        default_instance = DefaultMagicMatcher._DEFAULT_INSTANCE
+        if default_instance is None:
+            with DefaultMagicMatcher._LOCK:
+                if DefaultMagicMatcher._LOADING is not None:
+                    # a loader in this thread is accessing the instance that it is extending
+                    return DefaultMagicMatcher._LOADING
+                # another thread may have finished parsing while we were waiting for the lock
+                if DefaultMagicMatcher._DEFAULT_INSTANCE is None:
+                    # DefaultMagicMatcher._DEFAULT_INSTANCE = MagicMatcher.parse(*MAGIC_DEFS)
+                    # FIXME: skip the DER definition for now because we don't yet support it
+                    loading = MagicMatcher.parse(*(d for d in MAGIC_DEFS if d.name != "der"))
+                    DefaultMagicMatcher._LOADING = loading
+                    try:
+                        for loader in DefaultMagicMatcher._LOADERS:
+                            loader(loading)
+                    finally:
+                        DefaultMagicMatcher._LOADING = None
+                    DefaultMagicMatcher._DEFAULT_INSTANCE = loading
+                default_instance = DefaultMagicMatcher._DEFAULT_INSTANCE
+        return default_instance
 
     def __set__(self, instance, value: Optional["MagicMatcher"]):
-        DefaultMagicMatcher._DEFAULT_INSTANCE = value
+        with DefaultMagicMatcher._LOCK:
+            DefaultMagicMatcher._DEFAULT_INSTANCE = value
 
     def __delete__(self, instance):
-        DefaultMagicMatcher._DEFAULT_INSTANCE = None
+        with DefaultMagicMatcher._LOCK:
+            DefaultMagicMatcher._DEFAULT_INSTANCE = None
+
+    @staticmethod
+    def is_loaded() -> bool:
+        """Returns whether the default instance has been loaded, without loading it"""
+        return DefaultMagicMatcher._DEFAULT_INSTANCE is not None
 
 
 class MagicMatcher:
@@ -2806,7 +3100,12 @@ class MagicMatcher:
         self._tests_that_can_be_indirect: Set[MagicTest] = set()
         self._non_text_tests: Set[MagicTest] = set()
         self._text_tests: Set[MagicTest] = set()
+        self._tests_by_structure: Dict[Tuple[Any, ...], MagicTest] = {}
+        self._carving_indexes: Dict[int, CarvingIndex] = {}
+        """Carving indexes, keyed by their minimum signature length"""
         self._dirty: bool = True
+        self._lock: threading.RLock = threading.RLock()
+        """Guards modifications to this matcher; matching only ever reads from it"""
         for test in tests:
             self.add(test)
 
@@ -2836,55 +3135,133 @@ class MagicMatcher:
         return self._text_tests
 
     def add(self, test: Union[MagicTest, Path], test_type: TestType = TestType.UNKNOWN) -> List[MagicTest]:
-        if not isinstance(test, MagicTest):
-            level_zero_tests, _, tests_with_mime, indirect_tests = self._parse_file(test, self)
-            for test in tests_with_mime:
-                assert test.can_match_mime
-                for ancestor in test.ancestors():
-                    ancestor.can_match_mime = True
-            for test in indirect_tests:
-                assert test.can_be_indirect
-                assert test.can_match_mime
-                for ancestor in test.ancestors():
-                    ancestor.can_be_indirect = True
-            for test in level_zero_tests:
-                self.add(test, test_type=test_type)
-            return list(level_zero_tests)
-
-        if test_type != TestType.UNKNOWN:
-            test.test_type = test_type
-
-        self._dirty = True
-
-        if isinstance(test, NamedTest):
-            if test.name in self.named_tests:
-                raise ValueError(f"A test named {test.name} already exists in this matcher!")
-            self.named_tests[test.name] = test
-        else:
-            self._tests.append(test)
-
-        return [test]
+        with self._lock:
+            if not isinstance(test, MagicTest):
+                return self._add_parsed(self._parse_file(test, self), test_type)
+
+            if test_type != TestType.UNKNOWN:
+                test.test_type = test_type
+
+            self._dirty = True
+            self._carving_indexes = {}
+
+            if isinstance(test, NamedTest):
+                if test.name in self.named_tests:
+                    raise ValueError(f"A test named {test.name} already exists in this matcher!")
+                self.named_tests[test.name] = test
+            else:
+                self._tests.append(test)
+
+            return [test]
+
+    def add_definitions(
+            self, definitions: Union[str, bytes], name: str, test_type: TestType = TestType.UNKNOWN
+    ) -> List[MagicTest]:
+        """
+        Parses libmagic definitions from a string and adds them to this matcher.
+
+        This is equivalent to writing `definitions` to a file called `name` and adding its `Path`, without the file.
+        Returns the level zero tests that were added.
+
+        """
+        if isinstance(definitions, str):
+            definitions = definitions.encode("utf-8")
+        with self._lock:
+            lines = definitions.splitlines(keepends=True)
+            return self._add_parsed(self._parse_lines(lines, Path(name), self), test_type)
+
+    def _add_parsed(
+            self,
+            parsed: Tuple[Iterable[MagicTest], Iterable[UseTest], Set[MagicTest], Set[IndirectTest]],
+            test_type: TestType
+    ) -> List[MagicTest]:
+        level_zero_tests, _, tests_with_mime, indirect_tests = parsed
+        for test in tests_with_mime:
+            assert test.can_match_mime
+            for ancestor in test.ancestors():
+                ancestor.can_match_mime = True
+        for test in indirect_tests:
+            assert test.can_be_indirect
+            assert test.can_match_mime
+            for ancestor in test.ancestors():
+                ancestor.can_be_indirect = True
+        for test in level_zero_tests:
+            self.add(test, test_type=test_type)
+        self.share_evaluation_nodes(level_zero_tests)
+        return list(level_zero_tests)
+
+    def share_evaluation_nodes(self, tests: Iterable[MagicTest]) -> int:
+        """
+        Hash-conses the given tests and all of their descendants.
+
+        Subtrees that are structurally identical (same test type, offset, constant, message, MIME type, extensions,
+        and children) are assigned the same `MagicTest.evaluation_node`, so the results of tests that can be memoized
+        are only computed once per `MatchContext`. Returns the number of tests that share another test's node.
+
+        """
+        with self._lock:
+            structure_ids: Dict[MagicTest, Optional[int]] = {}
+            num_shared = 0
+            for root in tests:
+                stack: List[Tuple[MagicTest, bool]] = [(root, False)]
+                while stack:
+                    test, expanded = stack.pop()
+                    if not expanded:
+                        stack.append((test, True))
+                        stack.extend((child, False) for child in test.children if child not in structure_ids)
+                        continue
+                    node_key = test.node_key()
+                    child_ids = tuple(structure_ids.get(child, None) for child in test.children)
+                    if node_key is None or None in child_ids:
+                        structure_ids[test] = None
+                        continue
+                    if test.mime is None:
+                        mime: Optional[str] = None
+                    else:
+                        mime = str(test.mime)
+                    key = (
+                        type(test), str(test.offset), node_key, str(test.message), mime, tuple(sorted(test.extensions)),
+                        child_ids
+                    )
+                    canonical = self._tests_by_structure.setdefault(key, test)
+                    structure_ids[test] = id(canonical)
+                    if canonical is not test and test.MEMOIZE_RESULTS and test.evaluation_node is not canonical:
+                        canonical.evaluation_node = canonical
+                        test.evaluation_node = canonical
+                        num_shared += 1
+        if num_shared:
+            log.debug(f"{num_shared} magic tests share a structurally identical evaluation node")
+        return num_shared
 
     def _reassign_test_types(self):
         if not self._dirty:
             return
-        self._dirty = False
-        self._text_tests = set()
-        self._non_text_tests = set()
-        self._tests_that_can_be_indirect = set()
-        self._tests_by_ext = defaultdict(set)
-        self._tests_by_mime = defaultdict(set)
-        for test in self._tests:
-            if test.test_type == TestType.TEXT:
-                self._text_tests.add(test)
-            else:
-                self._non_text_tests.add(test)
-            if test.can_be_indirect:
-                self._tests_that_can_be_indirect.add(test)
-            for mime in test.mimetypes:
-                self._tests_by_mime[mime].add(test)
-            for ext in test.all_extensions:
-                self._tests_by_ext[ext].add(test)
+        with self._lock:
+            if not self._dirty:
+                return
+            # build the new indexes before publishing them so concurrent readers never observe a partial index
+            text_tests: Set[MagicTest] = set()
+            non_text_tests: Set[MagicTest] = set()
+            tests_that_can_be_indirect: Set[MagicTest] = set()
+            tests_by_ext: Dict[str, Set[MagicTest]] = defaultdict(set)
+            tests_by_mime: Dict[str, Set[MagicTest]] = defaultdict(set)
+            for test in self._tests:
+                if test.test_type == TestType.TEXT:
+                    text_tests.add(test)
+                else:
+                    non_text_tests.add(test)
+                if test.can_be_indirect:
+                    tests_that_can_be_indirect.add(test)
+                for mime in test.mimetypes:
+                    tests_by_mime[mime].add(test)
+                for ext in test.all_extensions:
+                    tests_by_ext[ext].add(test)
+            self._text_tests = text_tests
+            self._non_text_tests = non_text_tests
+            self._tests_that_can_be_indirect = tests_that_can_be_indirect
+            self._tests_by_ext = tests_by_ext
+            self._tests_by_mime = tests_by_mime
+            self._dirty = False
 
     def only_match(
             self,
@@ -2929,6 +3306,44 @@ class MagicMatcher:
         """Returns the set of extensions this matcher is capable of matching"""
         return self.tests_by_ext.keys()
 
+    def carving_index(self, min_signature_length: int = DEFAULT_MIN_SIGNATURE_LENGTH) -> "CarvingIndex":
+        """Returns the index of the signatures of this matcher's level zero tests that can produce a MIME type"""
+        with self._lock:
+            index = self._carving_indexes.get(min_signature_length, None)
+            if index is None:
+                index = CarvingIndex(
+                    (test for test in self._tests if test.can_match_mime), min_signature_length=min_signature_length
+                )
+                self._carving_indexes[min_signature_length] = index
+            return index
+
+    def carve(
+            self,
+            to_match: MatchContext,
+            min_signature_length: int = DEFAULT_MIN_SIGNATURE_LENGTH
+    ) -> Iterator[Tuple[int, Match]]:
+        """
+        Yields `(offset, match)` for the files embedded at nonzero offsets within `to_match`.
+
+        Rather than running every test at every offset, a single pass over the data finds the offsets at which the
+        signature of a level zero test occurs (see `MagicTest.carving_signature`), and only those tests are run, only
+        at those offsets. Tests without a signature of at least `min_signature_length` bytes are never carved, since
+        short signatures occur too often by chance. Only matches that have a MIME type are yielded.
+
+        """
+        candidates = self.carving_index(min_signature_length).candidates(to_match.data)
+        # slicing a memoryview does not copy the rest of the data for every candidate offset
+        view = MatchContext(
+            data=memoryview(to_match.data), path=to_match.path, only_match_mime=to_match.only_match_mime,
+            executable=to_match.executable
+        )
+        for offset in log.range(sorted(candidates), desc="carving", unit=" offsets", delay=1.0):
+            context = view[offset:]
+            for test in candidates[offset]:
+                m = Match(matcher=self, context=context, results=test.match(context))
+                if m and any(t is not None for t in m.mimetypes):
+                    yield offset, m
+
     def match(self, to_match: Union[bytes, BinaryIO, str, Path, MatchContext]) -> Iterator[Match]:
         if isinstance(to_match, bytes):
             to_match = MatchContext(to_match)
@@ -2974,10 +3389,15 @@ class MagicMatcher:
             raise ValueError(f"{def_file!s} line {line_number}: Invalid level for test {line!r}")
         test_str, message = _split_with_escapes(m.group("remainder"))
         message = unescape(message).decode("utf-8")
-        try:
-            offset = Offset.parse(m.group("offset"))
-        except ValueError as e:
-            raise ValueError(f"{def_file!s} line {line_number}: {e!s}")
+        offset_str = m.group("offset")
+        if offset_str in OFFSETS_BY_SPECIFICATION:
+            offset = OFFSETS_BY_SPECIFICATION[offset_str]
+        else:
+            try:
+                offset = Offset.parse(offset_str)
+            except ValueError as e:
+                raise ValueError(f"{def_file!s} line {line_number}: {e!s}")
+            OFFSETS_BY_SPECIFICATION[offset_str] = offset
         data_type = m.group("data_type")
         if data_type == "name":
             if parent is not None:
@@ -3066,7 +3486,12 @@ class MagicMatcher:
                         # subsequent value:
                         actual_operand, message = _split_with_escapes(message)
                         test_str = f"{test_str}{actual_operand}"
-                    constant = data_type.parse_expected(test_str)
+                    constant_key = (data_type.name, test_str)
+                    if constant_key in CONSTANTS_BY_SPECIFICATION:
+                        constant = CONSTANTS_BY_SPECIFICATION[constant_key]
+                    else:
+                        constant = data_type.parse_expected(test_str)
+                        CONSTANTS_BY_SPECIFICATION[constant_key] = constant
                 except ValueError as e:
                     raise ValueError(f"{def_file!s} line {line_number}: {e!s}")
                 test = ConstantMatchTest(
@@ -3082,6 +3507,13 @@ class MagicMatcher:
     @staticmethod
     def _parse_file(
             def_file: Union[str, Path], matcher: "MagicMatcher"
+    ) -> Tuple[Iterable[MagicTest], Iterable[UseTest], Set[MagicTest], Set[IndirectTest]]:
+        with open(def_file, "rb") as f:
+            return MagicMatcher._parse_lines(f.readlines(), def_file, matcher)
+
+    @staticmethod
+    def _parse_lines(
+            lines: Iterable[bytes], def_file: Union[str, Path], matcher: "MagicMatcher"
     ) -> Tuple[Iterable[MagicTest], Iterable[UseTest], Set[MagicTest], Set[IndirectTest]]:
         current_test: Optional[MagicTest] = None
         late_bindings: List[UseTest] = []
@@ -3089,85 +3521,84 @@ class MagicMatcher:
         tests_with_mime: Set[MagicTest] = set()
         indirect_tests: Set[IndirectTest] = set()
         comments: List[Comment] = []
-        with open(def_file, "rb") as f:
-            for line_number, raw_line in enumerate(f.readlines()):
-                line_number += 1
-                raw_line = raw_line.lstrip()
-                if not raw_line:
-                    # skip empty lines
-                    comments = []
-                    continue
-                elif raw_line.startswith(b"#"):
-                    # this is a comment
-                    try:
-                        comments.append(Comment(
-                            message=raw_line[1:].strip().decode("utf-8"),
-                            source_info=SourceInfo(def_file, line_number, raw_line.decode("utf-8"))
-                        ))
-                    except UnicodeDecodeError:
-                        pass
-                    continue
-                elif raw_line.startswith(b"!:apple"):
-                    continue
-                elif raw_line.startswith(b"!:strength"):
-                    if current_test is not None:
-                        strength_spec = raw_line[10:].strip().decode("utf-8")
-                        if strength_spec:
-                            op = strength_spec[0]
-                            factor_str = strength_spec[1:].strip()
-                            if op == '+':
-                                current_test.strength_op = StrengthOp.PLUS
-                            elif op == '-':
-                                current_test.strength_op = StrengthOp.MINUS
-                            elif op == '*':
-                                current_test.strength_op = StrengthOp.TIMES
-                            elif op == '/':
-                                current_test.strength_op = StrengthOp.DIV
-                            else:
-                                factor_str = strength_spec
-                                current_test.strength_op = StrengthOp.PLUS
-                            try:
-                                current_test.strength_factor = int(factor_str)
-                            except ValueError:
-                                pass
-                    continue
+        for line_number, raw_line in enumerate(lines):
+            line_number += 1
+            raw_line = raw_line.lstrip()
+            if not raw_line:
+                # skip empty lines
+                comments = []
+                continue
+            elif raw_line.startswith(b"#"):
+                # this is a comment
                 try:
-                    line = raw_line.decode("utf-8")
+                    comments.append(Comment(
+                        message=raw_line[1:].strip().decode("utf-8"),
+                        source_info=SourceInfo(def_file, line_number, raw_line.decode("utf-8"))
+                    ))
                 except UnicodeDecodeError:
-                    continue
-                test = MagicMatcher.parse_test(line, def_file, line_number, current_test, matcher)
-                if test is not None:
-                    if isinstance(test, NamedTest):
-                        matcher.named_tests[test.name] = test
-                    else:
-                        if isinstance(test, IndirectTest):
-                            indirect_tests.add(test)
-                        elif isinstance(test, UseTest) and test.late_binding:
-                            late_bindings.append(test)
-                        if test.level == 0:
-                            level_zero_tests.append(test)
-                        test.source_info = SourceInfo(def_file, line_number, line)
-                    test.comments = tuple(comments)
-                    comments = []
-                    current_test = test
-                    continue
-                m = MIME_PATTERN.match(line)
-                if m:
-                    if current_test is None:
-                        raise ValueError(f"{def_file!s} line {line_number}: Unexpected mime type {line!r}")
-                    elif current_test.mime is not None:
-                        raise ValueError(f"{def_file!s} line {line_number}: Duplicate mime types for test "
-                                         f"{current_test!r}: {current_test.mime!r} and {m.group(1)}")
-                    current_test.mime = m.group(1)
-                    tests_with_mime.add(current_test)
-                    continue
-                m = EXTENSION_PATTERN.match(line)
-                if m:
-                    if current_test is None:
-                        raise ValueError(f"{def_file!s} line {line_number}: Unexpected ext: {line!r}")
-                    current_test.extensions |= {ext for ext in re.split(r"[/,]", m.group(1)) if ext}
-                    continue
-                raise ValueError(f"{def_file!s} line {line_number}: Unexpected line\n{raw_line!r}")
+                    pass
+                continue
+            elif raw_line.startswith(b"!:apple"):
+                continue
+            elif raw_line.startswith(b"!:strength"):
+                if current_test is not None:
+                    strength_spec = raw_line[10:].strip().decode("utf-8")
+                    if strength_spec:
+                        op = strength_spec[0]
+                        factor_str = strength_spec[1:].strip()
+                        if op == '+':
+                            current_test.strength_op = StrengthOp.PLUS
+                        elif op == '-':
+                            current_test.strength_op = StrengthOp.MINUS
+                        elif op == '*':
+                            current_test.strength_op = StrengthOp.TIMES
+                        elif op == '/':
+                            current_test.strength_op = StrengthOp.DIV
+                        else:
+                            factor_str = strength_spec
+                            current_test.strength_op = StrengthOp.PLUS
+                        try:
+                            current_test.strength_factor = int(factor_str)
+                        except ValueError:
+                            pass
+                continue
+            try:
+                line = raw_line.decode("utf-8")
+            except UnicodeDecodeError:
+                continue
+            test = MagicMatcher.parse_test(line, def_file, line_number, current_test, matcher)
+            if test is not None:
+                if isinstance(test, NamedTest):
+                    matcher.named_tests[test.name] = test
+                else:
+                    if isinstance(test, IndirectTest):
+                        indirect_tests.add(test)
+                    elif isinstance(test, UseTest) and test.late_binding:
+                        late_bindings.append(test)
+                    if test.level == 0:
+                        level_zero_tests.append(test)
+                    test.source_info = SourceInfo(def_file, line_number, line)
+                test.comments = tuple(comments)
+                comments = []
+                current_test = test
+                continue
+            m = MIME_PATTERN.match(line)
+            if m:
+                if current_test is None:
+                    raise ValueError(f"{def_file!s} line {line_number}: Unexpected mime type {line!r}")
+                elif current_test.mime is not None:
+                    raise ValueError(f"{def_file!s} line {line_number}: Duplicate mime types for test "
+                                     f"{current_test!r}: {current_test.mime!r} and {m.group(1)}")
+                current_test.mime = m.group(1)
+                tests_with_mime.add(current_test)
+                continue
+            m = EXTENSION_PATTERN.match(line)
+            if m:
+                if current_test is None:
+                    raise ValueError(f"{def_file!s} line {line_number}: Unexpected ext: {line!r}")
+                current_test.extensions |= {ext for ext in re.split(r"[/,]", m.group(1)) if ext}
+                continue
+            raise ValueError(f"{def_file!s} line {line_number}: Unexpected line\n{raw_line!r}")
         return level_zero_tests, late_bindings, tests_with_mime, indirect_tests
 
     @staticmethod
@@ -3204,4 +3635,6 @@ class MagicMatcher:
         zero_level_tests.sort(key=lambda t: t.compute_strength(), reverse=True)
         for test in zero_level_tests:
             matcher.add(test)
+        matcher.share_evaluation_nodes(zero_level_tests)
+        matcher.share_evaluation_nodes(matcher.named_tests.values())
         return matcher
@@ -0,0 +1,135 @@
+"""
+A precomputed manifest of the MIME types and extensions that `MagicMatcher.DEFAULT_INSTANCE` can match.
+
+Listing the MIME types that PolyFile knows about (`polyfile --list`) or expanding a `--filetype` wildcard only needs
+their names, but reading them from the default matcher means parsing the entire libmagic database. The manifest
+records each MIME type and extension along with the definitions that can produce it, so those commands are
+near-instant. It is shipped with PolyFile and must be regenerated by running `python -m polyfile.manifest` whenever
+the definitions change; the test suite checks that it is up to date.
+
+A manifest is only used if its fingerprint matches the installed definitions; otherwise, PolyFile falls back to
+parsing the database.
+
+"""
+
+import hashlib
+import json
+from pathlib import Path
+import sys
+from typing import Dict, Iterable, List, Optional, Set
+
+from . import logger
+from .magic import DefaultMagicMatcher, get_resource_path, MAGIC_DEFS, MagicMatcher, MagicTest
+from .plugins import BUILTIN_MAGIC, MagicDefinitions
+
+MANIFEST_PATH: Path = get_resource_path("manifest.json")
+
+log = logger.getStatusLogger("polyfile")
+
+
+def fingerprint() -> str:
+    """A digest of the definitions that determine which MIME types and extensions the default matcher can match"""
+    digest = hashlib.sha256()
+    for def_file in MAGIC_DEFS:
+        digest.update(def_file.name.encode("utf-8"))
+        digest.update(def_file.read_bytes())
+    for magic in BUILTIN_MAGIC:
+        if isinstance(magic, MagicDefinitions):
+            digest.update(magic.definitions.encode("utf-8"))
+        else:
+            digest.update(f"{magic.module}:{magic.attribute}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _source(test: MagicTest) -> str:
+    """The name of the definition file that `test` was parsed from, or the class that implements it"""
+    if test.source_info is not None:
+        return test.source_info.path.name
+    return f"{test.__class__.__module__}:{test.__class__.__qualname__}"
+
+
+class MagicManifest:
+    def __init__(self, mimetypes: Dict[str, List[str]], extensions: Dict[str, List[str]], fingerprint: str):
+        self.mimetypes: Dict[str, List[str]] = mimetypes
+        """The sources of the tests that can match each MIME type"""
+        self.extensions: Dict[str, List[str]] = extensions
+        """The sources of the tests that can match each extension"""
+        self.fingerprint: str = fingerprint
+
+    def sources(self, mimetypes: Iterable[str]) -> Set[str]:
+        """Returns the sources of all of the tests that can match any of the given MIME types"""
+        sources: Set[str] = set()
+        for mimetype in mimetypes:
+            sources.update(self.mimetypes.get(mimetype, ()))
+        return sources
+
+    @staticmethod
+    def build(matcher: Optional[MagicMatcher] = None) -> "MagicManifest":
+        if matcher is None:
+            matcher = MagicMatcher.DEFAULT_INSTANCE
+        return MagicManifest(
+            mimetypes={
+                mimetype: sorted({_source(test) for test in tests})
+                for mimetype, tests in matcher.tests_by_mime.items()
+            },
+            extensions={
+                ext: sorted({_source(test) for test in tests}) for ext, tests in matcher.tests_by_ext.items()
+            },
+            fingerprint=fingerprint()
+        )
+
+    @staticmethod
+    def load(path: Path = MANIFEST_PATH) -> Optional["MagicManifest"]:
+        """Loads the manifest at `path`, returning None if it does not exist or is out of date"""
+        try:
+            with open(path, "r") as f:
+                obj = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if obj.get("fingerprint") != fingerprint():
+            log.debug(f"The magic manifest at {path!s} is out of date")
+            return None
+        return MagicManifest(mimetypes=obj["mimetypes"], extensions=obj["extensions"], fingerprint=obj["fingerprint"])
+
+    def save(self, path: Path = MANIFEST_PATH):
+        with open(path, "w") as f:
+            json.dump({
+                "fingerprint": self.fingerprint,
+                "mimetypes": self.mimetypes,
+                "extensions": self.extensions
+            }, f, sort_keys=True)
+
+
+def default_mimetypes() -> Iterable[str]:
+    """
+    Returns the MIME types that the default matcher can match.
+
+    These are read from the manifest unless the default matcher has already been loaded (and might have been extended
+    since) or the manifest is out of date.
+
+    """
+    if not DefaultMagicMatcher.is_loaded():
+        manifest = MagicManifest.load()
+        if manifest is not None:
+            return manifest.mimetypes.keys()
+    return MagicMatcher.DEFAULT_INSTANCE.mimetypes
+
+
+def main(argv: List[str]) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="builds the manifest of the MIME types that PolyFile can match")
+    parser.add_argument("--force", "-f", action="store_true", help="rebuild the manifest even if it is up to date")
+    parser.add_argument("--output", "-o", type=Path, default=MANIFEST_PATH,
+                        help="where to save the manifest (default: %(default)s)")
+
+    args = parser.parse_args(argv[1:])
+
+    if not args.force and MagicManifest.load(args.output) is not None:
+        return 0
+    MagicManifest.build().save(args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
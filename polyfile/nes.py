@@ -2,7 +2,7 @@ import base64
 from io import BytesIO
 from typing import TYPE_CHECKING
 
-from .polyfile import register_parser, InvalidMatch, Submatch
+from .polyfile import InvalidMatch, Submatch
 
 if TYPE_CHECKING:
     from PIL import Image as PILImage
@@ -83,7 +83,6 @@ def parse_ines_header(header, parent=None):
     )
 
 
-@register_parser("application/x-nes-rom")
 def parse_ines(file_stream, parent):
     header = file_stream.read(16)
     yield from parse_ines_header(header, parent)
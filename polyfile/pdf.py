@@ -21,10 +21,10 @@ from pdfminer.pdftypes import (
 )
 
 from .fileutils import FileStream
-from .fileutils import Tempfile
 from .logger import getStatusLogger
 from .magic import AbsoluteOffset, FailedTest, MagicMatcher, MagicTest, MatchedTest, TestResult, TestType
 from .polyfile import Match, Matcher, Submatch, register_parser
+from .quotas import Quota
 
 log = getStatusLogger("PDF")
 
@@ -571,7 +571,7 @@ class PNGPredictor(PSBytes):
 
 
 class PDFObjectStream(PDFStream):
-    def __init__(self, parent: PDFStream, pdf_offset: int, pdf_bytes: int):
+    def __init__(self, parent: PDFStream, pdf_offset: int, pdf_bytes: int, quota: Optional[Quota] = None):
         super().__init__(
             attrs=parent.attrs,
             rawdata=PSBytes(parent.rawdata, pdf_offset=pdf_offset, pdf_bytes=pdf_bytes),
@@ -583,6 +583,8 @@ class PDFObjectStream(PDFStream):
         self.data = parent.data
         self.objid = parent.objid
         self.genno = parent.genno
+        self.quota: Optional[Quota] = quota
+        """If not None, FlateDecode output is truncated at this quota's remaining decompression budget"""
 
     @property
     def data(self) -> Optional[PSBytes]:
@@ -623,7 +625,10 @@ class PDFObjectStream(PDFStream):
             if f in LITERALS_FLATE_DECODE:
                 # will get errors if the document is encrypted.
                 try:
-                    decoded = zlib.decompress(data)
+                    if self.quota is None:
+                        decoded = zlib.decompress(data)
+                    else:
+                        decoded = self.quota.decompress(data)
                 except zlib.error as e:
                     decoded = DecodingError(str(e))
             elif f in LITERALS_LZW_DECODE:
@@ -691,6 +696,7 @@ class PDFObjectStream(PDFStream):
 
 class PDFParser(PDFMinerParser):
     auto_flush: bool = False
+    quota: Optional[Quota] = None
 
     @staticmethod
     def string_escape(data: Union[bytes, int]) -> str:
@@ -743,7 +749,9 @@ class PDFParser(PDFMinerParser):
             elif len(obj) == 2 and isinstance(obj[1], PDFStream):
                 stream: PDFStream = obj[1]
                 pos = obj[0]
-                transformed.append((pos, PDFObjectStream(stream, pdf_offset=pos, pdf_bytes=len(stream.rawdata))))
+                transformed.append((pos, PDFObjectStream(
+                    stream, pdf_offset=pos, pdf_bytes=len(stream.rawdata), quota=self.quota
+                )))
             elif len(obj) == 2 and isinstance(obj[1], PSObject) and not isinstance(obj[1], PDFLiteral):
                 pos = obj[0]
                 psobj = obj[1]
@@ -929,8 +937,7 @@ def parse_object(obj, matcher: Matcher, parent: Optional[Match] = None, pdf_head
             parent=parent
         )
         yield deciphered
-        with Tempfile(obj) as f:
-            yield from matcher.match(f, parent=deciphered)
+        yield from matcher.match(obj, parent=deciphered)
     elif isinstance(obj, PSBytes):
         if isinstance(obj, PNGPredictor):
             match = Submatch(
@@ -956,8 +963,7 @@ def parse_object(obj, matcher: Matcher, parent: Optional[Match] = None, pdf_head
             yield from parse_object(obj.original_bytes, matcher=matcher, parent=match,
                                     pdf_header_offset=pdf_header_offset)
         # recursively match against the deflated contents
-        with Tempfile(obj) as f:
-            yield from matcher.match(f, parent=match)
+        yield from matcher.match(obj, parent=match)
     elif hasattr(obj, "pdf_offset") and hasattr(obj, "pdf_bytes"):
         yield Submatch(
             obj.__class__.__name__,
@@ -1163,7 +1169,7 @@ def pdf_obj_parser(file_stream, obj, objid: int, parent: Match, pdf_header_offse
     log.clear_status()
 
 
-# Note: PDF parser is registered lazily in __init__.py to defer pdfminer import
+# Note: PDF parser is registered lazily in plugins.py to defer pdfminer import
 def pdf_parser(file_stream, parent: Match):
     # pdfminer expects %PDF to be at byte offset zero in the file
     pdf_header_offset = file_stream.first_index_of(b"%PDF")
@@ -1188,6 +1194,7 @@ def pdf_parser(file_stream, parent: Match):
         return
     pdf_header_offset = file_stream.start
     parser = PDFParser(RawPDFStream(file_stream))
+    parser.quota = parent.matcher.quota
     doc = InstrumentedPDFDocument(parser)
     yielded = set()
     for xref in doc.xrefs:
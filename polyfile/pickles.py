@@ -1,9 +1,6 @@
 from typing import Optional
 
-from fickling.analysis import Analyzer, Severity
-from fickling.fickle import Pickled, PickleDecodeError
-
-from .magic import AbsoluteOffset, DynamicMagicTest, FailedTest, MagicMatcher, MatchedTest, TestResult, TestType
+from .magic import AbsoluteOffset, DynamicMagicTest, FailedTest, MatchedTest, TestResult, TestType
 
 
 class PickleMatcher(DynamicMagicTest):
@@ -24,6 +21,10 @@ class PickleMatcher(DynamicMagicTest):
             if i >= 128:
                 break
             elif prev == 0x80 and c in (2, 3, 4):
+                # fickling is slow to import, so only do so once something looks like a pickle
+                from fickling.analysis import Analyzer, Severity
+                from fickling.fickle import Pickled, PickleDecodeError
+
                 try:
                     pickled = Pickled.load(data)
                     results = Analyzer.default_instance.analyze(pickled)
@@ -42,4 +43,3 @@ class PickleMatcher(DynamicMagicTest):
 
 
 DEFAULT_PICKLE_MATCHER = PickleMatcher()
-MagicMatcher.DEFAULT_INSTANCE.add(DEFAULT_PICKLE_MATCHER)
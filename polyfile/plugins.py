@@ -0,0 +1,224 @@
+"""
+Lazy registration of PolyFile's built-in matchers and parsers.
+
+Importing the built-in format modules eagerly is slow, and adding a test to `MagicMatcher.DEFAULT_INSTANCE` at import
+time forces the whole libmagic database to be parsed. Instead, the built-in modules are declared here as metadata:
+
+* inline libmagic definitions (`MagicDefinitions`) and custom magic tests (`LazyMagicTest`) are added to the default
+  matcher when it is first loaded; and
+* parsers are registered by MIME type as `LazyParser`s, which only import their module the first time that a file of
+  that type is parsed, and likewise, resumers as `LazyResumer`s.
+
+"""
+
+from importlib import import_module
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from weakref import WeakKeyDictionary
+
+from .fileutils import FileStream
+from .magic import DefaultMagicMatcher, MagicMatcher, MagicTest, TestType
+from .polyfile import Match, Parser, ParserFunction, register_parser, register_resumer, ResumerFunction, Submatch
+
+
+class MagicDefinitions:
+    """Inline libmagic definitions that are parsed into the default matcher when it is loaded"""
+
+    def __init__(self, name: str, definitions: str, test_type: TestType = TestType.UNKNOWN):
+        self.name: str = name
+        self.definitions: str = definitions
+        self.test_type: TestType = test_type
+        self._tests: "WeakKeyDictionary[MagicMatcher, List[MagicTest]]" = WeakKeyDictionary()
+
+    def load(self, matcher: MagicMatcher) -> List[MagicTest]:
+        tests = matcher.add_definitions(self.definitions, name=self.name, test_type=self.test_type)
+        self._tests[matcher] = tests
+        return tests
+
+    @property
+    def tests(self) -> List[MagicTest]:
+        """The level zero tests that these definitions added to `MagicMatcher.DEFAULT_INSTANCE`"""
+        matcher = MagicMatcher.DEFAULT_INSTANCE
+        tests = self._tests.get(matcher, None)
+        if tests is None:
+            # the default instance was replaced by one that was not loaded with these definitions
+            tests = self.load(matcher)
+        return tests
+
+
+class LazyMagicTest:
+    """
+    A custom magic test that is imported from its module when the default matcher is loaded.
+
+    `attribute` names either a `MagicTest` instance or a `MagicTest` subclass whose constructor takes no arguments.
+
+    """
+
+    def __init__(self, module: str, attribute: str):
+        self.module: str = module
+        self.attribute: str = attribute
+
+    def load(self, matcher: MagicMatcher) -> List[MagicTest]:
+        test = getattr(import_module(self.module), self.attribute)
+        if isinstance(test, type):
+            test = test()
+        return matcher.add(test)
+
+
+class LazyParser(Parser):
+    """A parser that imports its implementation from `module` the first time that it is called"""
+
+    def __init__(self, module: str, attribute: str):
+        self.module: str = module
+        self.attribute: str = attribute
+        self._parser: Optional[ParserFunction] = None
+
+    @property
+    def parser(self) -> ParserFunction:
+        if self._parser is None:
+            self._parser = getattr(import_module(self.module), self.attribute)
+        return self._parser
+
+    def parse(self, stream: FileStream, match: Match) -> Iterator[Submatch]:
+        yield from self.parser(stream, match)
+
+    def __str__(self):
+        return self.attribute
+
+
+class LazyResumer:
+    """A resumer that imports its implementation from `module` the first time that it is called"""
+
+    def __init__(self, module: str, attribute: str):
+        self.module: str = module
+        self.attribute: str = attribute
+        self._resumer: Optional[ResumerFunction] = None
+
+    @property
+    def resumer(self) -> ResumerFunction:
+        if self._resumer is None:
+            self._resumer = getattr(import_module(self.module), self.attribute)
+        return self._resumer
+
+    def __call__(self, stream: FileStream, match: Match, previous_length: int) -> bool:
+        return self.resumer(stream, match, previous_length)
+
+    def __str__(self):
+        return self.attribute
+
+
+HTTP_MIME_TYPE: str = "message/x-http"
+HTTP_11_MIME_TYPE: str = f"{HTTP_MIME_TYPE}; version=1.1"
+
+RELAXED_ZIP_MAGIC = MagicDefinitions("RelaxedZipMatcher", """\
+# The default libmagic tests for detecting ZIPs assumes they start at byte offset zero
+0 search \\x50\\x4b\\x05\\x06 ZIP end of central directory record
+!:mime application/zip
+!:ext zip
+""")
+
+NITF_MAGIC = MagicDefinitions("NITFMatcher", """\
+# The default libmagic test for NITF does not associate a MIME type,
+# and does not support NITF 02.10
+0       string  NITF       NITF
+>4      string  02.10      \\ version 2.10 (ISO/IEC IS 12087-5)
+>25     string  >\\0     dated %.14s
+!:mime application/vnd.nitf
+!:ext ntf
+""", test_type=TestType.BINARY)
+
+HTTP_11_MAGIC = MagicDefinitions("HTTP1.1Matcher", f"""\
+0 regex/s [^\\\\n]*?\\\\s+HTTP/1.1\\\\s*$ HTTP 1.1
+!:mime {HTTP_11_MIME_TYPE}
+>0 string GET GET request header
+>0 string POST POST request header
+>0 string PUT PUT request header
+""")
+
+BUILTIN_MAGIC: List[Union[MagicDefinitions, LazyMagicTest]] = [
+    RELAXED_ZIP_MAGIC,
+    LazyMagicTest("polyfile.zipmatcher", "RelaxedJarMatcher"),
+    NITF_MAGIC,
+    HTTP_11_MAGIC,
+    LazyMagicTest("polyfile.languagematcher", "BFMatcher"),
+    LazyMagicTest("polyfile.pickles", "DEFAULT_PICKLE_MATCHER"),
+]
+"""The magic that is added to the default matcher when it is loaded, in order"""
+
+KAITAI_MIME_MAPPING: Dict[str, str] = {
+    "image/gif": "image/gif.ksy",
+    "image/png": "image/png.ksy",
+    "image/jpeg": "image/jpeg.ksy",
+    "image/vnd.microsoft.icon": "image/ico.ksy",
+#    "image/wmf": "image/wmf.ksy",  # there is currently a problem with this parser in Python
+    "application/vnd.nitf": "image/nitf.ksy",
+    "application/vnd.tcpdump.pcap": "network/pcap.ksy",
+    "application/x-sqlite3": "database/sqlite3.ksy",
+    "application/x-rar": "archive/rar.ksy",
+    "font/sfnt": "font/ttf.ksy",
+    "application/x-pie-executable": "executable/elf.ksy",
+    "application/gzip": "archive/gzip.ksy",
+    "application/x-xar": "archive/xar.ksy",
+    "application/x-python-code": "executable/python_pyc_27.ksy",
+    "application/x-shockwave-flash": "executable/swf.ksy",
+    "application/x-doom": "game/doom_wad.ksy",
+    "image/x-dcx": "image/pcx_dcx.ksy",
+    "model/gltf-binary": "3d/gltf_binary.ksy",
+    "application/x-rpm": "archive/rpm.ksy",
+    "application/x-cpio": "archive/cpio_old_le.ksy",
+    "image/x-gimp-gbr": "image/gimp_brush.ksy",
+#    "application/dicom": "image/dicom.ksy",  # there is currently a problem with this parser in Python
+    "image/bmp": "image/bmp.ksy",
+    "application/x-blender": "media/blender_blend.ksy",
+    "audio/x-voc": "media/creative_voice_file.ksy",
+    "audio/midi": "media/standard_midi_file.ksy",
+    "application/dime": "network/dime_message.ksy",
+    "application/bson": "serialization/bson.ksy",
+    "application/x-ms-shortcut": "windows/windows_lnk_file.ksy",
+    "application/x-java-applet": "executable/java_class.ksy",
+    # Uncomment this when/if Kaitai fixes its upstream compilation bug for ICC
+# (https://github.com/kaitai-io/kaitai_struct_formats/issues/347#ref-commit-fde2866)
+#    "application/vnd.iccprofile": "image/icc_4.ksy"
+}
+
+KAITAI_RECORD_ARRAYS: Dict[str, str] = {
+    "application/vnd.tcpdump.pcap": "packets"
+}
+"""The Kaitai formats that end with an array of records that repeats until the end of the file, by MIME type, and the
+name of that array; an analysis of a file of one of these types that was appended to can be resumed"""
+
+BUILTIN_PARSERS: List[Tuple[Tuple[str, ...], str, str]] = [
+    (("application/x-nes-rom",), "polyfile.nes", "parse_ines"),
+    (("image/jp2",), "polyfile.jpeg", "parse_jpeg2000"),
+    (("application/zip", "application/java-archive"), "polyfile.zipmatcher", "parse_zip"),
+    ((HTTP_11_MIME_TYPE,), "polyfile.http.matcher", "parse_http_11"),
+    (("application/x-brainfuck",), "polyfile.languagematcher", "parse_bf"),
+    (("application/pdf",), "polyfile.pdf", "pdf_parser"),
+] + [
+    ((mimetype,), "polyfile.kaitaimatcher", f"parse_{mimetype.replace('/', '_').replace('-', '_')}")
+    for mimetype in KAITAI_MIME_MAPPING
+]
+"""The MIME types, module, and attribute of each built-in parser"""
+
+BUILTIN_RESUMERS: List[Tuple[Tuple[str, ...], str, str]] = [
+    (("text/plain",), "polyfile.polyfile", "resume_text"),
+] + [
+    ((mimetype,), "polyfile.kaitaimatcher", f"resume_{mimetype.replace('/', '_').replace('-', '_')}")
+    for mimetype in KAITAI_RECORD_ARRAYS
+]
+"""The MIME types, module, and attribute of each built-in resumer (see `polyfile.polyfile.Analyzer.resume`)"""
+
+
+def _load_builtin_magic(matcher: MagicMatcher):
+    for magic in BUILTIN_MAGIC:
+        magic.load(matcher)
+
+
+DefaultMagicMatcher.register_loader(_load_builtin_magic)
+
+for _mimetypes, _module, _attribute in BUILTIN_PARSERS:
+    register_parser(*_mimetypes)(LazyParser(_module, _attribute))
+
+for _mimetypes, _module, _attribute in BUILTIN_RESUMERS:
+    register_resumer(*_mimetypes)(LazyResumer(_module, _attribute))
+
+del _mimetypes, _module, _attribute
@@ -1,18 +1,30 @@
 from abc import ABC, abstractmethod
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import base64
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import Enum
 import hashlib
 from json import dumps
 from mimetypes import guess_extension
 from pathlib import Path
+import re
 import sys
+import threading
 from time import localtime
 import traceback
-from typing import Any, Callable, Dict, IO, Iterable, Iterator, List, Optional, Set, Tuple, Union
+from typing import Any, Callable, Dict, IO, Iterable, Iterator, List, Optional, Set, Tuple, TYPE_CHECKING, Union
 
-from .fileutils import FileStream
+from intervaltree import IntervalTree
+
+from .fileutils import DEFAULT_SPOOL_THRESHOLD, FileStream, SpooledInput
 from . import logger
 from .magic import MagicMatcher, Match as MagicMatch, MatchContext, TestResult
+from .quotas import Quota, QuotaExceeded
+
+if TYPE_CHECKING:
+    from .columnar import ColumnarSBUD
+    from .spill import MatchSpill
+    from .workers import EmbeddedScheduler, ParserPool
 
 if sys.version_info >= (3, 10):
     from importlib.metadata import version
@@ -64,6 +76,7 @@ class ParserFunctionWrapper(Parser):
 
 
 PARSERS: Dict[str, Set[Parser]] = defaultdict(set)
+_PARSERS_LOCK = threading.Lock()
 
 log = logger.getStatusLogger("polyfile")
 
@@ -72,7 +85,60 @@ class InvalidMatch(ValueError):
     pass
 
 
+class ContentsMode(Enum):
+    """How the contents of the input file are represented in SBUD output"""
+
+    EMBED = "embed"
+    """Embed the entire file, base64 encoded, in `b64contents`"""
+    REFERENCE = "reference"
+    """Replace `b64contents` with `contentsPath`, the absolute path to the input file"""
+    OMIT = "omit"
+    """Do not include the contents of the file at all"""
+
+
+SBUD_CHUNK_SIZE: int = 3 * 1024 * 1024
+"""The number of bytes hashed and encoded at a time; a multiple of three so that base64 chunks can be concatenated"""
+
+
+def hash_chunks(chunks: Iterable[bytes], on_chunk: Optional[Callable[[bytes], Any]] = None) -> Dict[str, str]:
+    """
+    Computes the MD5, SHA1, and SHA256 digests of the concatenation of `chunks`.
+
+    The three digests are computed concurrently, since hashlib releases the GIL while hashing large buffers; the next
+    chunk is read (and passed to `on_chunk`, if provided) while the previous chunk is being hashed.
+
+    """
+    hashers = {"MD5": hashlib.md5(), "SHA1": hashlib.sha1(), "SHA256": hashlib.sha256()}
+    with ThreadPoolExecutor(max_workers=len(hashers), thread_name_prefix="polyfile-hash") as executor:
+        pending: List[Future] = []
+        for chunk in chunks:
+            if on_chunk is not None:
+                on_chunk(chunk)
+            for future in pending:
+                future.result()
+            pending = [executor.submit(hasher.update, chunk) for hasher in hashers.values()]
+        for future in pending:
+            future.result()
+    return {name: hasher.hexdigest() for name, hasher in hashers.items()}
+
+
+_UNRESOLVED_EXTENSION = object()
+
+
 class Match:
+    """
+    A node in the tree of matches for a file.
+
+    Match trees can grow to millions of nodes, so matches use slots, cache their absolute offset, and keep the extent
+    of their descendants up to date as children are added rather than recomputing it on every access to `length`.
+
+    """
+
+    __slots__ = (
+        "_children", "_children_view", "name", "matcher", "match", "img_data", "decoded", "_offset",
+        "_absolute_offset", "_length", "_end", "_parent", "_display_name", "_extension"
+    )
+
     def __init__(
             self,
             name: str,
@@ -86,7 +152,17 @@ class Match:
             decoded: Optional[bytes] = None,
             extension: Optional[str] = None
     ):
+        if matcher is None and parent is not None:
+            matcher = parent.matcher
+        if matcher is None:
+            raise(ValueError("A Match must be initialized with `parent` and/or `matcher` not being None"))
+        # count the match before attaching it to its parent so that a match over the quota never enters the tree
+        matcher.quota.add_node()
         self._children: List[Match] = []
+        self._children_view: Optional[Tuple[Match, ...]] = None
+        if isinstance(name, str):
+            # the same handful of names are repeated across millions of matches, so share the strings
+            name = sys.intern(name)
         self.name: str = name
         self.matcher: Optional[Matcher] = None
         self.match = match_obj
@@ -94,30 +170,63 @@ class Match:
         self.decoded: Optional[bytes] = decoded
         self._offset: int = relative_offset
         self._length: Optional[int] = length
+        self._end: Optional[int] = None
+        """For matches without a fixed length, the maximum end offset of all of their children"""
         self._parent: Optional[Match] = parent
         if parent is not None:
             if not isinstance(parent, Match):
                 raise ValueError("The parent must be an instance of a Match")
-            parent._children.append(self)
-            if matcher is None:
-                matcher = parent.matcher
-        if matcher is None:
-            raise(ValueError("A Match must be initialized with `parent` and/or `matcher` not being None"))
-        self.matcher = matcher
-        if display_name is None:
-            self.display_name: str = name
+            self._absolute_offset: int = parent._absolute_offset + relative_offset
+            parent._add_child(self)
         else:
-            self.display_name = display_name
-        self.extension: Optional[str] = extension
+            self._absolute_offset = relative_offset
+        self.matcher = matcher
+        self._display_name: Optional[str] = display_name
         if extension is None:
-            self.extension = guess_extension(self.name)
-            if self.extension is not None and self.extension.startswith("."):
+            self._extension: Any = _UNRESOLVED_EXTENSION
+        else:
+            self._extension = extension
+
+    def _add_child(self, child: "Match"):
+        self._children.append(child)
+        self._children_view = None
+        # propagate the child's end offset up through all of the ancestors whose lengths depend on their children
+        end = child._absolute_offset + child.length
+        match: Optional[Match] = self
+        while match is not None and match._length is None and (match._end is None or end > match._end):
+            match._end = end
+            end = match._absolute_offset + match.length
+            match = match._parent
+
+    @property
+    def display_name(self) -> str:
+        if self._display_name is None:
+            return self.name
+        return self._display_name
+
+    @display_name.setter
+    def display_name(self, new_name: str):
+        self._display_name = new_name
+
+    @property
+    def extension(self) -> Optional[str]:
+        if self._extension is _UNRESOLVED_EXTENSION:
+            extension = guess_extension(self.name)
+            if extension is not None and extension.startswith("."):
                 # guess_extension adds a leading dot
-                self.extension = self.extension[1:]
+                extension = extension[1:]
+            self._extension = extension
+        return self._extension
+
+    @extension.setter
+    def extension(self, new_extension: Optional[str]):
+        self._extension = new_extension
 
     @property
     def children(self) -> Tuple["Match", ...]:
-        return tuple(self._children)
+        if self._children_view is None:
+            self._children_view = tuple(self._children)
+        return self._children_view
 
     def __len__(self):
         return len(self._children)
@@ -135,17 +244,25 @@ class Match:
     @property
     def offset(self) -> int:
         """The global offset of this match with respect to the original file"""
-        if self.parent is not None:
-            return self.parent.offset + self.relative_offset
-        else:
-            return self.relative_offset
+        return self._absolute_offset
 
     @property
     def root(self) -> "Match":
-        if self.parent is None:
-            return self
-        else:
-            return self.parent.root
+        root = self
+        while root._parent is not None:
+            root = root._parent
+        return root
+
+    @property
+    def embedding_depth(self) -> int:
+        """The number of files this match is embedded in: zero for a top-level match and for all of its submatches"""
+        depth = 0
+        match: Optional[Match] = self
+        while match._parent is not None:
+            if not isinstance(match, Submatch):
+                depth += 1
+            match = match._parent
+        return depth
 
     @property
     def root_offset(self) -> int:
@@ -160,10 +277,9 @@ class Match:
     def length(self) -> int:
         """The number of bytes in the match"""
         if self._length is None:
-            if self._children:
-                return max(c.offset + c.length for c in self._children) - self.offset
-            else:
+            if self._end is None:
                 return 0
+            return self._end - self._absolute_offset
         return self._length
 
     def to_obj(self):
@@ -176,13 +292,31 @@ class Match:
             'value': str(self.match),
             'subEls': [c.to_obj() for c in self]
         }
+        self._add_optional_fields(ret)
+        return ret
+
+    def to_event(self, match_id: int, parent_id: Optional[int]) -> Dict[str, Any]:
+        """Returns a flat representation of this match, without its children, for streaming output"""
+        ret = {
+            'id': match_id,
+            'parent': parent_id,
+            'relative_offset': self.relative_offset,
+            'offset': self.offset,
+            'size': self.length,
+            'type': self.name,
+            'name': self.display_name,
+            'value': str(self.match)
+        }
+        self._add_optional_fields(ret)
+        return ret
+
+    def _add_optional_fields(self, obj: Dict[str, Any]):
         if self.img_data is not None:
-            ret['img_data'] = self.img_data
+            obj['img_data'] = self.img_data
         if self.decoded is not None:
-            ret['decoded'] = base64.b64encode(self.decoded).decode('utf-8')
+            obj['decoded'] = base64.b64encode(self.decoded).decode('utf-8')
         if self.extension is not None:
-            ret['extension'] = self.extension
-        return ret
+            obj['extension'] = self.extension
 
     def json(self) -> str:
         return dumps(self.to_obj())
@@ -195,33 +329,426 @@ class Match:
 
 
 class Submatch(Match):
-    pass
+    __slots__ = ()
+
+
+MatchEventCallback = Callable[[Dict[str, Any]], Any]
+
+
+class _ReleasedChildren(list):
+    """Replaces the children of a match released by a `MatchStream`, so that a match added to it later can find its id"""
+
+    __slots__ = ("stream", "node_id")
+
+    def __init__(self, stream: "MatchStream", node_id: int):
+        super().__init__()
+        self.stream: MatchStream = stream
+        self.node_id: int = node_id
+
+
+class MatchStream:
+    """
+    Reports matches as flat events, one per `Match` or `Submatch`, as soon as they are found.
+
+    Each match is assigned a stable integer id, in the order in which the matches are added, and its event (see
+    `Match.to_event`) references the id of its parent. A match with a fixed length is reported as soon as it is added;
+    a match whose length depends on its children is reported once its subtree is complete, i.e., once a match outside
+    of its subtree is added or the stream is closed. Events are therefore not necessarily in pre-order.
+
+    If `release` is True, the children of a match are detached from it once its subtree has been reported, so that the
+    memory used by the tree stays bounded by the matches that are still open. A match that a parser adds to a subtree
+    that was already reported is reported on its own, referencing the id of its parent.
+
+    """
+    def __init__(self, callback: MatchEventCallback, release: bool = False):
+        self.callback: MatchEventCallback = callback
+        self.release: bool = release
+        self._ids: Dict[Match, int] = {}
+        self._open: List[Match] = []
+        self._open_set: Set[Match] = set()
+        self._reported: Set[Match] = set()
+        self._next_id: int = 0
+
+    def _id(self, match: Match) -> int:
+        node_id = self._known_id(match)
+        if node_id is None:
+            node_id = self._next_id
+            self._next_id += 1
+            self._ids[match] = node_id
+        return node_id
+
+    def _known_id(self, match: Match) -> Optional[int]:
+        """The id already assigned to `match`, if any, including if it was released"""
+        node_id = self._ids.get(match)
+        if node_id is None and isinstance(match._children, _ReleasedChildren) and match._children.stream is self:
+            node_id = match._children.node_id
+        return node_id
+
+    def _report(self, match: Match):
+        if match.parent is None:
+            parent_id: Optional[int] = None
+        else:
+            parent_id = self._id(match.parent)
+        self.callback(match.to_event(self._id(match), parent_id))
+
+    def _release(self, match: Match):
+        """Detaches the children of a match that was reported, keeping its id in case more children are added to it"""
+        # freeze the length before detaching the children it may depend on
+        match._length = match.length
+        match._children = _ReleasedChildren(self, self._ids.pop(match))
+        match._children_view = None
+
+    def _close(self, match: Match):
+        self._open_set.discard(match)
+        if match in self._reported:
+            self._reported.remove(match)
+        else:
+            self._report(match)
+        if self.release:
+            self._release(match)
+
+    def add(self, match: Match):
+        parent = match.parent
+        if parent is not None and parent not in self._open_set:
+            if self._known_id(parent) is None:
+                # parsers sometimes create intermediate matches that they never yield, so add the parent first
+                self.add(parent)
+            if parent not in self._open_set:
+                # the parent's subtree was already closed, so just report this match on its own
+                self._report(match)
+                if self.release:
+                    if isinstance(parent._children, _ReleasedChildren):
+                        del parent._children[:]
+                    self._release(match)
+                return
+        while self._open and self._open[-1] is not parent:
+            self._close(self._open.pop())
+        self._id(match)
+        self._open.append(match)
+        self._open_set.add(match)
+        if match._length is not None:
+            self._report(match)
+            self._reported.add(match)
+
+    def add_tree(self, match: Match):
+        """Adds a match and all of its descendants"""
+        stack = [match]
+        while stack:
+            m = stack.pop()
+            self.add(m)
+            stack.extend(reversed(m._children))
+
+    def close(self):
+        while self._open:
+            self._close(self._open.pop())
+
+    def __enter__(self) -> "MatchStream":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class MatchIndex:
+    """
+    An interval tree of matches, keyed by the range of bytes that each one covers in the original file.
+
+    Point and range queries take time logarithmic in the number of matches (plus the number of results), rather than a
+    walk of the entire match tree. Their results are sorted by offset, and then from the outermost match inward.
+    Matches of length zero cover no bytes, so they are not indexed.
+
+    A match's length can depend on its children, so a match should only be added once its subtree is complete.
+
+    """
+    def __init__(self, matches: Iterable[Match] = ()):
+        self._tree: IntervalTree = IntervalTree()
+        self._num_added: int = 0
+        for match in matches:
+            self.add_tree(match)
+
+    def add(self, match: Match):
+        length = match.length
+        if length > 0:
+            # the order in which the matches were added breaks ties between a match and a child of the same extent
+            self._tree.addi(match.offset, match.offset + length, (self._num_added, match))
+            self._num_added += 1
+
+    def add_tree(self, match: Match):
+        """Adds a match and all of its descendants"""
+        stack = [match]
+        while stack:
+            m = stack.pop()
+            self.add(m)
+            stack.extend(reversed(m._children))
+
+    def __len__(self):
+        return len(self._tree)
+
+    @staticmethod
+    def _sorted(intervals) -> List[Match]:
+        return [
+            interval.data[1] for interval in sorted(intervals, key=lambda i: (i.begin, -i.end, i.data[0]))
+        ]
+
+    def at(self, offset: int) -> List[Match]:
+        """The matches that contain the byte at `offset`"""
+        return self._sorted(self._tree.at(offset))
+
+    def overlapping(self, begin: int, end: int) -> List[Match]:
+        """The matches that contain at least one byte in the range [`begin`, `end`)"""
+        return self._sorted(self._tree.overlap(begin, end))
+
+    def within(self, begin: int, end: int) -> List[Match]:
+        """The matches that are entirely contained in the range [`begin`, `end`)"""
+        return self._sorted(self._tree.envelop(begin, end))
+
+
+DEFAULT_BLOB_CACHE_NODES: int = 65536
+"""The total number of matches in the trees that a `BlobCache` remembers by default"""
+
+
+class _CachedBlob:
+    """The relocatable match tree of an embedded blob: every node stored relative to its parent, in pre-order"""
+
+    __slots__ = ("nodes", "yielded", "decompressed_bytes")
+
+    def __init__(self, nodes: List[Tuple[Any, ...]], yielded: List[int], decompressed_bytes: int):
+        self.nodes: List[Tuple[Any, ...]] = nodes
+        """(parent index or -1, is embedded, name, value, relative offset, fixed length, display name, image data,
+        decoded data, extension)"""
+        self.yielded: List[int] = yielded
+        """The indexes of the nodes that were yielded, in the order in which they were yielded"""
+        self.decompressed_bytes: int = decompressed_bytes
+
+    @staticmethod
+    def capture(
+            parent: Match, first_child: int, yielded: List[Match], decompressed_bytes: int, max_nodes: int
+    ) -> Optional["_CachedBlob"]:
+        """
+        Captures the children of `parent` from index `first_child` on.
+
+        Returns None if they are incomplete or if there are more than `max_nodes` of them.
+
+        """
+        nodes: List[Tuple[Any, ...]] = []
+        indexes: Dict[int, int] = {}
+        stack: List[Tuple[int, Match]] = [(-1, child) for child in reversed(parent._children[first_child:])]
+        while stack:
+            if len(nodes) >= max_nodes:
+                return None
+            parent_index, match = stack.pop()
+            indexes[id(match)] = len(nodes)
+            stack.extend((len(nodes), child) for child in reversed(match._children))
+            nodes.append((
+                parent_index, not isinstance(match, Submatch), match.name, match.match, match._offset, match._length,
+                match._display_name, match.img_data, match.decoded, match._extension
+            ))
+        try:
+            yielded_indexes = [indexes[id(match)] for match in yielded]
+        except KeyError:
+            # part of the tree was detached (e.g., by a `MatchStream` that releases reported matches)
+            return None
+        return _CachedBlob(nodes, yielded_indexes, decompressed_bytes)
+
+    def fits(self, quota: Quota) -> bool:
+        """Whether grafting this tree would stay within `quota`, and therefore match analyzing the blob again"""
+        remaining_nodes = quota.remaining_nodes
+        if remaining_nodes is not None and len(self.nodes) > remaining_nodes:
+            return False
+        remaining = quota.remaining_decompressed_bytes
+        return remaining is None or self.decompressed_bytes <= remaining
+
+    def graft(self, parent: Match) -> List[Match]:
+        """Copies this tree under `parent`, returning the copies of the matches that were originally yielded"""
+        matches: List[Match] = []
+        for parent_index, embedded, name, value, offset, length, display_name, img_data, decoded, extension \
+                in self.nodes:
+            if embedded:
+                match_type = Match
+            else:
+                match_type = Submatch
+            match = match_type(
+                name, value, offset, length=length, parent=parent if parent_index < 0 else matches[parent_index],
+                display_name=display_name, img_data=img_data, decoded=decoded
+            )
+            match._extension = extension
+            matches.append(match)
+        parent.matcher.quota.account_decompressed(self.decompressed_bytes)
+        return [matches[index] for index in self.yielded]
+
+
+class BlobCache:
+    """
+    Remembers the match trees of embedded blobs so that identical copies are only analyzed once per run.
+
+    Archives and documents often embed many identical objects, such as the same font in every page of a PDF or the
+    same icon in many members of an archive. The first time a blob is matched, its tree is stored relative to its
+    parent, keyed by a hash of its bytes and of the matcher's configuration; every later copy gets a copy of that tree
+    grafted at its own offset instead of being analyzed again.
+
+    A tree is only reused if the original analysis completed without reaching any limit of the quota and reusing it
+    would not exceed the quota either, so the resulting tree is the same as if every copy were analyzed.
+
+    The remembered trees keep their values and decoded data alive, so the cache is bounded by the total number of
+    matches in them: the least recently used trees are evicted once there are more than `max_nodes`, and a tree that
+    is larger than that on its own is not remembered at all.
+
+    """
+    def __init__(self, max_nodes: int = DEFAULT_BLOB_CACHE_NODES):
+        self.max_nodes: int = max_nodes
+        self.nodes: int = 0
+        """The total number of matches in the remembered trees"""
+        self._entries: "OrderedDict[Tuple[Any, ...], _CachedBlob]" = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(data: Union[bytes, FileStream], matcher: "Matcher", parent: Match) -> Tuple[Any, ...]:
+        if isinstance(data, FileStream):
+            data = data.content
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        if matcher.quota.max_depth is not None:
+            # how deep the blob's own embedded content may be matched depends on where it is embedded
+            depth: Optional[int] = parent.embedding_depth
+        else:
+            depth = None
+        return digest, len(data), depth, matcher.parse, matcher.try_all_offsets, id(matcher.magic_matcher)
+
+    def get(self, key: Tuple[Any, ...], quota: Quota) -> Optional[_CachedBlob]:
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is None or not cached.fits(quota):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return cached
+
+    def record(
+            self, key: Tuple[Any, ...], matches: Iterable[Match], parent: Match, matcher: "Matcher"
+    ) -> Iterator[Match]:
+        """Yields `matches`, the matches of a blob embedded under `parent`, and remembers their tree once complete"""
+        quota = matcher.quota
+        first_child = len(parent)
+        limits_reached = len(quota.limits_reached)
+        decompressed_bytes = quota.decompressed_bytes
+        if matcher.scheduler is not None:
+            pending: int = matcher.scheduler.pending(parent.root)
+        yielded: List[Match] = []
+        for match in matches:
+            yielded.append(match)
+            yield match
+        if len(quota.limits_reached) != limits_reached:
+            # the tree is truncated
+            return
+        if matcher.scheduler is not None and matcher.scheduler.pending(parent.root) != pending:
+            # some of the tree will only be grafted once the top-level match has been parsed
+            return
+        cached = _CachedBlob.capture(
+            parent, first_child, yielded, quota.decompressed_bytes - decompressed_bytes, max_nodes=self.max_nodes
+        )
+        if cached is None:
+            return
+        with self._lock:
+            replaced = self._entries.pop(key, None)
+            if replaced is not None:
+                self.nodes -= len(replaced.nodes)
+            self._entries[key] = cached
+            self.nodes += len(cached.nodes)
+            while self.nodes > self.max_nodes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nodes -= len(evicted.nodes)
 
 
 def register_parser(*filetypes: str) -> Callable[[Union[Parser, ParserFunction]], Parser]:
     def wrapper(parser: Union[Parser, ParserFunction]) -> Parser:
         if not isinstance(parser, Parser):
             parser = ParserFunctionWrapper(parser)
-        for ft in filetypes:
-            PARSERS[ft].add(parser)
+        with _PARSERS_LOCK:
+            for ft in filetypes:
+                # replace the set rather than mutating it so that concurrent matchers iterating over the old set
+                # are unaffected
+                PARSERS[ft] = PARSERS.get(ft, set()) | {parser}
         return parser
     return wrapper
 
 
+ResumerFunction = Callable[[FileStream, "Match", int], bool]
+"""
+Extends the complete match tree of a file that has grown since it was analyzed (see `Analyzer.resume`).
+
+A resumer is called with a stream of the grown file starting at the offset of a top-level match, the top-level match
+rebuilt from the earlier analysis, and the previous length of the match. It parses only the new data, adding to the
+tree so that it is the same as if the grown file had been analyzed from scratch, and returns True. If the new data
+cannot be parsed that way (e.g., because the file was not simply appended to), it returns False, and the file is
+analyzed from scratch instead.
+
+"""
+
+RESUMERS: Dict[str, ResumerFunction] = {}
+
+
+def register_resumer(*filetypes: str) -> Callable[[ResumerFunction], ResumerFunction]:
+    def wrapper(resumer: ResumerFunction) -> ResumerFunction:
+        with _PARSERS_LOCK:
+            for ft in filetypes:
+                RESUMERS[ft] = resumer
+        return resumer
+    return wrapper
+
+
+_ASCII_TEXT = re.compile(rb"[\x07-\x0d\x1b\x20-\x7e]*")
+"""The bytes that libmagic classifies as ASCII text"""
+
+
+def resume_text(stream: FileStream, match: "Match", previous_length: int) -> bool:
+    """Extends a plain text match over appended lines, as long as they are ASCII text"""
+    if len(match) or match.length != previous_length:
+        return False
+    stream.seek(previous_length)
+    if _ASCII_TEXT.fullmatch(stream.read()) is None:
+        return False
+    match._length = len(stream)
+    return True
+
+
 class Matcher:
-    def __init__(self, try_all_offsets: bool = False, parse: bool = True, matcher: Optional[MagicMatcher] = None):
+    def __init__(
+            self,
+            try_all_offsets: bool = False,
+            parse: bool = True,
+            matcher: Optional[MagicMatcher] = None,
+            quota: Optional[Quota] = None,
+            parser_pool: Optional["ParserPool"] = None,
+            scheduler: Optional["EmbeddedScheduler"] = None,
+            deduplicate: bool = False
+    ):
         if matcher is None:
             self.magic_matcher: MagicMatcher = MagicMatcher.DEFAULT_INSTANCE
         else:
             self.magic_matcher = matcher
         self.try_all_offsets: bool = try_all_offsets
         self.parse: bool = parse
+        if quota is None:
+            quota = Quota()
+        self.quota: Quota = quota
+        """The resource limits shared by this matcher and every parser it invokes"""
+        self.parser_pool: Optional[ParserPool] = parser_pool
+        """If not None, parsers are run out of process in this pool's workers"""
+        self.scheduler: Optional[EmbeddedScheduler] = scheduler
+        """If not None, embedded content is matched concurrently by this scheduler"""
+        self.blob_cache: Optional[BlobCache] = BlobCache() if deduplicate else None
+        """If not None, identical embedded blobs are only analyzed once (see `BlobCache`)"""
 
     def handle_mimetype(
             self, mimetype: str,
             match_obj: TestResult,
             data: bytes,
-            file_stream: Union[str, Path, IO, FileStream],
+            file_stream: Union[str, Path, IO, FileStream, bytes],
             parent: Optional[Match] = None,
             offset: int = 0,
             length: Optional[int] = None
@@ -244,12 +771,15 @@ class Matcher:
         )
         yield m
         if self.parse:
-            for parser in PARSERS[mimetype]:
+            for parser in PARSERS.get(mimetype, ()):
                 # Don't yield this custom match until we've tried its submatch function
                 # (which may throw an InvalidMatch, meaning that this match is invalid)
                 try:
                     with FileStream(file_stream, start=offset, length=length) as fs:
-                        submatch_iter = parser(fs, m)
+                        if self.parser_pool is None:
+                            submatch_iter = parser(fs, m)
+                        else:
+                            submatch_iter = self.parser_pool.parse(parser, mimetype, data, m, offset, length)
                         try:
                             first_submatch = next(submatch_iter)
                             has_first = True
@@ -260,9 +790,16 @@ class Matcher:
                             yield from submatch_iter
                 except InvalidMatch:
                     pass
+                except QuotaExceeded:
+                    # the quota has already been recorded and logged, so just stop parsing
+                    return
                 except Exception as e:
+                    if isinstance(file_stream, bytes):
+                        source = f"{len(file_stream)} bytes of embedded data"
+                    else:
+                        source = str(file_stream)
                     log.warning(f"Parser {parser!s} for MIME type {mimetype} raised an exception while "
-                                f"parsing {match_obj!s} in {file_stream!s}: {e!s}")
+                                f"parsing {match_obj!s} in {source}: {e!s}")
                     if log.isEnabledFor(logger.logging.DEBUG):
                         traceback.print_exc()
 
@@ -273,11 +810,82 @@ class Matcher:
             context = MatchContext.load(f, only_match_mime=False)
             yield from self.magic_matcher.match(context)
 
-    def match(self, file_stream: Union[str, Path, IO, FileStream], parent: Optional[Match] = None) -> Iterator[Match]:
-        with FileStream(file_stream) as f:
-            matched_mimetypes: Set[str] = set()
-            context = MatchContext.load(f, only_match_mime=True)
-            for magic_match in self.magic_matcher.match(context):
+    def match(
+            self,
+            file_stream: Union[str, Path, IO, FileStream, bytes, bytearray, memoryview],
+            parent: Optional[Match] = None
+    ) -> Iterator[Match]:
+        """
+        Yields all matches for the given file, stream, or in-memory data.
+
+        Parsers recursing into embedded content should pass the embedded bytes (or a `FileStream` slice) directly
+        rather than writing them to a temporary file. Embedded content (i.e., when `parent` is not None) is never
+        considered executable.
+
+        Embedded content that would exceed this matcher's `quota` for recursion depth or embedded blob size is not
+        matched. If this matcher has a `scheduler`, embedded bytes may instead be matched concurrently, in which case
+        their matches are yielded once the parsers of the top-level match have finished.
+
+        """
+        if parent is not None:
+            executable: Optional[bool] = False
+        else:
+            executable = None
+        if isinstance(file_stream, (bytes, bytearray, memoryview)) and type(file_stream) is not bytes:
+            file_stream = bytes(file_stream)
+        if parent is not None:
+            if isinstance(file_stream, (bytes, FileStream)):
+                size = len(file_stream)
+            else:
+                with FileStream(file_stream) as f:
+                    size = len(f)
+            if not self.quota.allows_embedded(depth=parent.embedding_depth + 1, size=size):
+                return
+            if self.blob_cache is not None and isinstance(file_stream, (bytes, FileStream)):
+                cache_key: Optional[Tuple[Any, ...]] = self.blob_cache.key(file_stream, self, parent)
+                cached = self.blob_cache.get(cache_key, self.quota)
+                if cached is not None:
+                    yield from cached.graft(parent)
+                    return
+            else:
+                cache_key = None
+            if self.scheduler is not None and isinstance(file_stream, bytes) \
+                    and self.scheduler.submit(file_stream, parent):
+                return
+        else:
+            cache_key = None
+        if isinstance(file_stream, bytes):
+            context = MatchContext(file_stream, only_match_mime=True, executable=False)
+        else:
+            with FileStream(file_stream) as f:
+                if isinstance(file_stream, FileStream):
+                    # the slice may not start at the underlying stream's current position
+                    context = MatchContext(bytes(f), only_match_mime=True, executable=executable)
+                else:
+                    context = MatchContext.load(f, only_match_mime=True)
+                    context.executable = executable
+        matches = self.match_magic(self.magic_matcher.match(context), context, file_stream, parent)
+        if cache_key is not None:
+            matches = self.blob_cache.record(cache_key, matches, parent, self)
+        yield from matches
+
+    def match_magic(
+            self,
+            magic_matches: Iterable[MagicMatch],
+            context: MatchContext,
+            file_stream: Union[str, Path, IO, FileStream, bytes],
+            parent: Optional[Match] = None
+    ) -> Iterator[Match]:
+        """
+        Yields the matches resulting from magic matches that were already computed over `context`.
+
+        If `try_all_offsets` is True and `parent` is None, this is followed by the matches for files carved from
+        nonzero offsets of `context` (see `carve`).
+
+        """
+        matched_mimetypes: Set[str] = set()
+        try:
+            for magic_match in magic_matches:
                 for result in magic_match:
                     if result.test.mime is None:
                         continue
@@ -285,21 +893,148 @@ class Matcher:
                     if mimetype in matched_mimetypes:
                         continue
                     matched_mimetypes.add(mimetype)
-                    yield from self.handle_mimetype(mimetype, result, context.data, file_stream, parent)
+                    yield from self._handle_mimetype(mimetype, result, context.data, file_stream, parent)
+            if parent is None and self.try_all_offsets:
+                yield from self._carve(context, file_stream)
+        except QuotaExceeded:
+            return
+
+    def carve(self, context: MatchContext, file_stream: Union[str, Path, IO, FileStream, bytes]) -> Iterator[Match]:
+        """
+        Yields top-level matches for the files embedded at nonzero offsets of `context`, such as in a firmware image.
+
+        Only the level zero magic tests whose signature occurs at an offset are run there (see `MagicMatcher.carve`).
+
+        """
+        try:
+            yield from self._carve(context, file_stream)
+        except QuotaExceeded:
+            return
+
+    def _carve(self, context: MatchContext, file_stream: Union[str, Path, IO, FileStream, bytes]) -> Iterator[Match]:
+        matched: Set[Tuple[int, str]] = set()
+        for offset, magic_match in self.magic_matcher.carve(context):
+            for result in magic_match:
+                if result.test.mime is None:
+                    continue
+                mimetype = result.test.mime.resolve(magic_match.context)
+                if (offset, mimetype) in matched:
+                    continue
+                matched.add((offset, mimetype))
+                yield from self._handle_mimetype(mimetype, result, context.data, file_stream, offset=offset)
+
+    def _handle_mimetype(
+            self,
+            mimetype: str,
+            match_obj: TestResult,
+            data: bytes,
+            file_stream: Union[str, Path, IO, FileStream, bytes],
+            parent: Optional[Match] = None,
+            offset: int = 0
+    ) -> Iterator[Match]:
+        """Like `handle_mimetype`, but also grafts the results of the `scheduler` into new top-level matches"""
+        if parent is not None or self.scheduler is None:
+            yield from self.handle_mimetype(mimetype, match_obj, data, file_stream, parent, offset=offset)
+            return
+        # the first match from `handle_mimetype` is always the new top-level match
+        root: Optional[Match] = None
+        try:
+            for match in self.handle_mimetype(mimetype, match_obj, data, file_stream, parent, offset=offset):
+                if root is None:
+                    root = match
+                yield match
+            if root is not None:
+                yield from self.scheduler.graft(root)
+        finally:
+            if root is not None:
+                self.scheduler.discard(root)
+
+
+class _MagicPass:
+    """The matches of a pass of the magic matcher, computed as they are first needed and shared by every caller"""
+
+    __slots__ = ("matches", "iterator")
+
+    def __init__(self, iterator: Iterator[MagicMatch]):
+        self.matches: List[MagicMatch] = []
+        self.iterator: Optional[Iterator[MagicMatch]] = iterator
+        """The rest of the pass, or None once it is exhausted"""
 
 
 class Analyzer:
-    def __init__(self, path: Union[str, Path], try_all_offsets: bool = False, parse: bool = True,
-                 magic_matcher: Optional[MagicMatcher] = None):
-        self.path: Union[str, Path] = path
+    """
+    Analyzes a single file.
+
+    All of the analyses (`magic_matches`, `mime_types`, `matches`, and `sbud`) share a single `MatchContext`.
+    `mime_types`, `matches`, and `sbud` also share a single pass of the magic matcher that skips the tests that cannot
+    produce a MIME type. `magic_matches` reports every match, so the first time it is iterated, it starts a second,
+    full pass; if `only_match_mime` is True, it instead only reports the matches of the shared pass that have a MIME
+    type.
+
+    The input can be a path, bytes-like, or a binary stream (including a non-seekable pipe like STDIN); inputs other
+    than paths are buffered in memory, or spilled to disk if they are larger than `spool_threshold` bytes (see
+    `polyfile.fileutils.SpooledInput`), and are reported as `name`.
+
+    The resource limits in `quota` apply to the parsing of the whole file; the limits that were reached are reported
+    in the SBUD output. If `parser_pool` is not None, parsers are run out of process in its workers (see
+    `polyfile.workers.ParserPool`), and if `scheduler` is not None, embedded content is matched concurrently (see
+    `polyfile.workers.EmbeddedScheduler`). If `deduplicate` is True, identical embedded blobs are only analyzed once
+    (see `BlobCache`), at the cost of keeping their match trees in memory.
+
+    If `max_nodes_in_memory` is not None, the parts of the match tree that are complete are spilled to a temporary file
+    on disk once it grows to more than that many matches, and once matching has finished, the top-level matches are
+    replaced by `polyfile.spill.StoredMatch`es that read their descendants back from disk as they are traversed (see
+    `polyfile.spill.MatchSpill`); `write_sbud` can then output the tree without loading it into memory. Spilling
+    requires the matches to be found in order, so it cannot be combined with a `scheduler`.
+
+    """
+    def __init__(self, path: Union[str, Path, bytes, bytearray, memoryview, IO[bytes], SpooledInput],
+                 try_all_offsets: bool = False, parse: bool = True,
+                 magic_matcher: Optional[MagicMatcher] = None, only_match_mime: bool = False,
+                 quota: Optional[Quota] = None, parser_pool: Optional["ParserPool"] = None,
+                 scheduler: Optional["EmbeddedScheduler"] = None, name: Optional[str] = None,
+                 spool_threshold: int = DEFAULT_SPOOL_THRESHOLD, max_nodes_in_memory: Optional[int] = None,
+                 deduplicate: bool = False):
+        if max_nodes_in_memory is not None and scheduler is not None:
+            raise ValueError("The match tree cannot be spilled to disk while embedded files are matched concurrently")
+        if isinstance(path, (str, Path)):
+            self.path: Optional[Union[str, Path]] = path
+            """The path of the input file, or None if the input is not a file"""
+            self._input: Optional[SpooledInput] = None
+            if name is None:
+                name = str(path)
+        else:
+            self.path = None
+            if isinstance(path, SpooledInput):
+                self._input = path
+            else:
+                self._input = SpooledInput(path, max_memory=spool_threshold)
+            if name is None:
+                name = getattr(path, "name", None)
+                if not isinstance(name, str):
+                    name = "-"
+        self.name: str = name
         self.try_all_offsets: bool = try_all_offsets
         self.parse: bool = parse
+        self.only_match_mime: bool = only_match_mime
+        if quota is None:
+            quota = Quota()
+        self.quota: Quota = quota
+        self.parser_pool: Optional[ParserPool] = parser_pool
+        self.scheduler: Optional[EmbeddedScheduler] = scheduler
+        self.max_nodes_in_memory: Optional[int] = max_nodes_in_memory
+        self.deduplicate: bool = deduplicate
+        self._spill: Optional[MatchSpill] = None
         self._magic_matcher: Optional[MagicMatcher] = magic_matcher
+        self._context: Optional[MatchContext] = None
         self._matcher: Optional[Matcher] = None
         self._matches: Optional[List[Match]] = None
         self._match_iterator: Optional[Iterator[Match]] = None
-        self._magic_matches: Optional[List[MagicMatch]] = None
-        self._magic_match_iterator: Optional[Iterator[MagicMatch]] = None
+        self._mime_pass: Optional[_MagicPass] = None
+        self._full_pass: Optional[_MagicPass] = None
+        self._index: Optional[MatchIndex] = None
+        self._lock: threading.RLock = threading.RLock()
+        """Guards the lazily computed matches so that an Analyzer can be shared between threads"""
 
     @property
     def magic_matcher(self) -> MagicMatcher:
@@ -308,97 +1043,368 @@ class Analyzer:
         else:
             return self._magic_matcher
 
+    @property
+    def file_stream(self) -> Union[str, Path, bytes, IO[bytes]]:
+        """The input in a form that can be wrapped in a `FileStream`"""
+        if self._input is None:
+            return self.path
+        return self._input.stream
+
+    def close(self):
+        """Releases the buffered input and the spilled matches, if any; the analyzer cannot be used afterward"""
+        if self._input is not None:
+            self._input.close()
+        if self._spill is not None:
+            self._spill.close()
+
+    @property
+    def context(self) -> MatchContext:
+        """The match context shared by all of this analyzer's analyses, which only matches tests with a MIME type"""
+        with self._lock:
+            if self._context is None:
+                if self._input is None:
+                    self._context = MatchContext.load(self.path, only_match_mime=True)
+                else:
+                    # data without a path cannot be an executable file
+                    self._context = MatchContext(self._input.data, only_match_mime=True, executable=False)
+            return self._context
+
+    def _magic_pass(self, full: bool) -> Iterator[MagicMatch]:
+        """Yields the matches of the MIME-only or the full magic pass, advancing the shared pass as needed"""
+        index = 0
+        while True:
+            with self._lock:
+                magic_pass = self._full_pass if full else self._mime_pass
+                if magic_pass is None:
+                    context = self.context
+                    if full:
+                        # the memoized evaluations depend on whether only tests with a MIME type are matched, so the
+                        # full pass needs its own context (over the same data)
+                        context = MatchContext(
+                            context.data, context.path, only_match_mime=False, executable=context.executable
+                        )
+                        magic_pass = self._full_pass = _MagicPass(iter(self.magic_matcher.match(context)))
+                    else:
+                        magic_pass = self._mime_pass = _MagicPass(iter(self.magic_matcher.match(context)))
+                if index < len(magic_pass.matches):
+                    match: Optional[MagicMatch] = magic_pass.matches[index]
+                elif magic_pass.iterator is None:
+                    match = None
+                else:
+                    try:
+                        match = next(magic_pass.iterator)
+                        magic_pass.matches.append(match)
+                    except StopIteration:
+                        magic_pass.iterator = None
+                        match = None
+            if match is None:
+                break
+            index += 1
+            yield match
+
+    def mime_matches(self) -> Iterator[MagicMatch]:
+        """Yields the magic matches that have at least one MIME type"""
+        for match in self._magic_pass(full=False):
+            if any(True for _ in match.mimetypes):
+                yield match
+
     def mime_types(self) -> Iterator[Tuple[str, MagicMatch]]:
         mimetypes: Dict[str, Set[str]] = {}
-        with open(self.path, "rb") as f:
-            for match in self.magic_matcher.match(MatchContext.load(f, only_match_mime=True)):
-                for mimetype in match.mimetypes:
-                    match_text = str(match)
-                    if mimetype not in mimetypes:
-                        mimetypes[mimetype] = set()
-                    if match_text not in mimetypes[mimetype]:
-                        yield mimetype, match
-                        mimetypes[mimetype].add(match_text)
+        for match in self.mime_matches():
+            for mimetype in match.mimetypes:
+                match_text = str(match)
+                if mimetype not in mimetypes:
+                    mimetypes[mimetype] = set()
+                if match_text not in mimetypes[mimetype]:
+                    yield mimetype, match
+                    mimetypes[mimetype].add(match_text)
 
     @property
     def matcher(self) -> Matcher:
-        if self._matcher is None:
-            self._matcher = Matcher(parse=self.parse, matcher=self.magic_matcher)
-        return self._matcher
+        with self._lock:
+            if self._matcher is None:
+                self._matcher = Matcher(
+                    try_all_offsets=self.try_all_offsets, parse=self.parse, matcher=self.magic_matcher, quota=self.quota, parser_pool=self.parser_pool,
+                    scheduler=self.scheduler,
+                    # a cached blob is captured from its parent's children, which might since have been spilled
+                    deduplicate=self.deduplicate and self.max_nodes_in_memory is None
+                )
+            return self._matcher
 
     @property
     def matches_so_far(self) -> List[Match]:
         return self._matches
 
     @property
-    def magic_matches_so_far(self) -> List[MagicMatch]:
-        return self._magic_matches
+    def magic_matches_so_far(self) -> Optional[List[MagicMatch]]:
+        if self.only_match_mime:
+            magic_pass = self._mime_pass
+        else:
+            magic_pass = self._full_pass
+        if magic_pass is None:
+            return None
+        return magic_pass.matches
 
-    def matches(self) -> Iterator[Match]:
-        if self._matches is None or self._match_iterator is not None:
-            if self._matches is None:
-                self._matches = []
-                self._match_iterator = iter(self.matcher.match(self.path))
+    def _next_match(self) -> Optional[Match]:
+        """Advances the match iterator to the next top-level match, returning None once it is exhausted"""
+        while True:
+            try:
+                match = next(self._match_iterator)
+            except StopIteration:
+                self._match_iterator = None
+                self._finish_spill()
+                return None
+            if self._spill is not None:
+                self._spill.add(match)
+            if hasattr(match.match, "filetype"):
+                filetype = match.match.filetype
             else:
-                yield from self._matches
-            while True:
-                try:
-                    match = next(self._match_iterator)
-                except StopIteration:
-                    self._match_iterator = None
-                    break
-                if hasattr(match.match, "filetype"):
-                    filetype = match.match.filetype
-                else:
-                    filetype = match.name
-                if match.parent is None:
-                    log.info(f"Found a file of type {filetype} at byte offset {match.offset}")
-                    self._matches.append(match)
-                    yield match
-                elif isinstance(match, Submatch):
-                    log.debug(f"Found a subregion of type {filetype} at byte offset {match.offset}")
+                filetype = match.name
+            if match.parent is None:
+                log.info(f"Found a file of type {filetype} at byte offset {match.offset}")
+                self._matches.append(match)
+                return match
+            elif isinstance(match, Submatch):
+                log.debug(f"Found a subregion of type {filetype} at byte offset {match.offset}")
+            else:
+                log.info(f"Found an embedded file of type {filetype} at byte offset {match.offset}")
+
+    def _finish_spill(self):
+        if self._spill is not None:
+            roots = self._spill.finish(self._matches)
+            if roots is not None:
+                self._matches = roots
+
+    def stop(self):
+        """Stops matching early, keeping the matches found so far; `matches` will not yield any new ones"""
+        with self._lock:
+            if self._match_iterator is not None:
+                self._match_iterator.close()
+                self._match_iterator = None
+                self._finish_spill()
+
+    def matches(self) -> Iterator[Match]:
+        """
+        Yields the top-level matches, matching the file the first time it is called.
+
+        If the match tree is spilled to disk (see `max_nodes_in_memory`), the matches yielded while matching lose their
+        descendants once these are spilled, so traverse the matches from a second call (or `matches_so_far`) after
+        matching has finished.
+
+        """
+        index = 0
+        while True:
+            with self._lock:
+                if self._matches is None:
+                    self._matches = []
+                    if self.max_nodes_in_memory is not None:
+                        from .spill import MatchSpill
+                        self._spill = MatchSpill(self.max_nodes_in_memory)
+                    self._match_iterator = iter(
+                        self.matcher.match_magic(self.mime_matches(), self.context, self.file_stream)
+                    )
+                if index < len(self._matches):
+                    match: Optional[Match] = self._matches[index]
+                elif self._match_iterator is None:
+                    match = None
                 else:
-                    log.info(f"Found an embedded file of type {filetype} at byte offset {match.offset}")
+                    match = self._next_match()
+            if match is None:
+                break
+            index += 1
+            yield match
+
+    def index(self) -> MatchIndex:
+        """
+        Returns an index of all of the matches by the byte ranges that they cover, matching the file first if needed.
+
+        The index is built on the first call and reused afterward.
+
+        """
+        for _ in self.matches():
+            pass
+        with self._lock:
+            if self._index is None:
+                self._index = MatchIndex(self._matches)
+            return self._index
+
+    def _snapshot_options(self) -> Dict[str, Any]:
+        """Everything besides the file's contents that determines the match tree"""
+        if self._magic_matcher is None:
+            from .cache import magic_fingerprint
+            magic: Optional[str] = magic_fingerprint()
         else:
-            yield from self._matches
+            # the tree cannot be resumed with custom magic, since it is not known whether the definitions have changed
+            magic = None
+        return {
+            "magic": magic,
+            "try_all_offsets": self.try_all_offsets,
+            "parse": self.parse,
+            "only_match_mime": self.only_match_mime,
+            "quota": {
+                "max_depth": self.quota.max_depth,
+                "max_decompressed_bytes": self.quota.max_decompressed_bytes,
+                "max_nodes": self.quota.max_nodes,
+                "max_embedded_size": self.quota.max_embedded_size
+            }
+        }
 
-    def magic_matches(self) -> Iterator[Match]:
-        if self._magic_matches is None or self._magic_match_iterator is not None:
-            if self._magic_matches is None:
-                self._magic_matches = []
-                self._magic_match_iterator = iter(self.matcher.identify(self.path))
-            else:
-                yield from self._magic_matches
-            while True:
-                try:
-                    match = next(self._magic_match_iterator)
-                    yield match
-                except StopIteration:
-                    self._magic_match_iterator = None
-                    break
+    def snapshot(self, stream: IO[bytes]):
+        """
+        Saves the complete match tree to `stream`, matching the file first if needed.
+
+        The snapshot is in the columnar format (see `polyfile.columnar`), without the contents of the file. If the file
+        is later appended to, an analysis of the grown file can `resume` from the snapshot rather than starting over.
+
+        """
+        from .columnar import dump
+
+        for _ in self.matches():
+            pass
+        dump(self, stream, matches=self._matches, contents=ContentsMode.OMIT,
+             metadata={"snapshot": self._snapshot_options()})
+
+    def resume(self, snapshot: Union["ColumnarSBUD", str, Path, IO[bytes]]) -> bool:
+        """
+        Restores the match tree from a `snapshot` of an earlier analysis of this file, before it was appended to.
+
+        The magic matches are repeated on the grown file, since appended data can change its types (e.g., HTML appended
+        to a plain text log), and the tree is only resumed if they produce the same top-level matches as the snapshot.
+        The data appended since the snapshot was taken are then parsed by the resumer registered for the type of each
+        top-level match (see `register_resumer`), which extends its tree.
+
+        Returns False if the snapshot is of a different file, was taken with different options, or cannot be resumed,
+        in which case the file will be analyzed from scratch. This must be called before the file is matched.
+
+        """
+        from .columnar import ColumnarSBUD
+
+        if not isinstance(snapshot, ColumnarSBUD):
+            snapshot = ColumnarSBUD.load(snapshot)
+        header = snapshot.header
+        options = self._snapshot_options()
+        if header.get("snapshot") != options or options["magic"] is None or options["try_all_offsets"]:
+            log.info("The snapshot was taken with different options, so it cannot be resumed")
+            return False
+        if "limitsReached" in header:
+            log.info("The snapshot is of an incomplete analysis, so it cannot be resumed")
+            return False
+        previous_length: int = header["length"]
+        data = self.context.data
+        if len(data) < previous_length or \
+                hashlib.sha256(memoryview(data)[:previous_length]).hexdigest() != header["SHA256"]:
+            log.info("The file was modified since the snapshot was taken, so it cannot be resumed")
+            return False
+        if len(data) > previous_length:
+            mimetypes: List[str] = []
+            for magic_match in self.mime_matches():
+                for result in magic_match:
+                    if result.test.mime is not None:
+                        mimetype = result.test.mime.resolve(self.context)
+                        if mimetype not in mimetypes:
+                            mimetypes.append(mimetype)
+            if mimetypes != [snapshot.type(root) for root in snapshot.roots]:
+                log.info("The types of the file changed since the snapshot was taken, so it cannot be resumed")
+                return False
+        with self._lock:
+            if self._matches is not None:
+                raise ValueError("An analysis can only be resumed before the file is matched")
+            quota = self.quota
+            nodes = quota.nodes
+            roots = list(snapshot.matches(self.matcher))
+            if len(data) > previous_length:
+                if not roots:
+                    log.info("The snapshot has no matches, so the grown file must be analyzed from scratch")
+                    quota.nodes = nodes
+                    return False
+                for root in roots:
+                    resumer = RESUMERS.get(root.name)
+                    resumed = False
+                    if resumer is not None:
+                        with FileStream(self.file_stream, start=root.offset) as stream:
+                            try:
+                                resumed = resumer(stream, root, previous_length - root.offset)
+                            except QuotaExceeded:
+                                pass
+                    if not resumed:
+                        log.info(f"The appended data cannot be parsed as {root.name}, so the file must be analyzed "
+                                 "from scratch")
+                        # the rebuilt matches are discarded, so they should not count against the quota
+                        quota.nodes = nodes
+                        quota.limits_reached.pop("max_nodes", None)
+                        return False
+                log.info(f"Resumed the analysis after byte offset {previous_length}")
+            self._matches = roots
+            self._match_iterator = None
+        return True
+
+    def magic_matches(self) -> Iterator[MagicMatch]:
+        if self.only_match_mime:
+            return self.mime_matches()
+        return self._magic_pass(full=True)
+
+    def _chunks(self) -> Iterator[bytes]:
+        """Yields the contents of the file in chunks of `SBUD_CHUNK_SIZE` bytes"""
+        if self._context is not None or self._input is not None:
+            # the file has already been read into memory (or is not a file), so don't read it again
+            data = memoryview(self.context.data)
+            for offset in range(0, len(data), SBUD_CHUNK_SIZE):
+                yield data[offset:offset + SBUD_CHUNK_SIZE]
         else:
-            yield from self._magic_matches
+            with open(self.path, "rb") as f:
+                while True:
+                    chunk = f.read(SBUD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
 
-    def sbud(self, matches: Optional[Iterable[Match]] = None) -> Dict[str, Any]:
+    def stream(self, callback: MatchEventCallback, release: bool = False) -> Iterator[Match]:
+        """
+        Reports every match to `callback` as a flat event while matching (see `MatchStream`).
+
+        Yields each top-level match as it is found, so callers can stop early. Unlike `matches`, the results are not
+        retained by this analyzer, so if `release` is True, the matches are freed as soon as they are reported.
+
+        """
+        if self._matches is not None and self._match_iterator is None:
+            # the matches were already computed, so just replay them
+            with MatchStream(callback) as stream:
+                for match in self._matches:
+                    stream.add_tree(match)
+                    yield match
+            return
+        with MatchStream(callback, release=release) as stream:
+            for match in self.matcher.match_magic(self.mime_matches(), self.context, self.file_stream):
+                stream.add(match)
+                if match.parent is None:
+                    yield match
+
+    def sbud(
+            self, matches: Optional[Iterable[Match]] = None, contents: ContentsMode = ContentsMode.EMBED
+    ) -> Dict[str, Any]:
         if matches is None:
             matches = self.matches()
-        md5 = hashlib.md5()
-        sha1 = hashlib.sha1()
-        sha256 = hashlib.sha256()
-        with open(self.path, 'rb') as hash_file:
-            data = hash_file.read()
-            md5.update(data)
-            sha1.update(data)
-            sha256.update(data)
-            b64contents = base64.b64encode(data)
-            file_length = len(data)
-            del data
-        return {
-            'MD5': md5.hexdigest(),
-            'SHA1': sha1.hexdigest(),
-            'SHA256': sha256.hexdigest(),
-            'b64contents': b64contents.decode('utf-8'),
-            'fileName': self.path,
+        file_length = 0
+        b64chunks: List[str] = []
+
+        def on_chunk(chunk: bytes):
+            nonlocal file_length
+            file_length += len(chunk)
+            if contents == ContentsMode.EMBED:
+                b64chunks.append(base64.b64encode(chunk).decode("utf-8"))
+
+        digests = hash_chunks(self._chunks(), on_chunk=on_chunk)
+        sbud: Dict[str, Any] = dict(digests)
+        if contents == ContentsMode.EMBED:
+            sbud['b64contents'] = "".join(b64chunks)
+            del b64chunks
+        elif contents == ContentsMode.REFERENCE:
+            if self.path is None:
+                log.warning(f"{self.name} is not a file, so it cannot be referenced; omitting its contents instead")
+            else:
+                sbud['contentsPath'] = str(Path(self.path).absolute())
+        sbud.update({
+            'fileName': self.name,
             'length': file_length,
             'versions': {
                 'polyfile': __version__
@@ -406,4 +1412,94 @@ class Analyzer:
             'struc': [
                 match.to_obj() for match in matches
             ]
-        }
+        })
+        if self.quota.limits_reached:
+            sbud['limitsReached'] = dict(self.quota.limits_reached)
+        return sbud
+
+    def write_sbud(
+            self, output: IO[str], matches: Optional[Iterable[Match]] = None,
+            contents: ContentsMode = ContentsMode.EMBED
+    ):
+        """
+        Writes the same JSON as `json.dump(self.sbud(matches, contents), output)`, one match at a time.
+
+        Unlike `sbud`, this never holds more than one path of the match tree in memory, so it can output the matches
+        that were spilled to disk (see `max_nodes_in_memory`), nor the whole base64 encoded contents of the file, which
+        are written one chunk at a time.
+
+        """
+        if matches is None:
+            for _ in self.matches():
+                pass
+            matches = self._matches
+        # the limits that were reached are only known once the matches have been found
+        if contents == ContentsMode.EMBED:
+            header = self.sbud(matches=(), contents=ContentsMode.OMIT)
+            # the contents come right after the digests; they are written in place of an empty placeholder
+            digests = {name: header.pop(name) for name in ("MD5", "SHA1", "SHA256")}
+            header = {**digests, "b64contents": "", **header}
+        else:
+            header = self.sbud(matches=(), contents=contents)
+        del header["struc"]
+        limits_reached = header.pop("limitsReached", None)
+        if contents == ContentsMode.EMBED:
+            # the digests are hexadecimal, so the first occurrence of the placeholder is the one in the header
+            before, _, after = dumps(header)[:-1].partition('"b64contents": ""')
+            output.write(before)
+            output.write('"b64contents": "')
+            for chunk in self._chunks():
+                # SBUD_CHUNK_SIZE is a multiple of three, so the encoded chunks can be concatenated
+                output.write(base64.b64encode(chunk).decode("utf-8"))
+            output.write('"')
+            output.write(after)
+        else:
+            output.write(dumps(header)[:-1])
+        output.write(', "struc": [')
+        for i, match in enumerate(matches):
+            if i > 0:
+                output.write(", ")
+            self._write_match(output, match)
+        output.write("]")
+        if limits_reached is not None:
+            output.write(f', "limitsReached": {dumps(limits_reached)}')
+        output.write("}")
+
+    @staticmethod
+    def _write_match(output: IO[str], match: Match):
+        """Writes `match.to_obj()` as JSON without recursing, since match trees can be arbitrarily deep"""
+        end = object()
+        stack: List[Tuple[Match, Iterator[Match]]] = []
+        next_match: Optional[Match] = match
+        while True:
+            if next_match is not None:
+                output.write(dumps({
+                    'relative_offset': next_match.relative_offset,
+                    'offset': next_match.offset,
+                    'size': next_match.length,
+                    'type': next_match.name,
+                    'name': next_match.display_name,
+                    'value': str(next_match.match)
+                })[:-1])
+                output.write(', "subEls": [')
+                stack.append((next_match, iter(next_match)))
+                first_child = True
+            else:
+                first_child = False
+            parent, children = stack[-1]
+            child = next(children, end)
+            if child is end:
+                stack.pop()
+                optional_fields: Dict[str, Any] = {}
+                parent._add_optional_fields(optional_fields)
+                output.write("]")
+                if optional_fields:
+                    output.write(f", {dumps(optional_fields)[1:-1]}")
+                output.write("}")
+                if not stack:
+                    break
+                next_match = None
+            else:
+                if not first_child:
+                    output.write(", ")
+                next_match = child
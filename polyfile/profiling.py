@@ -1,6 +1,7 @@
 from functools import wraps
+import threading
 import time
-from typing import Optional
+from typing import List, Optional
 from . import logger
 
 log = logger.getStatusLogger(__file__)
@@ -10,8 +11,14 @@ def current_time_ms():
     return time.process_time_ns() / 1000000.0
 
 
-# Note: This assumes single-threading, but that's basically the case as long as the GIL exists
-_PROFILER_STACK: ["Profiler"] = []
+class _ProfilerStack(threading.local):
+    """The stack of active profilers, which is local to each thread"""
+
+    def __init__(self):
+        self.profilers: List["Profiler"] = []
+
+
+_PROFILER_STACK = _ProfilerStack()
 
 
 class Profiler:
@@ -42,6 +49,7 @@ class Profiler:
             if profiler.complete:
                 raise ValueError("You cannot pause a completed profiler")
             profiler._paused_start_time_ms.append(current_time_ms())
+            profiler = profiler.parent
 
     def unpause(self):
         profiler = self
@@ -75,18 +83,20 @@ class Profiler:
 
     def __enter__(self) -> "Profiler":
         self.start()
-        if self.parent is None and _PROFILER_STACK:
-            self.parent = _PROFILER_STACK[-1]
-        _PROFILER_STACK.append(self)
+        profilers = _PROFILER_STACK.profilers
+        if self.parent is None and profilers:
+            self.parent = profilers[-1]
+        profilers.append(self)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.stop()
-        if _PROFILER_STACK[-1] is not self:
+        profilers = _PROFILER_STACK.profilers
+        if profilers[-1] is not self:
             log.warning(f"Profiler {self!r} stopped before its children stopped!")
-            _PROFILER_STACK.remove(self)
+            profilers.remove(self)
         else:
-            _PROFILER_STACK.pop()
+            profilers.pop()
 
 
 class Unprofiled:
@@ -95,8 +105,8 @@ class Unprofiled:
         self._had_profiler = profiler is not None
 
     def __enter__(self):
-        if not self._had_profiler and _PROFILER_STACK:
-            self.profiler = _PROFILER_STACK[-1]
+        if not self._had_profiler and _PROFILER_STACK.profilers:
+            self.profiler = _PROFILER_STACK.profilers[-1]
         if self.profiler is not None:
             self.profiler.pause()
 
@@ -0,0 +1,192 @@
+import threading
+from typing import Dict, IO, List, Optional
+import zlib
+
+from . import logger
+
+log = logger.getStatusLogger("polyfile")
+
+
+class QuotaExceeded(Exception):
+    """Raised when an analysis exceeds one of the limits of its `Quota`"""
+
+    def __init__(self, limit: str, value: int):
+        super().__init__(f"exceeded the {limit} quota of {value}")
+        self.limit: str = limit
+        self.value: int = value
+
+
+class QuotaReservation:
+    """A share of a `Quota`'s remaining nodes and decompressed bytes that is set aside for work done elsewhere"""
+    __slots__ = ("nodes", "decompressed_bytes")
+
+    def __init__(self, nodes: Optional[int], decompressed_bytes: Optional[int]):
+        self.nodes: Optional[int] = nodes
+        """The number of nodes set aside, or None if the number of nodes is unlimited"""
+        self.decompressed_bytes: Optional[int] = decompressed_bytes
+        """The number of decompressed bytes set aside, or None if decompression is unlimited"""
+
+
+class Quota:
+    """
+    Per-analysis resource limits that protect against hostile inputs like zip bombs and deeply nested files.
+
+    A limit of None is unlimited. When a limit is reached, the analysis degrades gracefully: embedded content that
+    would exceed the limits is not matched, decompressed data are truncated, and once the maximum number of matches
+    has been created, parsing stops. Each limit that was reached is recorded in `limits_reached`.
+
+    """
+    def __init__(
+            self,
+            max_depth: Optional[int] = None,
+            max_decompressed_bytes: Optional[int] = None,
+            max_nodes: Optional[int] = None,
+            max_embedded_size: Optional[int] = None
+    ):
+        self.max_depth: Optional[int] = max_depth
+        """The maximum depth of recursive matching into embedded content"""
+        self.max_decompressed_bytes: Optional[int] = max_decompressed_bytes
+        """The maximum total number of bytes that parsers may decompress"""
+        self.max_nodes: Optional[int] = max_nodes
+        """The maximum number of matches and submatches"""
+        self.max_embedded_size: Optional[int] = max_embedded_size
+        """The maximum size of a single embedded blob that will be recursively matched"""
+        self.nodes: int = 0
+        self.decompressed_bytes: int = 0
+        self.limits_reached: Dict[str, int] = {}
+        self._reserved_nodes: int = 0
+        self._reserved_decompressed_bytes: int = 0
+        self._lock: threading.Lock = threading.Lock()
+
+    def reached(self, limit: str, value: int):
+        """Records that `limit` (with the given value) was reached"""
+        with self._lock:
+            if limit in self.limits_reached:
+                return
+            self.limits_reached[limit] = value
+        log.warning(f"Reached the {limit} quota of {value}; the analysis will be incomplete")
+
+    def add_node(self):
+        """Accounts for a new match, raising `QuotaExceeded` if there are already too many"""
+        with self._lock:
+            self.nodes += 1
+            exceeded = self.max_nodes is not None and self.nodes + self._reserved_nodes > self.max_nodes
+        if exceeded:
+            self.reached("max_nodes", self.max_nodes)
+            raise QuotaExceeded("max_nodes", self.max_nodes)
+
+    def allows_embedded(self, depth: int, size: int) -> bool:
+        """Returns whether embedded content of the given depth and size should be recursively matched"""
+        if self.max_depth is not None and depth > self.max_depth:
+            self.reached("max_depth", self.max_depth)
+            return False
+        if self.max_embedded_size is not None and size > self.max_embedded_size:
+            self.reached("max_embedded_size", self.max_embedded_size)
+            return False
+        return True
+
+    @property
+    def remaining_nodes(self) -> Optional[int]:
+        """The number of nodes that may still be created, excluding those that are reserved"""
+        if self.max_nodes is None:
+            return None
+        return max(self.max_nodes - self.nodes - self._reserved_nodes, 0)
+
+    @property
+    def remaining_decompressed_bytes(self) -> Optional[int]:
+        """The number of bytes that may still be decompressed, excluding those that are reserved"""
+        if self.max_decompressed_bytes is None:
+            return None
+        return max(self.max_decompressed_bytes - self.decompressed_bytes - self._reserved_decompressed_bytes, 0)
+
+    def reserve(self, shares: int = 1) -> QuotaReservation:
+        """
+        Sets aside one of `shares` equal shares of the remaining nodes and decompressed bytes.
+
+        This is for work done concurrently elsewhere (e.g., in a worker process): as long as that work stays within
+        the reservation, it cannot exceed this quota however many reservations are outstanding. The reservation must
+        be given back with `release` before the resources that were actually used are accounted for.
+
+        """
+        with self._lock:
+            nodes: Optional[int] = None
+            decompressed_bytes: Optional[int] = None
+            if self.max_nodes is not None:
+                nodes = -(-max(self.max_nodes - self.nodes - self._reserved_nodes, 0) // shares)
+                self._reserved_nodes += nodes
+            if self.max_decompressed_bytes is not None:
+                decompressed_bytes = -(-max(
+                    self.max_decompressed_bytes - self.decompressed_bytes - self._reserved_decompressed_bytes, 0
+                ) // shares)
+                self._reserved_decompressed_bytes += decompressed_bytes
+        return QuotaReservation(nodes, decompressed_bytes)
+
+    def release(self, reservation: QuotaReservation):
+        """Gives back a reservation made by `reserve`"""
+        with self._lock:
+            if reservation.nodes is not None:
+                self._reserved_nodes -= reservation.nodes
+            if reservation.decompressed_bytes is not None:
+                self._reserved_decompressed_bytes -= reservation.decompressed_bytes
+
+    def account_decompressed(self, num_bytes: int) -> bool:
+        """
+        Accounts for bytes that were decompressed elsewhere (e.g., in a worker process).
+
+        Returns False, and records that the limit was reached, if they exceed the decompression quota.
+
+        """
+        with self._lock:
+            self.decompressed_bytes += num_bytes
+            exceeded = self.max_decompressed_bytes is not None and \
+                self.decompressed_bytes + self._reserved_decompressed_bytes > self.max_decompressed_bytes
+        if exceeded:
+            self.reached("max_decompressed_bytes", self.max_decompressed_bytes)
+        return not exceeded
+
+    def _account_decompressed(self, num_bytes: int, truncated: bool):
+        with self._lock:
+            self.decompressed_bytes += num_bytes
+        if truncated:
+            self.reached("max_decompressed_bytes", self.max_decompressed_bytes)
+
+    def decompress(self, data: bytes) -> bytes:
+        """Decompresses zlib data, truncating the output at the remaining decompression quota"""
+        remaining = self.remaining_decompressed_bytes
+        if remaining is None:
+            decompressed = zlib.decompress(data)
+            self._account_decompressed(len(decompressed), truncated=False)
+            return decompressed
+        decompressor = zlib.decompressobj()
+        # ask for one more byte than the quota allows so we can tell whether the output was truncated
+        decompressed = decompressor.decompress(data, remaining + 1)
+        truncated = len(decompressed) > remaining
+        if not truncated and not decompressor.eof:
+            # `zlib.decompress` would have raised this, too
+            raise zlib.error("Error -5 while decompressing data: incomplete or truncated stream")
+        decompressed = decompressed[:remaining]
+        self._account_decompressed(len(decompressed), truncated=truncated)
+        return decompressed
+
+    def read_decompressed(self, stream: IO[bytes]) -> bytes:
+        """Reads a decompressing stream (e.g., from `zipfile.ZipFile.open`), truncating at the remaining quota"""
+        remaining = self.remaining_decompressed_bytes
+        if remaining is None:
+            decompressed = stream.read()
+            self._account_decompressed(len(decompressed), truncated=False)
+            return decompressed
+        # a single read may return less than was asked for before the end of the stream, in which case the output
+        # would be silently incomplete, and the stream would not get to check that its compressed data are complete
+        chunks: List[bytes] = []
+        size = 0
+        while size <= remaining:
+            chunk = stream.read(remaining + 1 - size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        decompressed = b"".join(chunks)
+        truncated = len(decompressed) > remaining
+        decompressed = decompressed[:remaining]
+        self._account_decompressed(len(decompressed), truncated=truncated)
+        return decompressed
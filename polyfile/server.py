@@ -0,0 +1,416 @@
+"""
+A long-running analysis daemon.
+
+Each PolyFile run pays a fixed cost before it analyzes anything: starting the interpreter, parsing the magic
+definitions, and importing the parsers and their dependencies. `polyfile serve` pays it once, warms up every parser,
+and then answers analysis requests over HTTP on localhost or on a Unix domain socket.
+
+API
+---
+
+``GET /health``
+    Returns ``{"status": "ok", "version": ..., "active": N}``, where N is the number of running analyses.
+
+``POST /analyze``
+    Analyzes the request body, or with ``?path=PATH``, a file on the server (only beneath a directory that the server
+    was started with ``--allow-path``). The query string may also contain:
+
+    * ``format``: an output format (``file``, ``mime``, ``explain``, ``ndjson``, ``json``, or ``sbud``); may be
+      repeated, and defaults to ``mime``
+    * ``name``: the file name to report for an uploaded body
+    * ``max_depth``, ``max_decompressed_bytes``, ``max_nodes``, ``max_embedded_size``: per-request resource quotas
+      (see `polyfile.quotas.Quota`)
+    * ``deadline``: the number of seconds after which the analysis is abandoned; this is a soft limit that is only
+      checked while waiting for an analysis slot and between results, so a single slow magic test or parser can
+      overrun it (run the server with ``--parser-timeout`` to also bound the time spent in each parser)
+    * ``only_match`` and ``try_all_offsets``: ``1`` to enable the corresponding CLI options
+
+    A body larger than the server's ``max_body_size`` is rejected with status 413.
+
+    The response is streamed as chunked NDJSON while the file is analyzed, with one object per result:
+    ``{"format": "mime", "mimetype": ..., "match": ...}``, ``{"format": "file", "line": ...}``,
+    ``{"format": "explain", "mimetype": ..., "explanation": ...}``, ``{"format": "ndjson", "event": ...}``, and
+    ``{"format": "sbud", "sbud": ...}``. The last object is ``{"done": true, "elapsed": SECONDS}``, which has an
+    ``error`` if the analysis failed or was abandoned at its (soft) deadline and ``limitsReached`` if a quota was
+    reached.
+
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+from pathlib import Path
+import socketserver
+import stat
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlsplit
+
+from . import logger
+from .kaitai.parser import KaitaiParser
+from .kaitaimatcher import KAITAI_MIME_MAPPING
+from .magic import MagicMatcher
+from .polyfile import __version__, Analyzer, ContentsMode
+from .quotas import Quota
+from .workers import ParserPool
+
+log = logger.getStatusLogger("polyfile")
+
+
+SERVER_FORMATS: Tuple[str, ...] = ("file", "mime", "explain", "ndjson", "json", "sbud")
+
+QUOTA_PARAMETERS: Tuple[str, ...] = ("max_depth", "max_decompressed_bytes", "max_nodes", "max_embedded_size")
+
+DEFAULT_MAX_BODY_SIZE: int = 1024 ** 3
+"""The default maximum size of an uploaded body, in bytes; uploads are read into memory"""
+
+
+def warm_up(magic_matcher: Optional[MagicMatcher] = None, try_all_offsets: bool = False):
+    """Parses the magic definitions and imports every parser, so that the first request does not pay for them"""
+    if magic_matcher is None:
+        magic_matcher = MagicMatcher.DEFAULT_INSTANCE
+    if try_all_offsets:
+        magic_matcher.carving_index()
+    # the PDF parser is otherwise imported (and registers its magic test) the first time that a PDF is parsed, which
+    # would make the results of a request depend on whether an earlier request contained a PDF
+    from . import pdf
+    for ksy_path in KAITAI_MIME_MAPPING.values():
+        try:
+            KaitaiParser.load(ksy_path)
+        except Exception as e:
+            log.warning(f"Could not load the Kaitai parser for {ksy_path}: {e!s}")
+
+
+class RequestError(ValueError):
+    """An invalid analysis request, reported to the client with `status`"""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status: int = status
+
+
+class AnalysisRequest:
+    """The options of a single analysis request"""
+
+    def __init__(
+            self,
+            formats: Tuple[str, ...] = ("mime",),
+            path: Optional[str] = None,
+            name: str = "upload",
+            quota_limits: Optional[Dict[str, Optional[int]]] = None,
+            deadline: Optional[float] = None,
+            parse: bool = True,
+            try_all_offsets: bool = False
+    ):
+        self.formats: Tuple[str, ...] = formats
+        self.path: Optional[str] = path
+        self.name: str = name
+        if quota_limits is None:
+            quota_limits = {}
+        self.quota_limits: Dict[str, Optional[int]] = quota_limits
+        self.deadline: Optional[float] = deadline
+        """A soft limit on the number of seconds that the request may take, which is only checked between results"""
+        self.parse: bool = parse
+        self.try_all_offsets: bool = try_all_offsets
+
+    @staticmethod
+    def parse_query(query: str) -> "AnalysisRequest":
+        params = parse_qs(query, keep_blank_values=True)
+
+        def single(key: str) -> Optional[str]:
+            values = params.get(key, ())
+            if len(values) > 1:
+                raise RequestError(f"{key!r} may only be passed once")
+            elif values:
+                return values[0]
+            return None
+
+        def flag(key: str) -> bool:
+            value = single(key)
+            return value is not None and value.lower() not in ("", "0", "false", "no")
+
+        def number(key: str, parse_type=int):
+            value = single(key)
+            if value is None:
+                return None
+            try:
+                parsed = parse_type(value)
+            except ValueError:
+                raise RequestError(f"invalid value for {key!r}: {value!r}")
+            if parsed < 0:
+                raise RequestError(f"{key!r} must not be negative")
+            return parsed
+
+        unknown = set(params.keys()) - {"format", "path", "name", "deadline", "only_match", "try_all_offsets"} - set(
+            QUOTA_PARAMETERS
+        )
+        if unknown:
+            raise RequestError(f"unknown parameter(s): {', '.join(sorted(unknown))}")
+        formats: List[str] = []
+        for output_format in params.get("format", ["mime"]):
+            if output_format not in SERVER_FORMATS:
+                raise RequestError(f"unsupported format {output_format!r}; expected one of {', '.join(SERVER_FORMATS)}")
+            if output_format not in formats:
+                formats.append(output_format)
+        name = single("name")
+        if name is None:
+            name = "upload"
+        elif not name or os.path.basename(name) != name or name in (".", ".."):
+            raise RequestError(f"invalid file name {name!r}")
+        return AnalysisRequest(
+            formats=tuple(formats),
+            path=single("path"),
+            name=name,
+            quota_limits={key: number(key) for key in QUOTA_PARAMETERS},
+            deadline=number("deadline", float),
+            parse=not flag("only_match"),
+            try_all_offsets=flag("try_all_offsets")
+        )
+
+
+class AnalysisServer:
+    """
+    Runs analysis requests with at most `max_concurrent` analyses at a time.
+
+    Requests beyond the limit wait for a slot until their deadline, and uploads larger than `max_body_size` bytes (if it
+    is not None) are rejected. If `parser_pool` is not None, the parsers of every request run in its workers, which is
+    the only way to bound the time spent in a single parser: a request's deadline is otherwise checked between results.
+
+    """
+    def __init__(
+            self,
+            max_concurrent: Optional[int] = None,
+            allowed_paths: Tuple[str, ...] = (),
+            magic_matcher: Optional[MagicMatcher] = None,
+            parser_pool: Optional[ParserPool] = None,
+            max_body_size: Optional[int] = DEFAULT_MAX_BODY_SIZE
+    ):
+        if max_concurrent is None:
+            max_concurrent = os.cpu_count() or 1
+        self.max_concurrent: int = max(max_concurrent, 1)
+        self.allowed_paths: Tuple[Path, ...] = tuple(Path(path).resolve() for path in allowed_paths)
+        self.magic_matcher: Optional[MagicMatcher] = magic_matcher
+        self.parser_pool: Optional[ParserPool] = parser_pool
+        self.max_body_size: Optional[int] = max_body_size
+        self.active: int = 0
+        self._slots: threading.BoundedSemaphore = threading.BoundedSemaphore(self.max_concurrent)
+        self._lock: threading.Lock = threading.Lock()
+
+    def resolve_path(self, path: str) -> str:
+        resolved = Path(path).resolve()
+        if not any(resolved == allowed or allowed in resolved.parents for allowed in self.allowed_paths):
+            raise RequestError(f"the server does not allow analyzing {path!r}", status=403)
+        if not resolved.is_file():
+            raise RequestError(f"{path!r} is not a file", status=404)
+        return str(resolved)
+
+    def acquire(self, request: AnalysisRequest) -> bool:
+        """Waits for an analysis slot until the request's deadline, returning whether one was acquired"""
+        if not self._slots.acquire(timeout=request.deadline):
+            return False
+        with self._lock:
+            self.active += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+    def analyze(
+            self, request: AnalysisRequest, source: Union[str, bytes], start_time: float
+    ) -> Iterator[Dict[str, Any]]:
+        """Yields the results of analyzing `source` (a path or the uploaded content), ending with a `done` result"""
+        analyzer = Analyzer(
+            source, try_all_offsets=request.try_all_offsets, parse=request.parse, magic_matcher=self.magic_matcher,
+            only_match_mime="file" not in request.formats, quota=Quota(**request.quota_limits),
+            parser_pool=self.parser_pool, name=request.name if isinstance(source, bytes) else None
+        )
+        done: Dict[str, Any] = {"done": True}
+        try:
+            for result in self._results(analyzer, request):
+                yield result
+                if request.deadline is not None and time.monotonic() - start_time > request.deadline:
+                    done["error"] = f"the analysis exceeded its deadline of {request.deadline} seconds"
+                    break
+        except Exception as e:
+            log.error(f"Error analyzing {analyzer.name!r}: {e!s}")
+            done["error"] = f"{e.__class__.__name__}: {e!s}"
+        if analyzer.quota.limits_reached:
+            done["limitsReached"] = dict(analyzer.quota.limits_reached)
+        done["elapsed"] = time.monotonic() - start_time
+        analyzer.close()
+        yield done
+
+    @staticmethod
+    def _results(analyzer: Analyzer, request: AnalysisRequest) -> Iterator[Dict[str, Any]]:
+        for output_format in request.formats:
+            if output_format == "file":
+                lines = set()
+                for match in analyzer.magic_matches():
+                    line = str(match)
+                    if line not in lines:
+                        lines.add(line)
+                        yield {"format": "file", "line": line}
+            elif output_format == "mime":
+                for mimetype, match in analyzer.mime_types():
+                    yield {"format": "mime", "mimetype": mimetype, "match": str(match)}
+            elif output_format == "explain":
+                for mimetype, match in analyzer.mime_types():
+                    yield {
+                        "format": "explain", "mimetype": mimetype,
+                        "explanation": match.explain(ansi_color=False, file=analyzer.file_stream)
+                    }
+            elif output_format == "ndjson":
+                events: List[Dict[str, Any]] = []
+                for _ in analyzer.stream(events.append):
+                    for event in events:
+                        yield {"format": "ndjson", "event": event}
+                    events.clear()
+                for event in events:
+                    yield {"format": "ndjson", "event": event}
+            else:
+                # SBUD needs the complete match tree, but computing it here lets an ndjson format requested
+                # afterward replay it instead of matching again
+                sbud = analyzer.sbud(contents=ContentsMode.OMIT)
+                yield {"format": output_format, "sbud": sbud}
+
+
+class AnalysisRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = f"PolyFile/{__version__}"
+
+    @property
+    def analysis_server(self) -> AnalysisServer:
+        return self.server.analysis_server  # type: ignore
+
+    def address_string(self) -> str:
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return str(self.client_address[0])
+        # Unix domain socket clients have no address
+        return "unix"
+
+    def log_message(self, format: str, *args):
+        log.debug(f"{self.address_string()} - {format % args}")
+
+    def send_json(self, status: int, obj: Dict[str, Any]):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii"))
+        self.wfile.write(data)
+        self.wfile.write(b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/health":
+            self.send_json(200, {"status": "ok", "version": __version__, "active": self.analysis_server.active})
+        else:
+            self.send_json(404, {"error": f"unknown endpoint {url.path!r}"})
+
+    def do_POST(self):
+        start_time = time.monotonic()
+        url = urlsplit(self.path)
+        if url.path != "/analyze":
+            self.send_json(404, {"error": f"unknown endpoint {url.path!r}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.send_json(400, {"error": "invalid Content-Length"})
+            return
+        max_body_size = self.analysis_server.max_body_size
+        if max_body_size is not None and length > max_body_size:
+            # the body is not read, so the connection cannot be reused
+            self.close_connection = True
+            self.send_json(413, {"error": f"the body is larger than the maximum of {max_body_size} bytes"})
+            return
+        # always consume the body so that the connection can be reused
+        data = self.rfile.read(length) if length > 0 else b""
+        try:
+            request = AnalysisRequest.parse_query(url.query)
+            if request.path is not None:
+                if data:
+                    raise RequestError("a request cannot have both a `path` and a body")
+                path: Optional[str] = self.analysis_server.resolve_path(request.path)
+            else:
+                path = None
+        except RequestError as e:
+            self.send_json(e.status, {"error": str(e)})
+            return
+        if not self.analysis_server.acquire(request):
+            self.send_json(503, {"error": "the server is busy; no analysis slot became available before the deadline"})
+            return
+        try:
+            # uploads are analyzed in memory
+            self._stream(request, data if path is None else path, start_time)
+        finally:
+            self.analysis_server.release()
+
+    def _stream(self, request: AnalysisRequest, source: Union[str, bytes], start_time: float):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for result in self.analysis_server.analyze(request, source, start_time):
+                self.write_chunk(json.dumps(result).encode("utf-8") + b"\n")
+            self.write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            log.debug("The client disconnected before its analysis finished")
+            self.close_connection = True
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, analysis_server: AnalysisServer):
+        super().__init__(server_address, AnalysisRequestHandler)
+        self.analysis_server: AnalysisServer = analysis_server
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self, socket_path: str, analysis_server: AnalysisServer):
+            super().__init__(socket_path, AnalysisRequestHandler)
+            self.analysis_server: AnalysisServer = analysis_server
+
+        def server_close(self):
+            super().server_close()
+            try:
+                os.unlink(self.server_address)
+            except OSError:
+                pass
+else:
+    _ThreadingUnixHTTPServer = None
+
+
+def make_server(
+        analysis_server: AnalysisServer, host: str = "127.0.0.1", port: int = 8080, unix_socket: Optional[str] = None
+) -> socketserver.BaseServer:
+    """Creates (but does not start) an HTTP server for `analysis_server`, on a Unix socket if `unix_socket` is set"""
+    if unix_socket is not None:
+        if _ThreadingUnixHTTPServer is None:
+            raise ValueError("Unix domain sockets are not supported on this platform")
+        try:
+            mode: Optional[int] = os.lstat(unix_socket).st_mode
+        except FileNotFoundError:
+            mode = None
+        if mode is not None:
+            if not stat.S_ISSOCK(mode):
+                raise ValueError(f"{unix_socket} already exists and is not a socket")
+            # remove a socket left behind by a previous server
+            os.unlink(unix_socket)
+        return _ThreadingUnixHTTPServer(unix_socket, analysis_server)
+    return _ThreadingHTTPServer((host, port), analysis_server)
@@ -0,0 +1,311 @@
+"""
+Bounding the memory used by very large match trees by spilling them to disk.
+
+Parsing a database, image, or PDF with hundreds of thousands of objects can produce a match tree that uses gigabytes
+of Python objects before any output is written. A `MatchSpill` follows the matches as they are found (see
+`polyfile.polyfile.Analyzer`'s `max_nodes_in_memory`), and once more than `max_nodes_in_memory` matches have been
+created, it moves the subtrees that are complete out of memory and into a temporary SQLite database.
+
+Once matching has finished, the whole tree is read back lazily through `StoredMatch`es, which are `Match`es whose
+children are queried from the database as they are traversed, so writers like `Analyzer.write_sbud` can traverse the
+tree without loading it into memory.
+
+A subtree is complete once a match outside of it is found, which means that the matches must be found in a single
+thread (i.e., without a `polyfile.workers.EmbeddedScheduler`). Parsers occasionally add a match to a subtree that was
+already spilled; such a match is spilled on its own, after its earlier siblings.
+
+"""
+
+import os
+from pathlib import Path
+import sqlite3
+import tempfile
+from typing import Any, Iterator, List, Optional, Tuple, Union
+
+from . import logger
+from .polyfile import Match, Submatch
+
+log = logger.getStatusLogger("polyfile")
+
+
+DEFAULT_SPILL_BATCH_SIZE: int = 10000
+"""The number of matches that are written to the database at once"""
+
+_COLUMNS = (
+    "id, embedded, name, display_name, value, relative_offset, length, img_data, decoded, extension, has_children"
+)
+
+
+class _SpilledChildren(list):
+    """Replaces the children of a match that was spilled, so that a match added to it later can find its parent"""
+
+    __slots__ = ("node_id",)
+
+    def __init__(self, node_id: int):
+        super().__init__()
+        self.node_id: int = node_id
+
+
+class StoredMatch(Match):
+    """A match that was spilled to a `MatchSpill`, whose children are read from it on demand"""
+
+    __slots__ = ("spill", "node_id", "has_children")
+
+    def __init__(self, spill: "MatchSpill", row: Tuple[Any, ...], parent: Optional["StoredMatch"]):
+        # a stored match was already counted against the quota when it was first created, so do not call
+        # `Match.__init__`
+        node_id, _, name, display_name, value, relative_offset, length, img_data, decoded, extension, has_children = row
+        self.spill: MatchSpill = spill
+        self.node_id: int = node_id
+        self.has_children: bool = bool(has_children)
+        self.name = name
+        self.matcher = None
+        self.match = value
+        self.img_data = img_data
+        self.decoded = decoded
+        self._offset = relative_offset
+        self._length = length
+        self._end = None
+        self._parent = parent
+        if parent is None:
+            self._absolute_offset = relative_offset
+        else:
+            self._absolute_offset = parent._absolute_offset + relative_offset
+        self._display_name = display_name
+        self._extension = extension
+
+    @staticmethod
+    def from_row(spill: "MatchSpill", row: Tuple[Any, ...], parent: Optional["StoredMatch"]) -> "StoredMatch":
+        if row[1]:
+            return StoredMatch(spill, row, parent)
+        return StoredSubmatch(spill, row, parent)
+
+    def _add_child(self, child: "Match"):
+        raise TypeError("Matches cannot be added to a match that was spilled to disk")
+
+    @property
+    def _children(self) -> List["StoredMatch"]:
+        return list(self)
+
+    @property
+    def children(self) -> Tuple["StoredMatch", ...]:
+        return tuple(self)
+
+    def __iter__(self) -> Iterator["StoredMatch"]:
+        if not self.has_children:
+            # most matches are leaves, so save querying for their children
+            return
+        for row in self.spill.child_rows(self.node_id):
+            yield StoredMatch.from_row(self.spill, row, self)
+
+    def __len__(self):
+        if not self.has_children:
+            return 0
+        return self.spill.num_children(self.node_id)
+
+    def __getitem__(self, index: int) -> "StoredMatch":
+        return self._children[index]
+
+
+class StoredSubmatch(StoredMatch, Submatch):
+    __slots__ = ()
+
+
+class MatchSpill:
+    """
+    A temporary on-disk store for the subtrees of a match tree that are complete.
+
+    Matches are passed to `add` in the order in which they are found; `finish` then spills the rest of the tree and
+    returns the top-level matches as `StoredMatch`es. Nothing is written to disk unless the tree grows to more than
+    `max_nodes_in_memory` matches.
+
+    """
+    def __init__(self, max_nodes_in_memory: int, directory: Optional[Union[str, Path]] = None):
+        if max_nodes_in_memory < 1:
+            raise ValueError("`max_nodes_in_memory` must be positive")
+        self.max_nodes_in_memory: int = max_nodes_in_memory
+        self.directory: Optional[Union[str, Path]] = directory
+        self.path: Optional[Path] = None
+        self.num_spilled: int = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._open: List[Match] = []
+        """The path from the current top-level match to the most recently found match"""
+        self._ids: dict = {}
+        """The ids assigned to matches that are still in memory but already have spilled children"""
+        self._next_id: int = 0
+        self._next_check: int = max_nodes_in_memory
+        self._rows: List[Tuple[Any, ...]] = []
+
+    @property
+    def is_spilling(self) -> bool:
+        return self._db is not None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            fd, path = tempfile.mkstemp(prefix="polyfile-spill-", suffix=".sqlite3", dir=self.directory)
+            os.close(fd)
+            self.path = Path(path)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            # the database is deleted when the analysis is done, so it does not need to survive a crash
+            self._db.execute("PRAGMA journal_mode=OFF")
+            self._db.execute("PRAGMA synchronous=OFF")
+            self._db.execute(
+                "CREATE TABLE matches (id INTEGER PRIMARY KEY, parent INTEGER, embedded INTEGER NOT NULL, "
+                "name TEXT, display_name TEXT, value TEXT, relative_offset INTEGER NOT NULL, "
+                "length INTEGER NOT NULL, img_data TEXT, decoded BLOB, extension TEXT, has_children INTEGER NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX matches_parent ON matches (parent, id)")
+            log.debug(f"Spilling the match tree to {path}")
+        return self._db
+
+    def _id(self, match: Match) -> int:
+        node_id = self._ids.get(match)
+        if node_id is None:
+            node_id = self._next_id
+            self._next_id += 1
+            self._ids[match] = node_id
+        return node_id
+
+    def _spill(self, match: Match, parent_id: Optional[int]):
+        """Moves `match` and all of its descendants out of memory"""
+        stack: List[Tuple[Match, Optional[int]]] = [(match, parent_id)]
+        while stack:
+            m, pid = stack.pop()
+            node_id = self._ids.pop(m, None)
+            if node_id is None:
+                node_id = self._next_id
+                self._next_id += 1
+            children = m._children
+            self._rows.append((
+                node_id, not isinstance(m, Submatch), m.name, m._display_name, str(m.match), m._offset, m.length,
+                m.img_data, m.decoded, m.extension, bool(children), pid
+            ))
+            m._children = _SpilledChildren(node_id)
+            m._children_view = None
+            stack.extend((child, node_id) for child in reversed(children))
+            if len(self._rows) >= DEFAULT_SPILL_BATCH_SIZE:
+                self._flush()
+
+    def _flush(self):
+        if self._rows:
+            self._connect().executemany(
+                f"INSERT INTO matches ({_COLUMNS}, parent) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", self._rows
+            )
+            self.num_spilled += len(self._rows)
+            self._rows = []
+
+    def _update_parent(self, match: Match):
+        """Updates the stored rows of a spilled match that a child was added to and of its ancestors, which may grow"""
+        db = self._connect()
+        db.execute("UPDATE matches SET has_children = 1 WHERE id = ?", (match._children.node_id,))
+        updates: List[Tuple[int, int]] = []
+        ancestor: Optional[Match] = match
+        while ancestor is not None and isinstance(ancestor._children, _SpilledChildren):
+            if ancestor._length is None:
+                updates.append((ancestor.length, ancestor._children.node_id))
+            ancestor = ancestor.parent
+        db.executemany("UPDATE matches SET length = ? WHERE id = ?", updates)
+
+    def _spill_complete(self):
+        """Spills the subtrees that precede each of the open matches"""
+        for parent, open_child in zip(self._open, self._open[1:]):
+            children = parent._children
+            if children and children[0] is open_child:
+                continue
+            index = len(children) - 1
+            while index >= 0 and children[index] is not open_child:
+                index -= 1
+            if index <= 0:
+                continue
+            parent_id = self._id(parent)
+            for child in children[:index]:
+                self._spill(child, parent_id)
+            parent._children = children[index:]
+            parent._children_view = None
+        self._flush()
+
+    def add(self, match: Match):
+        parent = match.parent
+        if parent is None:
+            self._close_roots()
+            self._open = [match]
+        else:
+            # parsers sometimes create intermediate matches that they never yield, so open those, too
+            path = [match]
+            ancestor: Optional[Match] = parent
+            while ancestor is not None and ancestor not in self._open:
+                if isinstance(ancestor._children, _SpilledChildren):
+                    # the parser added to a subtree that was already spilled
+                    self._spill(path[-1], ancestor._children.node_id)
+                    self._flush()
+                    del ancestor._children[:]
+                    self._update_parent(ancestor)
+                    return
+                path.append(ancestor)
+                ancestor = ancestor.parent
+            if ancestor is None:
+                self._close_roots()
+                self._open = []
+            else:
+                del self._open[self._open.index(ancestor) + 1:]
+            self._open.extend(reversed(path))
+        quota = match.matcher.quota
+        if quota.nodes >= self._next_check and quota.nodes - self.num_spilled > self.max_nodes_in_memory:
+            self._spill_complete()
+            # do not look for complete subtrees after every match if there are not many
+            self._next_check = quota.nodes + max(self.max_nodes_in_memory // 10, 1)
+
+    def _close_roots(self):
+        if self.is_spilling and self._open and not isinstance(self._open[0]._children, _SpilledChildren):
+            # a previous top-level match is complete, so it does not need to stay in memory
+            self._spill(self._open[0], None)
+            self._flush()
+
+    def finish(self, roots: List[Match]) -> Optional[List[StoredMatch]]:
+        """
+        Spills the rest of the tree once matching has finished, returning the stored versions of `roots`.
+
+        Returns None if nothing was spilled, in which case the tree is still entirely in memory.
+
+        """
+        self._open = []
+        if not self.is_spilling:
+            self._ids = {}
+            return None
+        root_ids: List[int] = []
+        for root in roots:
+            if not isinstance(root._children, _SpilledChildren):
+                self._spill(root, None)
+            root_ids.append(root._children.node_id)
+        self._flush()
+        self._ids = {}
+        self._db.commit()
+        log.info(f"Spilled {self.num_spilled} matches to disk")
+        return [StoredMatch.from_row(self, self.row(root_id), None) for root_id in root_ids]
+
+    def row(self, node_id: int) -> Tuple[Any, ...]:
+        return self._connect().execute(f"SELECT {_COLUMNS} FROM matches WHERE id = ?", (node_id,)).fetchone()
+
+    def child_rows(self, node_id: int) -> Iterator[Tuple[Any, ...]]:
+        return self._connect().execute(f"SELECT {_COLUMNS} FROM matches WHERE parent = ? ORDER BY id", (node_id,))
+
+    def num_children(self, node_id: int) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM matches WHERE parent = ?", (node_id,)).fetchone()[0]
+
+    def close(self):
+        """Deletes the database; any `StoredMatch`es read from it can no longer be traversed"""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        if self.path is not None:
+            try:
+                self.path.unlink()
+            except OSError:
+                pass
+            self.path = None
+
+    def __enter__(self) -> "MatchSpill":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,6 +1,5 @@
 from typing import Iterator, Optional
 
-from .fileutils import Tempfile
 from .polyfile import InvalidMatch, Match, Matcher, Submatch
 from .structs import Field, Struct, StructError
 
@@ -40,7 +39,6 @@ class PolyFileStruct(Struct):
                 if isinstance(value, PolyFileStruct):
                     yield from value.match(matcher, s)
                 elif isinstance(value, bytes):
-                    with Tempfile(value) as tmp:
-                        yield from matcher.match(tmp, parent=s)
+                    yield from matcher.match(value, parent=s)
             except (InvalidMatch, StructError):
                 pass
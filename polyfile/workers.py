@@ -0,0 +1,559 @@
+"""
+Out-of-process parser execution.
+
+A misbehaving parser can hang or exhaust the memory of the process running it. A `ParserPool` runs each parser
+invocation in a pooled worker process with a time limit and, on platforms that support it, CPU-time and memory limits.
+Matches are streamed back to the main process as they are yielded and are reconstructed there, so a parser that is
+killed keeps all of the submatches that it produced beforehand (as well as the magic match it was parsing).
+
+An `EmbeddedScheduler` analyzes embedded content (e.g., the members of an archive) concurrently in a process pool and
+grafts the results back into the match tree, producing the same tree as analyzing them in process.
+
+"""
+
+from concurrent.futures import Future, ProcessPoolExecutor
+import multiprocessing
+from multiprocessing.connection import Connection
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .fileutils import FileStream
+from . import logger
+from .magic import MagicMatcher
+from .polyfile import InvalidMatch, Match, Matcher, Parser, PARSERS, Submatch
+from .quotas import Quota, QuotaReservation
+
+if os.name == "posix":
+    import resource
+else:
+    resource = None
+
+log = logger.getStatusLogger("polyfile")
+
+
+class ParserError(RuntimeError):
+    """Raised in the main process when a parser running in a worker raised an exception"""
+    pass
+
+
+class ParserKilled(RuntimeError):
+    """Raised in the main process when a worker was killed (or died) before its parser finished"""
+    pass
+
+
+MatchRecord = Tuple[int, int, bool, bool, str, str, int, Optional[int], Optional[str], Optional[str], Optional[bytes],
+                    Optional[str]]
+"""
+A match sent from a worker: (id, parent id, is embedded, was yielded, name, value, relative offset, fixed length,
+display name, image data, decoded data, extension)
+"""
+
+ROOT_ID = 0
+"""The id of the match that the parser is parsing; it already exists in the main process, so it is never sent"""
+
+
+def _find_parser(mimetype: str, parser_name: str) -> Parser:
+    for parser in PARSERS.get(mimetype, ()):
+        if str(parser) == parser_name:
+            return parser
+    raise ParserError(f"Parser {parser_name} for MIME type {mimetype} is not registered in the worker process")
+
+
+class _MatchRecorder:
+    """Assigns ids to the matches in a worker's tree and converts them to records to send to the main process"""
+
+    def __init__(self, root: Match):
+        self.root: Match = root
+        self.ids: Dict[int, int] = {id(root): ROOT_ID}
+
+    def __contains__(self, match: Match) -> bool:
+        return id(match) in self.ids
+
+    def record(self, match: Match, yielded: bool) -> MatchRecord:
+        match_id = len(self.ids)
+        self.ids[id(match)] = match_id
+        return (
+            match_id, self.ids[id(match.parent)], not isinstance(match, Submatch), yielded, match.name,
+            str(match.match), match.relative_offset, match._length, match._display_name, match.img_data,
+            match.decoded, match.extension
+        )
+
+    def record_with_ancestors(self, match: Match) -> List[MatchRecord]:
+        """Records a match that was yielded, preceded by any of its ancestors that have not yet been recorded"""
+        ancestors = []
+        parent = match.parent
+        while parent is not None and parent not in self:
+            ancestors.append(parent)
+            parent = parent.parent
+        records = [self.record(ancestor, yielded=False) for ancestor in reversed(ancestors)]
+        records.append(self.record(match, yielded=True))
+        return records
+
+    def record_remaining(self) -> List[MatchRecord]:
+        """Records, in pre-order, every match in the tree that has not yet been recorded"""
+        records: List[MatchRecord] = []
+        stack = [self.root]
+        while stack:
+            match = stack.pop()
+            if match not in self:
+                records.append(self.record(match, yielded=False))
+            stack.extend(reversed(match.children))
+        return records
+
+
+def _reconstruct(record: MatchRecord, matches: Dict[int, Match]) -> Match:
+    """Reconstructs a match sent from a worker in the main process, given the matches reconstructed so far by id"""
+    match_id, parent_id, embedded, _, name, value, relative_offset, length, display_name, img_data, decoded, \
+        extension = record
+    if embedded:
+        match_type = Match
+    else:
+        match_type = Submatch
+    new_match = match_type(
+        name, value, relative_offset, length=length, parent=matches[parent_id], display_name=display_name,
+        img_data=img_data, decoded=decoded, extension=extension
+    )
+    matches[match_id] = new_match
+    return new_match
+
+
+def _quota_limits(
+        quota: Quota, match: Optional[Match] = None, reservation: Optional[QuotaReservation] = None
+) -> Dict[str, Optional[int]]:
+    """
+    The limits for a worker whose top-level match corresponds to `match` in the main process.
+
+    If `match` is None, the worker analyzes a whole file, none of whose matches have been counted in the main process.
+    If `reservation` is not None, the worker runs concurrently with others, and may only use the nodes and
+    decompressed bytes that were reserved for it; otherwise, it may use all that remain.
+
+    """
+    limits: Dict[str, Optional[int]] = {
+        "max_depth": quota.max_depth,
+        "max_decompressed_bytes": quota.remaining_decompressed_bytes,
+        "max_nodes": quota.remaining_nodes,
+        "max_embedded_size": quota.max_embedded_size
+    }
+    if reservation is not None:
+        limits["max_decompressed_bytes"] = reservation.decompressed_bytes
+        limits["max_nodes"] = reservation.nodes
+    if quota.max_depth is not None and match is not None:
+        limits["max_depth"] = max(quota.max_depth - match.embedding_depth, 0)
+    if limits["max_nodes"] is not None:
+        if match is not None:
+            # the worker's own top-level match was already counted in the main process, but also counts against the
+            # worker's quota
+            limits["max_nodes"] += 1
+    return limits
+
+
+def _merge_quota(quota: Quota, limits_reached: Iterable[str], decompressed_bytes: int) -> bool:
+    """Accounts for the resources used by a worker, returning False if they exceeded the quota"""
+    for limit in limits_reached:
+        quota.reached(limit, getattr(quota, limit))
+    return quota.account_decompressed(decompressed_bytes)
+
+
+class _TaskRunner:
+    """Runs a single parser invocation in a worker, sending the matches it produces back over `conn`"""
+
+    def __init__(self, conn: Connection, task: Dict[str, Any]):
+        self.conn: Connection = conn
+        self.task: Dict[str, Any] = task
+
+    def run(self):
+        task = self.task
+        quota = Quota(**task["quota"])
+        matcher = Matcher(try_all_offsets=task["try_all_offsets"], parse=True, quota=quota)
+        root = Match(
+            task["mimetype"], task["value"], task["match_offset"], length=task["match_length"], matcher=matcher
+        )
+        recorder = _MatchRecorder(root)
+        parser = _find_parser(task["mimetype"], task["parser"])
+        with FileStream(task["data"], start=task["offset"], length=task["length"]) as fs:
+            for submatch in parser(fs, root):
+                if submatch not in recorder:
+                    self.conn.send(("matches", recorder.record_with_ancestors(submatch)))
+        # send the matches that were created but never yielded, since they still affect the lengths of their parents
+        remaining = recorder.record_remaining()
+        if remaining:
+            self.conn.send(("matches", remaining))
+        self.conn.send(("done", list(quota.limits_reached), quota.decompressed_bytes))
+
+
+def _multiprocessing_context():
+    # forked workers inherit the parsers and the magic definitions that were already loaded
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+
+def _set_cpu_limit(seconds: Optional[float]):
+    if resource is None or seconds is None:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # RLIMIT_CPU counts the lifetime of the process, so extend it by the time allotted to this task
+    limit = int(usage.ru_utime + usage.ru_stime + seconds) + 1
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+
+
+def _worker_main(conn: Connection, max_memory: Optional[int]):
+    if resource is not None and max_memory is not None:
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, hard))
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        _set_cpu_limit(task["timeout"])
+        try:
+            _TaskRunner(conn, task).run()
+        except InvalidMatch:
+            conn.send(("invalid",))
+        except MemoryError:
+            conn.send(("error", "the parser exceeded the worker memory limit"))
+        except Exception as e:
+            conn.send(("error", f"{e.__class__.__name__}: {e!s}"))
+
+
+class _Worker:
+    def __init__(self, context, max_memory: Optional[int]):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, max_memory), name="polyfile-parser", daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=1.0)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class ParserPool:
+    """
+    A pool of worker processes in which parsers are run.
+
+    Pass a pool to a `Matcher` (or an `Analyzer`) to run every parser invocation out of process. `timeout` is the
+    number of seconds that a parser may spend running before its worker is killed; on POSIX systems, it is also
+    enforced as a CPU-time limit. `max_memory` is the maximum size, in bytes, of each worker's address space (POSIX
+    only). When a parser is killed or raises an exception, the matches it has already produced are kept.
+
+    Parsers are looked up in the workers by MIME type and name. Workers are started lazily and forked where the
+    platform supports it, so they have every parser that was registered before they started.
+
+    """
+    def __init__(self, max_workers: Optional[int] = None, timeout: Optional[float] = None,
+                 max_memory: Optional[int] = None):
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        self.max_workers: int = max_workers
+        self.timeout: Optional[float] = timeout
+        self.max_memory: Optional[int] = max_memory
+        self._context = _multiprocessing_context()
+        self._idle: List[_Worker] = []
+        self._num_workers: int = 0
+        self._closed: bool = False
+        self._condition: threading.Condition = threading.Condition()
+
+    def _acquire(self) -> _Worker:
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise ValueError("The parser pool is closed")
+                if self._idle:
+                    return self._idle.pop()
+                if self._num_workers < self.max_workers:
+                    self._num_workers += 1
+                    break
+                self._condition.wait()
+        try:
+            return _Worker(self._context, self.max_memory)
+        except BaseException:
+            with self._condition:
+                self._num_workers -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, worker: _Worker, reusable: bool):
+        if not reusable:
+            worker.kill()
+        with self._condition:
+            if reusable and not self._closed:
+                self._idle.append(worker)
+            else:
+                self._num_workers -= 1
+                if reusable:
+                    worker.close()
+            self._condition.notify()
+
+    def parse(self, parser: Parser, mimetype: str, data: bytes, match: Match, offset: int = 0,
+              length: Optional[int] = None) -> Iterator[Match]:
+        """
+        Runs `parser` over `length` bytes of `data` starting at `offset` in a worker process.
+
+        The matches the parser produces are added to the tree under `match`, and those the parser yields are yielded.
+        Raises `InvalidMatch` if the parser did, `ParserError` if the parser raised any other exception, and
+        `ParserKilled` if the worker was killed or died.
+
+        """
+        if length is None:
+            length = len(data) - offset
+        if not isinstance(data, bytes):
+            # memory-mapped data cannot be sent to a worker
+            data = bytes(data)
+        matcher = match.matcher
+        task = {
+            "parser": str(parser),
+            "mimetype": mimetype,
+            "data": data,
+            "offset": offset,
+            "length": length,
+            "value": str(match.match),
+            "match_offset": match.offset,
+            "match_length": match._length,
+            "try_all_offsets": matcher.try_all_offsets,
+            "quota": _quota_limits(matcher.quota, match),
+            "timeout": self.timeout
+        }
+        worker = self._acquire()
+        finished = False
+        try:
+            worker.conn.send(task)
+            matches: Dict[int, Match] = {ROOT_ID: match}
+            waited = 0.0
+            while True:
+                if self.timeout is None:
+                    ready = True
+                else:
+                    # only count the time spent waiting on the worker, not the time our caller spends consuming matches
+                    start = time.monotonic()
+                    ready = worker.conn.poll(max(self.timeout - waited, 0.0))
+                    waited += time.monotonic() - start
+                if not ready:
+                    raise ParserKilled(f"the parser exceeded its time limit of {self.timeout} seconds")
+                try:
+                    message = worker.conn.recv()
+                except EOFError:
+                    worker.process.join()
+                    raise ParserKilled(f"the parser's worker process exited with code {worker.process.exitcode}")
+                kind = message[0]
+                if kind == "matches":
+                    for record in message[1]:
+                        new_match = _reconstruct(record, matches)
+                        if record[3]:
+                            yield new_match
+                elif kind == "done":
+                    finished = True
+                    _merge_quota(matcher.quota, message[1], message[2])
+                    break
+                elif kind == "invalid":
+                    finished = True
+                    raise InvalidMatch()
+                else:
+                    finished = True
+                    raise ParserError(message[1])
+        finally:
+            # a worker that is still running a parser (because it timed out, or because our caller stopped early)
+            # is not reusable
+            self._release(worker, reusable=finished and worker.process.is_alive())
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._num_workers -= len(idle)
+            self._condition.notify_all()
+        for worker in idle:
+            worker.close()
+
+    def __enter__(self) -> "ParserPool":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _match_embedded(
+        data: bytes, parent_offset: int, parse: bool, try_all_offsets: bool, limits: Dict[str, Optional[int]]
+) -> Tuple[List[MatchRecord], List[str], int]:
+    """Matches embedded content in a worker, returning the records of the resulting matches and the resources used"""
+    quota = Quota(**limits)
+    matcher = Matcher(try_all_offsets=try_all_offsets, parse=parse, quota=quota)
+    root = Match("embedded", None, parent_offset, matcher=matcher)
+    recorder = _MatchRecorder(root)
+    records: List[MatchRecord] = []
+    for match in matcher.match(data, parent=root):
+        if match not in recorder:
+            records.extend(recorder.record_with_ancestors(match))
+    records.extend(recorder.record_remaining())
+    return records, list(quota.limits_reached), quota.decompressed_bytes
+
+
+class _EmbeddedTask:
+    __slots__ = ("future", "parent", "position", "size", "reservation")
+
+    def __init__(self, future: Future, parent: Match, position: int, size: int, reservation: QuotaReservation):
+        self.future: Future = future
+        self.parent: Match = parent
+        self.position: int = position
+        """The index in `parent`'s children at which the matches would have been added if matched in process"""
+        self.size: int = size
+        self.reservation: QuotaReservation = reservation
+        """The share of the quota that the task may use; it is released once the task is grafted or cancelled"""
+
+    def cancel(self):
+        self.future.cancel()
+        self.parent.matcher.quota.release(self.reservation)
+
+
+DEFAULT_MIN_EMBEDDED_TASK_SIZE: int = 16 * 1024
+"""Embedded content smaller than this is matched in process, since it is cheaper than sending it to a worker"""
+
+
+class EmbeddedScheduler:
+    """
+    Analyzes embedded content concurrently in a pool of worker processes.
+
+    When a `Matcher` has a scheduler, each embedded blob of at least `min_size` bytes that a parser passes to
+    `Matcher.match` becomes an independent task (unless the matcher has a custom `MagicMatcher` or a `ParserPool`, in
+    which case it is matched in process) instead of being matched depth-first. Once the parsers of a top-level
+    match have finished, the results are grafted into the tree in the order in which they were submitted, each at the
+    position it would have had if it had been matched in process, so the resulting tree is the same. Content embedded
+    within embedded content is matched depth-first within the worker.
+
+    Each task may only use the share of the remaining nodes and decompressed bytes of the quota that was reserved for
+    it when it was submitted (one per worker), so concurrent tasks cannot exceed the quota together. When a limit is
+    reached, the tree may therefore be truncated differently than it would have been in process.
+
+    """
+    def __init__(self, max_workers: Optional[int] = None, min_size: int = DEFAULT_MIN_EMBEDDED_TASK_SIZE):
+        self.max_workers: Optional[int] = max_workers
+        self.min_size: int = min_size
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending: Dict[int, List[_EmbeddedTask]] = {}
+        """The tasks that have not yet been grafted, keyed by the id of their parent's root match"""
+        self._lock: threading.Lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=_multiprocessing_context()
+                )
+            return self._executor
+
+    def submit(self, data: bytes, parent: Match) -> bool:
+        """Schedules matching `data` embedded under `parent`, returning False if it should be matched in process"""
+        if len(data) < self.min_size:
+            return False
+        matcher = parent.matcher
+        if matcher.parser_pool is not None or matcher.magic_matcher is not MagicMatcher.DEFAULT_INSTANCE:
+            # the workers only match against the default magic definitions and run their parsers in process
+            return False
+        reservation = matcher.quota.reserve(self.max_workers or os.cpu_count() or 1)
+        try:
+            future = self._get_executor().submit(
+                _match_embedded, data, parent.offset, matcher.parse, matcher.try_all_offsets,
+                _quota_limits(matcher.quota, parent, reservation)
+            )
+        except BaseException:
+            matcher.quota.release(reservation)
+            raise
+        task = _EmbeddedTask(future, parent, position=len(parent), size=len(data), reservation=reservation)
+        with self._lock:
+            self._pending.setdefault(id(parent.root), []).append(task)
+        return True
+
+    def pending(self, root: Match) -> int:
+        """The number of tasks submitted under `root` that have not yet been grafted"""
+        with self._lock:
+            return len(self._pending.get(id(root), ()))
+
+    def graft(self, root: Match) -> Iterator[Match]:
+        """Waits for the tasks submitted under `root`, grafts their matches into its tree, and yields them"""
+        with self._lock:
+            tasks = self._pending.pop(id(root), [])
+        # the number of matches already grafted into each parent, by id
+        grafted: Dict[int, int] = {}
+        num_finished = 0
+        try:
+            for task in tasks:
+                num_finished += 1
+                parent = task.parent
+                try:
+                    records, limits_reached, decompressed_bytes = task.future.result()
+                except Exception as e:
+                    log.warning(f"Error matching {task.size} bytes of embedded data at byte offset "
+                                f"{parent.offset}: {e!s}")
+                    continue
+                finally:
+                    # the matches the task created are counted as they are reconstructed
+                    parent.matcher.quota.release(task.reservation)
+                if not _merge_quota(parent.matcher.quota, limits_reached, decompressed_bytes):
+                    # the quota is exhausted, so stop analyzing
+                    break
+                num_children = len(parent)
+                matches: Dict[int, Match] = {ROOT_ID: parent}
+                yielded: List[Match] = []
+                try:
+                    for record in records:
+                        match = _reconstruct(record, matches)
+                        if record[3]:
+                            yielded.append(match)
+                finally:
+                    # move the new matches to where they would have been added if they were matched in process
+                    new_children = parent._children[num_children:]
+                    position = task.position + grafted.get(id(parent), 0)
+                    if position < num_children:
+                        del parent._children[num_children:]
+                        parent._children[position:position] = new_children
+                        parent._children_view = None
+                    grafted[id(parent)] = grafted.get(id(parent), 0) + len(new_children)
+                yield from yielded
+        finally:
+            for task in tasks[num_finished:]:
+                task.cancel()
+
+    def discard(self, root: Match):
+        """Cancels any tasks submitted under `root` that have not been grafted"""
+        with self._lock:
+            tasks = self._pending.pop(id(root), [])
+        for task in tasks:
+            task.cancel()
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            pending, self._pending = self._pending, {}
+        for tasks in pending.values():
+            for task in tasks:
+                task.cancel()
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self) -> "EmbeddedScheduler":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
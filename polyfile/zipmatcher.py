@@ -1,23 +1,22 @@
 from io import BytesIO
-from pathlib import Path
 from typing import Iterator, Optional
 from zipfile import ZipFile as PythonZip
 
-from .fileutils import ExactNamedTempfile, FileStream, Tempfile
+from .fileutils import FileStream
 from .logger import StatusLogger
-from .magic import AbsoluteOffset, FailedTest, MagicMatcher, MagicTest, MatchedTest, TestResult, TestType
-from .polyfile import InvalidMatch, register_parser
+from .magic import AbsoluteOffset, FailedTest, MagicTest, MatchedTest, TestResult, TestType
+from .plugins import RELAXED_ZIP_MAGIC
+from .polyfile import InvalidMatch
 from .structmatcher import PolyFileStruct
 from .structs import ByteField, Constant, Endianness, StructError, UInt16, UInt32
 
 log = StatusLogger("polyfile")
 
-with ExactNamedTempfile(b"""# The default libmagic tests for detecting ZIPs assumes they start at byte offset zero
-0 search \\x50\\x4b\\x05\\x06 ZIP end of central directory record
-!:mime application/zip
-!:ext zip
-""", name="RelaxedZipMatcher") as t:
-    relaxed_zip_matcher = MagicMatcher.DEFAULT_INSTANCE.add(Path(t))[0]
+
+def __getattr__(name: str):
+    if name == "relaxed_zip_matcher":
+        return RELAXED_ZIP_MAGIC.tests[0]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 # The default libmagic test for detecting JARs is too restrictive:
@@ -28,7 +27,7 @@ class RelaxedJarMatcher(MagicTest):
             mime="application/java-archive",
             extensions=("jar",),
             message="Java JAR archive",
-            parent=relaxed_zip_matcher
+            parent=RELAXED_ZIP_MAGIC.tests[0]
         )
 
     def subtest_type(self) -> TestType:
@@ -52,9 +51,6 @@ class RelaxedJarMatcher(MagicTest):
         return FailedTest(self, offset=0, message="ZIP file does not appear to be a JAR")
 
 
-MagicMatcher.DEFAULT_INSTANCE.add(RelaxedJarMatcher())
-
-
 class LocalFileHeader(PolyFileStruct):
     endianness = Endianness.LITTLE
 
@@ -150,8 +146,6 @@ class EndOfCentralDirectory(PolyFileStruct):
             return None
 
 
-@register_parser("application/zip")
-@register_parser("application/java-archive")
 def parse_zip(file_stream, parent):
     eocd = EndOfCentralDirectory.load(file_stream)
     if eocd is None:
@@ -164,20 +158,20 @@ def parse_zip(file_stream, parent):
             with file_stream.save_pos():
                 file_stream.seek(fh.start_offset)
                 zip_data = file_stream.read(eocd.start_offset + eocd.num_bytes - fh.start_offset)
-                with Tempfile(zip_data) as tmp:
-                    zf = PythonZip(tmp)
+                zf = PythonZip(BytesIO(zip_data))
         for match in fh.match(matcher=parent.matcher, parent=parent):
             is_data = False
             if match.name == "compressed_data" and match.parent.parent == parent:
                 try:
-                    match.decoded = zf.read(fh.file_name.decode("utf-8"))
+                    with zf.open(fh.file_name.decode("utf-8")) as compressed:
+                        # bound the decompression so that a zip bomb cannot exhaust memory
+                        match.decoded = parent.matcher.quota.read_decompressed(compressed)
                     is_data = True
                 except Exception as e:
                     log.warning(f"Error decompressing file {fh.file_name!r} at byte offset {match.offset}")
             yield match
             if is_data:
-                with Tempfile(match.decoded) as tmp:
-                    yield from parent.matcher.match(tmp, parent=match)
+                yield from parent.matcher.match(match.decoded, parent=match)
     for cd in cds:
         yield from cd.match(matcher=parent.matcher, parent=parent)
     yield from eocd.match(matcher=parent.matcher, parent=parent)
@@ -1,10 +1,16 @@
 from pathlib import Path
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+from time import monotonic
 from typing import Callable, Optional
 from unittest import TestCase
 
+from polyfile.fileutils import ExactNamedTempfile
 # from polyfile import logger
 import polyfile.magic
-from polyfile.magic import MagicMatcher, MAGIC_DEFS
+from polyfile.magic import CarvingIndex, MagicMatcher, MAGIC_DEFS, MatchContext
+from polyfile.manifest import MagicManifest
 
 
 # logger.setLevel(logger.TRACE)
@@ -136,6 +142,67 @@ class MagicTest(TestCase):
         self.assertIn("application/x-pie-executable", matcher.mimetypes)
         self.assertIn("application/x-sharedlib", matcher.mimetypes)
 
+    def test_shared_evaluation_nodes(self):
+        matcher = MagicMatcher.parse(*MAGIC_DEFS)
+        shared = [
+            test for test in matcher._tests_by_structure.values()
+            if test.evaluation_node is not None
+        ]
+        self.assertGreater(len(shared), 0)
+        for test in shared:
+            self.assertTrue(test.MEMOIZE_RESULTS)
+            self.assertIs(test.evaluation_node.evaluation_node, test.evaluation_node)
+        # adding the same definitions again should not introduce any new structures
+        num_structures = len(matcher._tests_by_structure)
+        self.assertEqual(matcher.share_evaluation_nodes(list(matcher)), 0)
+        self.assertEqual(len(matcher._tests_by_structure), num_structures)
+
+    def test_add_definitions(self):
+        definitions = b"""0 string POLYFILE PolyFile test
+!:mime application/x-polyfile-test
+!:ext pft
+"""
+        from_string = MagicMatcher().add_definitions(definitions, name="PolyFileTest")
+        with ExactNamedTempfile(definitions, name="PolyFileTest") as t:
+            from_file = MagicMatcher().add(Path(t))
+        self.assertEqual([str(test.mime) for test in from_string], [str(test.mime) for test in from_file])
+        self.assertEqual(from_string[0].extensions, {"pft"})
+        self.assertEqual(from_string[0].source_info.path, Path("PolyFileTest"))
+
+    def test_carving(self):
+        png = b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x02\x00\x00\x00"
+        data = b"\xff" * 1000 + png + b"\xff" * 10 + png
+        matches = list(MagicMatcher.DEFAULT_INSTANCE.carve(MatchContext(data, only_match_mime=True)))
+        png_offsets = sorted({offset for offset, m in matches if "image/png" in m.mimetypes})
+        self.assertEqual(png_offsets, [1000, 1000 + len(png) + 10])
+        # matches at offset zero are left to the regular magic pass
+        self.assertEqual(list(MagicMatcher.DEFAULT_INSTANCE.carve(MatchContext(png, only_match_mime=True))), [])
+
+    def test_carving_padding(self):
+        png = b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x02\x00\x00\x00"
+        data = b"\x00" * 256 * 1024 + png + b"\x00" * 256 * 1024
+        # signatures that are mostly zeros would otherwise match at every offset of the padding
+        self.assertEqual(dict(MagicMatcher.DEFAULT_INSTANCE.carving_index().candidates(b"\x00" * 256 * 1024)), {})
+        start = monotonic()
+        matches = list(MagicMatcher.DEFAULT_INSTANCE.carve(MatchContext(data, only_match_mime=True, executable=False)))
+        self.assertLess(monotonic() - start, 30.0)
+        self.assertEqual(sorted({offset for offset, m in matches if "image/png" in m.mimetypes}), [256 * 1024])
+
+    def test_carving_index(self):
+        self.assertEqual(CarvingIndex.trie_pattern([b"ab", b"abc", b"ad", b"b.d"]), b"(?:a(?:b|d)|b\\.d)")
+
+        class SignedTest:
+            def __init__(self, offset: int, literal: bytes):
+                self.signature = offset, literal
+
+            def carving_signature(self):
+                return self.signature
+
+        first, second, short = SignedTest(0, b"aba"), SignedTest(1, b"bab"), SignedTest(0, b"ab")
+        index = CarvingIndex((first, second, short), min_signature_length=3)
+        # overlapping occurrences are all found, and signatures that are too short are ignored
+        self.assertEqual(dict(index.candidates(b"xababa")), {1: [first, second], 3: [first]})
+
     def test_file_corpus(self):
         self.assertTrue(FILE_TEST_DIR.exists(), "Make sure to run `git submodule init && git submodule update` in the "
                                                 "root of this repository.")
@@ -191,3 +258,35 @@ class MagicTest(TestCase):
                                 self.assertTrue(any(m.endswith(expected) for m in matches))
                             else:
                                 self.assertIn(expected, matches)
+
+
+class MagicManifestTest(TestCase):
+    def test_manifest_is_up_to_date(self):
+        manifest = MagicManifest.load()
+        self.assertIsNotNone(
+            manifest, "the magic manifest is out of date; rebuild it with `python -m polyfile.manifest`"
+        )
+        self.assertEqual(set(manifest.mimetypes), set(MagicMatcher.DEFAULT_INSTANCE.mimetypes))
+        self.assertEqual(set(manifest.extensions), set(MagicMatcher.DEFAULT_INSTANCE.extensions))
+        # the shipped manifest must be exactly what would be built from the definitions; the default instance in this
+        # process might have been extended since it was loaded (e.g., by importing `polyfile.pdf`), so build it anew
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "manifest.json"
+            subprocess.run(
+                [sys.executable, "-m", "polyfile.manifest", "--force", "--output", str(path)],
+                cwd=str(Path(__file__).parent.parent), check=True
+            )
+            built = MagicManifest.load(path)
+        self.assertEqual(manifest.mimetypes, built.mimetypes)
+        self.assertEqual(manifest.extensions, built.extensions)
+        self.assertIn("RelaxedZipMatcher", manifest.sources(["application/zip"]))
+
+    def test_stale_manifest(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "manifest.json"
+            manifest = MagicManifest.build()
+            manifest.save(path)
+            self.assertIsNotNone(MagicManifest.load(path))
+            manifest.fingerprint = "0" * 64
+            manifest.save(path)
+            self.assertIsNone(MagicManifest.load(path))
@@ -0,0 +1,1305 @@
+import asyncio
+import base64
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import http.client
+import json
+from io import BytesIO, RawIOBase, StringIO
+from pathlib import Path
+import re
+import struct
+import subprocess
+import sys
+import tempfile
+from tempfile import TemporaryDirectory
+import threading
+from typing import Dict, List
+from unittest import TestCase
+from unittest.mock import patch, PropertyMock
+import zipfile
+import zlib
+
+from polyfile.aio import AsyncAnalyzer
+from polyfile.batch import _restore_sbud, _strip_sbud, BatchAnalyzer, batch_inputs
+from polyfile.cache import CorpusIndex, ResultCache
+from polyfile.columnar import ColumnarFormatError, ColumnarSBUD, dump
+from polyfile.polyfile import (
+    Analyzer, BlobCache, ContentsMode, hash_chunks, Match, Matcher, MatchIndex, MatchStream, PARSERS, register_parser, Submatch
+)
+from polyfile import zipmatcher
+from polyfile.fileutils import FileStream, SpooledInput
+from polyfile.magic import MagicMatcher, MatchContext
+from polyfile.plugins import HTTP_11_MIME_TYPE, RELAXED_ZIP_MAGIC
+from polyfile.profiling import Profiler, Unprofiled
+from polyfile.quotas import Quota
+from polyfile.server import AnalysisRequest, AnalysisServer, make_server, RequestError
+from polyfile.spill import StoredMatch, StoredSubmatch
+from polyfile.workers import EmbeddedScheduler, ParserError, ParserKilled, ParserPool
+
+
+def _zip_file() -> bytes:
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w") as z:
+        z.writestr("hello.txt", "Hello, world!\n")
+    return buffer.getvalue()
+
+
+SAMPLES: Dict[str, bytes] = {
+    "sample.zip": _zip_file(),
+    "sample.txt": b"This is a plain ASCII text file.\n" * 10,
+    "sample.png": b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x02\x00\x00\x00",
+    "sample.sh": b"#!/bin/sh\necho hello\n",
+}
+
+
+class ThreadSafetyTest(TestCase):
+    def setUp(self):
+        self._tmpdir = TemporaryDirectory()
+        self.paths: List[Path] = []
+        for name, content in SAMPLES.items():
+            path = Path(self._tmpdir.name) / name
+            path.write_bytes(content)
+            self.paths.append(path)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    @staticmethod
+    def _analyze(path: Path):
+        analyzer = Analyzer(path)
+        return sorted(mime for mime, _ in analyzer.mime_types()), [m.name for m in analyzer.matches()]
+
+    def test_thread_pool(self):
+        matcher = MagicMatcher.DEFAULT_INSTANCE
+        expected = [self._analyze(path) for path in self.paths]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            actual = list(executor.map(self._analyze, self.paths * 4))
+        self.assertEqual(actual, expected * 4)
+        self.assertIs(MagicMatcher.DEFAULT_INSTANCE, matcher)
+
+    def test_shared_analyzer(self):
+        analyzer = Analyzer(self.paths[0])
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: list(analyzer.matches()), range(8)))
+        for result in results:
+            self.assertEqual(result, analyzer.matches_so_far)
+        self.assertGreater(len(analyzer.matches_so_far), 0)
+
+
+class AnalyzerTest(TestCase):
+    def setUp(self):
+        self._tmpdir = TemporaryDirectory()
+        self.path = Path(self._tmpdir.name) / "sample.zip"
+        self.path.write_bytes(SAMPLES["sample.zip"])
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def test_single_pass(self):
+        analyzer = Analyzer(self.path)
+        matches = list(analyzer.matches())
+        context = analyzer.context
+        mime_types = [mimetype for mimetype, _ in analyzer.mime_types()]
+        self.assertEqual(analyzer.sbud()["length"], len(SAMPLES["sample.zip"]))
+        # the matches, MIME types, and SBUD share a single MIME-only pass
+        self.assertIsNone(analyzer.magic_matches_so_far)
+        self.assertEqual(len(analyzer._mime_pass.matches), len(list(analyzer.mime_matches())))
+        # the full pass is only run once the magic matches are needed
+        magic_matches = list(analyzer.magic_matches())
+        self.assertIs(analyzer.context, context)
+        self.assertEqual(
+            [str(m) for m in magic_matches],
+            [str(m) for m in MagicMatcher.DEFAULT_INSTANCE.match(MatchContext.load(self.path))]
+        )
+        self.assertEqual(analyzer.magic_matches_so_far, magic_matches)
+        mime_analyzer = Analyzer(self.path, only_match_mime=True)
+        self.assertEqual([mimetype for mimetype, _ in mime_analyzer.mime_types()], mime_types)
+        self.assertEqual([m.name for m in mime_analyzer.matches()], [m.name for m in matches])
+        self.assertLessEqual(len(list(mime_analyzer.magic_matches())), len(magic_matches))
+        self.assertIsNone(mime_analyzer._full_pass)
+        self.assertIn("application/zip", mime_types)
+
+    def test_sbud_contents(self):
+        data = SAMPLES["sample.zip"]
+        analyzer = Analyzer(self.path)
+        embedded = analyzer.sbud(matches=())
+        self.assertEqual(embedded["SHA256"], hashlib.sha256(data).hexdigest())
+        self.assertEqual(base64.b64decode(embedded["b64contents"]), data)
+        referenced = analyzer.sbud(matches=(), contents=ContentsMode.REFERENCE)
+        self.assertNotIn("b64contents", referenced)
+        self.assertEqual(Path(referenced["contentsPath"]), self.path.absolute())
+        omitted = analyzer.sbud(matches=(), contents=ContentsMode.OMIT)
+        self.assertNotIn("b64contents", omitted)
+        self.assertNotIn("contentsPath", omitted)
+        self.assertEqual(omitted["MD5"], hashlib.md5(data).hexdigest())
+        self.assertEqual(omitted["length"], len(data))
+
+    def test_write_sbud(self):
+        class Writes(StringIO):
+            def __init__(self):
+                super().__init__()
+                self.writes = []
+
+            def write(self, s):
+                self.writes.append(s)
+                return super().write(s)
+
+        analyzer = Analyzer(self.path)
+        output = Writes()
+        with patch("polyfile.polyfile.SBUD_CHUNK_SIZE", 30):
+            analyzer.write_sbud(output)
+        sbud = analyzer.sbud()
+        self.assertEqual(output.getvalue(), json.dumps(sbud))
+        # the contents are written one chunk at a time
+        self.assertGreater(len(sbud["b64contents"]), 80)
+        self.assertEqual(output.writes[2:4], [sbud["b64contents"][:40], sbud["b64contents"][40:80]])
+
+    def test_try_all_offsets(self):
+        path = Path(self._tmpdir.name) / "firmware.bin"
+        path.write_bytes(b"\xff" * 1000 + SAMPLES["sample.zip"])
+        self.assertNotIn(1000, [m.offset for m in Analyzer(path).matches()])
+        carved = [m for m in list(Analyzer(path, try_all_offsets=True).matches()) if m.offset == 1000]
+        self.assertIn("application/zip", [m.name for m in carved])
+        # the carved file is parsed, too
+        zip_match = next(m for m in carved if m.name == "application/zip")
+        self.assertGreater(len(zip_match), 0)
+        self.assertEqual(zip_match.length, len(SAMPLES["sample.zip"]))
+
+    def test_hash_chunks(self):
+        chunks = [bytes([i]) * 10000 for i in range(10)]
+        digests = hash_chunks(chunks)
+        self.assertEqual(digests["SHA1"], hashlib.sha1(b"".join(chunks)).hexdigest())
+
+
+class InMemoryMatchingTest(TestCase):
+    def test_match_in_memory(self):
+        data = SAMPLES["sample.zip"]
+        matcher = Matcher()
+        expected = [m.name for m in matcher.match(data)]
+        self.assertIn("application/zip", expected)
+        self.assertEqual([m.name for m in matcher.match(memoryview(data))], expected)
+        self.assertEqual([m.name for m in matcher.match(bytearray(data))], expected)
+        with FileStream(b"\0" * 16 + data) as stream:
+            self.assertEqual([m.name for m in matcher.match(stream[16:])], expected)
+
+    def test_file_stream_views(self):
+        with FileStream(b"0123456789") as stream:
+            view = stream[2:8]
+            nested = view[1:-1]
+            self.assertEqual(bytes(view), b"234567")
+            self.assertEqual(bytes(nested), b"3456")
+            self.assertEqual(nested.offset(), 3)
+            self.assertIs(nested.root, stream)
+            self.assertEqual(view[0], b"2")
+            self.assertEqual(view[-1], b"7")
+            self.assertEqual(view[6], b"")
+            # each view has its own position
+            self.assertEqual(view.read(2), b"23")
+            self.assertEqual(nested.read(), b"3456")
+            self.assertEqual(stream.tell(), 0)
+            self.assertEqual(view.read(), b"4567")
+            self.assertEqual(view.first_index_of(b"56"), 3)
+            self.assertEqual(nested.first_index_of(b"7"), -1)
+            self.assertRaises(IndexError, view.seek, -1)
+            self.assertRaises(IndexError, view.seek, 7)
+            content = nested.content
+            self.assertIsInstance(content, memoryview)
+            self.assertEqual(content.tobytes(), b"3456")
+
+    def test_file_stream_shares_mapping(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "data.bin"
+            path.write_bytes(b"\x00" * 1024 + b"needle")
+            with FileStream(path) as first, FileStream(str(path)) as second:
+                self.assertIs(first._data, second._data)
+                self.assertTrue(first[1000:].contains_all(b"needle", b"\x00"))
+                self.assertEqual(bytes(second[1024:]), b"needle")
+
+    def test_no_temporary_files(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "sample.zip"
+            path.write_bytes(SAMPLES["sample.zip"])
+            with patch("tempfile.NamedTemporaryFile", wraps=tempfile.NamedTemporaryFile) as named_temporary_file:
+                matches = list(Analyzer(path).matches())
+        self.assertGreater(len(matches), 0)
+        # parser exceptions are logged rather than raised, so check that no temporary file was even attempted
+        named_temporary_file.assert_not_called()
+
+
+class _Pipe(RawIOBase):
+    """A non-seekable stream, like STDIN when it is a pipe"""
+
+    def __init__(self, data: bytes):
+        self._data = BytesIO(data)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        return self._data.readinto(buffer)
+
+
+class InputTest(TestCase):
+    def setUp(self):
+        self._tmpdir = TemporaryDirectory()
+        self.path = Path(self._tmpdir.name) / "sample.zip"
+        self.path.write_bytes(SAMPLES["sample.zip"])
+        self.expected = _tree(list(Analyzer(self.path).matches()))
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _assert_same(self, analyzer: Analyzer):
+        with patch("tempfile.NamedTemporaryFile", wraps=tempfile.NamedTemporaryFile) as named_temporary_file:
+            self.assertEqual(_tree(list(analyzer.matches())), self.expected)
+            sbud = analyzer.sbud(contents=ContentsMode.EMBED)
+        named_temporary_file.assert_not_called()
+        self.assertEqual(base64.b64decode(sbud["b64contents"]), SAMPLES["sample.zip"])
+        analyzer.close()
+
+    def test_bytes(self):
+        data = SAMPLES["sample.zip"]
+        analyzer = Analyzer(data, name="sample.zip")
+        self._assert_same(analyzer)
+        self.assertIsNone(analyzer.path)
+        self.assertEqual(analyzer.name, "sample.zip")
+        self._assert_same(Analyzer(bytearray(data)))
+        self._assert_same(Analyzer(memoryview(data)))
+        self._assert_same(Analyzer(memoryview(b"\0" + data)[1:]))
+
+    def test_streams(self):
+        self._assert_same(Analyzer(BytesIO(SAMPLES["sample.zip"])))
+        with open(self.path, "rb") as f:
+            analyzer = Analyzer(f)
+            self.assertEqual(analyzer.name, str(self.path))
+            self._assert_same(analyzer)
+
+    def test_pipe(self):
+        spooled = SpooledInput(_Pipe(SAMPLES["sample.zip"]))
+        self.assertEqual(spooled.data, SAMPLES["sample.zip"])
+        self.assertFalse(spooled.spilled)
+        self._assert_same(Analyzer(_Pipe(SAMPLES["sample.zip"])))
+
+    def test_spill(self):
+        spooled = SpooledInput(_Pipe(SAMPLES["sample.zip"]), max_memory=16)
+        self.assertEqual(spooled.data[:], SAMPLES["sample.zip"])
+        self.assertTrue(spooled.spilled)
+        spooled.close()
+        self._assert_same(Analyzer(_Pipe(SAMPLES["sample.zip"]), spool_threshold=16))
+
+    def test_reference_without_path(self):
+        sbud = Analyzer(SAMPLES["sample.zip"]).sbud(contents=ContentsMode.REFERENCE)
+        self.assertNotIn("contentsPath", sbud)
+        self.assertEqual(sbud["fileName"], "-")
+
+
+def _nested_zip(depth: int) -> bytes:
+    data = SAMPLES["sample.zip"]
+    for _ in range(depth):
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, "w") as z:
+            z.writestr("nested.zip", data)
+        data = buffer.getvalue()
+    return data
+
+
+def _zip_bomb() -> bytes:
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        z.writestr("zeros.bin", b"\0" * 1024 * 1024)
+    return buffer.getvalue()
+
+
+class QuotaTest(TestCase):
+    def setUp(self):
+        self._tmpdir = TemporaryDirectory()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _analyze(self, data: bytes, quota: Quota) -> Analyzer:
+        path = Path(self._tmpdir.name) / "input.zip"
+        path.write_bytes(data)
+        analyzer = Analyzer(path, quota=quota)
+        list(analyzer.matches())
+        return analyzer
+
+    @staticmethod
+    def _all_matches(matches) -> List[Match]:
+        ret = []
+        for match in matches:
+            ret.append(match)
+            ret.extend(QuotaTest._all_matches(match))
+        return ret
+
+    def test_unlimited(self):
+        analyzer = self._analyze(_zip_bomb(), Quota())
+        self.assertNotIn("limitsReached", analyzer.sbud(contents=ContentsMode.OMIT))
+        decoded = [m.decoded for m in self._all_matches(analyzer.matches()) if m.name == "compressed_data"]
+        self.assertEqual([len(d) for d in decoded], [1024 * 1024])
+
+    def test_max_decompressed_bytes(self):
+        analyzer = self._analyze(_zip_bomb(), Quota(max_decompressed_bytes=1000))
+        decoded = [m.decoded for m in self._all_matches(analyzer.matches()) if m.name == "compressed_data"]
+        self.assertEqual(decoded, [b"\0" * 1000])
+        self.assertEqual(analyzer.sbud(contents=ContentsMode.OMIT)["limitsReached"], {"max_decompressed_bytes": 1000})
+
+    def test_max_depth(self):
+        data = _nested_zip(3)
+        unlimited = self._all_matches(self._analyze(data, Quota()).matches())
+        self.assertGreater(max(m.embedding_depth for m in unlimited), 1)
+        analyzer = self._analyze(data, Quota(max_depth=1))
+        limited = self._all_matches(analyzer.matches())
+        self.assertEqual(max(m.embedding_depth for m in limited), 1)
+        self.assertEqual(analyzer.quota.limits_reached, {"max_depth": 1})
+
+    def test_max_embedded_size(self):
+        analyzer = self._analyze(_nested_zip(1), Quota(max_embedded_size=16))
+        embedded = [m for m in self._all_matches(analyzer.matches()) if m.embedding_depth > 0]
+        self.assertLessEqual(max(m.length for m in embedded), 16)
+        self.assertIn("max_embedded_size", analyzer.quota.limits_reached)
+
+    def test_max_nodes(self):
+        analyzer = self._analyze(_nested_zip(2), Quota(max_nodes=10))
+        matches = self._all_matches(analyzer.matches())
+        self.assertGreater(len(matches), 0)
+        self.assertLessEqual(len(matches), 10)
+        self.assertEqual(analyzer.sbud(contents=ContentsMode.OMIT)["limitsReached"], {"max_nodes": 10})
+
+    def test_decompress(self):
+        compressed = zlib.compress(b"A" * 100)
+        self.assertEqual(Quota().decompress(compressed), b"A" * 100)
+        quota = Quota(max_decompressed_bytes=150)
+        self.assertEqual(quota.decompress(compressed), b"A" * 100)
+        self.assertEqual(quota.limits_reached, {})
+        self.assertEqual(quota.decompress(compressed), b"A" * 50)
+        self.assertEqual(quota.decompress(compressed), b"")
+        self.assertEqual(quota.limits_reached, {"max_decompressed_bytes": 150})
+        # incomplete data are an error whether or not there is a quota, unless the output is truncated anyway
+        with self.assertRaises(zlib.error):
+            Quota(max_decompressed_bytes=150).decompress(compressed[:-4])
+        self.assertEqual(Quota(max_decompressed_bytes=50).decompress(compressed[:-4]), b"A" * 50)
+
+    def test_read_decompressed(self):
+        class Trickle(RawIOBase):
+            """A stream that returns a single byte per read"""
+            def __init__(self, data: bytes):
+                self.data = data
+
+            def readable(self):
+                return True
+
+            def readinto(self, buffer):
+                if not self.data or not len(buffer):
+                    return 0
+                buffer[0] = self.data[0]
+                self.data = self.data[1:]
+                return 1
+
+        self.assertEqual(Quota(max_decompressed_bytes=150).read_decompressed(Trickle(b"A" * 100)), b"A" * 100)
+        quota = Quota(max_decompressed_bytes=50)
+        self.assertEqual(quota.read_decompressed(Trickle(b"A" * 100)), b"A" * 50)
+        self.assertEqual(quota.limits_reached, {"max_decompressed_bytes": 50})
+
+    def test_reserve(self):
+        quota = Quota(max_nodes=10, max_decompressed_bytes=100)
+        first = quota.reserve(3)
+        second = quota.reserve(3)
+        self.assertEqual((first.nodes, first.decompressed_bytes), (4, 34))
+        self.assertEqual((second.nodes, second.decompressed_bytes), (2, 22))
+        self.assertEqual((quota.remaining_nodes, quota.remaining_decompressed_bytes), (4, 44))
+        # reserved resources are not available to the main process
+        self.assertEqual(quota.decompress(zlib.compress(b"A" * 100)), b"A" * 44)
+        quota.release(first)
+        self.assertTrue(quota.account_decompressed(34))
+        self.assertFalse(quota.account_decompressed(1))
+        self.assertEqual(quota.limits_reached, {"max_decompressed_bytes": 100})
+        unlimited = Quota().reserve(3)
+        self.assertEqual((unlimited.nodes, unlimited.decompressed_bytes), (None, None))
+
+
+def _tree(matches: List[Match]) -> List[Dict]:
+    """The SBUD representation of the given matches, without the addresses in the values of unprintable objects"""
+    def normalize(obj: Dict) -> Dict:
+        obj = dict(obj)
+        obj["value"] = re.sub(r" at 0x[0-9a-f]+", "", obj["value"])
+        obj["subEls"] = [normalize(child) for child in obj["subEls"]]
+        return obj
+    return [normalize(match.to_obj()) for match in matches]
+
+
+HANGING_MIMETYPE = "application/x-polyfile-test-hang"
+FAILING_MIMETYPE = "application/x-polyfile-test-fail"
+
+
+def _hanging_parser(file_stream, parent):
+    yield Submatch("Before", file_stream.read(4), relative_offset=0, length=4, parent=parent)
+    while True:
+        pass
+
+
+def _failing_parser(file_stream, parent):
+    yield Submatch("Before", file_stream.read(4), relative_offset=0, length=4, parent=parent)
+    raise ValueError("malformed input")
+
+
+class ParserPoolTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.hanging_parser = register_parser(HANGING_MIMETYPE)(_hanging_parser)
+        cls.failing_parser = register_parser(FAILING_MIMETYPE)(_failing_parser)
+
+    @classmethod
+    def tearDownClass(cls):
+        del PARSERS[HANGING_MIMETYPE]
+        del PARSERS[FAILING_MIMETYPE]
+
+    def _root(self, mimetype: str) -> Match:
+        return Match(mimetype, None, 0, length=8, matcher=Matcher(parse=False))
+
+    def test_same_matches(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "nested.zip"
+            path.write_bytes(_nested_zip(2))
+            # the tree of a top-level match is only complete once the next one has been found
+            expected = _tree(list(Analyzer(path).matches()))
+            with ParserPool(max_workers=2) as pool:
+                actual = _tree(list(Analyzer(path, parser_pool=pool).matches()))
+        self.assertGreater(len(expected[0]["subEls"]), 0)
+        self.assertEqual(actual, expected)
+
+    def test_timeout(self):
+        with ParserPool(max_workers=1, timeout=1.0) as pool:
+            root = self._root(HANGING_MIMETYPE)
+            submatches = []
+            with self.assertRaises(ParserKilled):
+                for submatch in pool.parse(self.hanging_parser, HANGING_MIMETYPE, b"ABCDEFGH", root):
+                    submatches.append(submatch)
+            # the matches produced before the parser was killed are kept
+            self.assertEqual([m.name for m in submatches], ["Before"])
+            self.assertEqual(root.children, tuple(submatches))
+            # the killed worker is replaced
+            failing_root = self._root(FAILING_MIMETYPE)
+            with self.assertRaises(ParserError):
+                list(pool.parse(self.failing_parser, FAILING_MIMETYPE, b"ABCDEFGH", failing_root))
+            self.assertEqual(len(failing_root), 1)
+
+    def test_killed_parser_keeps_magic_match(self):
+        with ParserPool(max_workers=1, timeout=1.0) as pool:
+            matcher = Matcher(parser_pool=pool)
+            root = self._root(HANGING_MIMETYPE)
+            result = next(iter(MagicMatcher.DEFAULT_INSTANCE.match(b"\x89PNG\r\n\x1a\n")))[0]
+            matches = list(matcher.handle_mimetype(HANGING_MIMETYPE, result, b"ABCDEFGH", b"ABCDEFGH", parent=root))
+        self.assertEqual([m.name for m in matches], [HANGING_MIMETYPE, "Before"])
+
+
+def _archive(num_members: int) -> bytes:
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        for i in range(num_members):
+            z.writestr(f"member{i}.zip", _nested_zip(i % 3))
+            z.writestr(f"member{i}.txt", SAMPLES["sample.txt"])
+    return buffer.getvalue()
+
+
+class EmbeddedSchedulerTest(TestCase):
+    def test_same_tree(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "archive.zip"
+            path.write_bytes(_archive(2))
+            expected = _tree(list(Analyzer(path).matches()))
+            with EmbeddedScheduler(max_workers=4, min_size=0) as scheduler:
+                actual = _tree(list(Analyzer(path, scheduler=scheduler).matches()))
+                # analyzing a second file with the same scheduler also works
+                again = _tree(list(Analyzer(path, scheduler=scheduler).matches()))
+        self.assertGreater(len(expected[0]["subEls"]), 0)
+        self.assertEqual(again, expected)
+        self.assertEqual(actual, expected)
+
+    def test_small_content_is_matched_in_process(self):
+        scheduler = EmbeddedScheduler(min_size=1024)
+        parent = Match("parent", None, matcher=Matcher(parse=False, scheduler=scheduler))
+        self.assertFalse(scheduler.submit(b"small", parent))
+        scheduler.close()
+
+    def test_custom_matchers_are_matched_in_process(self):
+        with EmbeddedScheduler(min_size=0) as scheduler, ParserPool(max_workers=1) as pool:
+            png = MagicMatcher.DEFAULT_INSTANCE.only_match(mimetypes=["image/png"])
+            for matcher in (Matcher(matcher=png, scheduler=scheduler), Matcher(parser_pool=pool, scheduler=scheduler)):
+                parent = Match("parent", None, matcher=matcher)
+                self.assertFalse(scheduler.submit(SAMPLES["sample.zip"], parent))
+                self.assertEqual(scheduler.pending(parent.root), 0)
+
+    def test_quota(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "archive.zip"
+            path.write_bytes(_archive(2))
+            with EmbeddedScheduler(max_workers=2, min_size=0) as scheduler:
+                analyzer = Analyzer(path, scheduler=scheduler, quota=Quota(max_depth=1))
+                matches = QuotaTest._all_matches(list(analyzer.matches()))
+        self.assertEqual(max(m.embedding_depth for m in matches), 1)
+        self.assertIn("max_depth", analyzer.quota.limits_reached)
+
+    def test_shared_quota(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "archive.zip"
+            path.write_bytes(_archive(4))
+            unlimited = Analyzer(path)
+            list(unlimited.matches())
+            max_decompressed_bytes = unlimited.quota.decompressed_bytes // 2
+            with EmbeddedScheduler(max_workers=4, min_size=0) as scheduler:
+                analyzer = Analyzer(path, scheduler=scheduler, quota=Quota(
+                    max_nodes=100, max_decompressed_bytes=max_decompressed_bytes
+                ))
+                matches = QuotaTest._all_matches(list(analyzer.matches()))
+        # the concurrent tasks share the quota rather than each getting all that remains
+        self.assertLessEqual(len(matches), 100)
+        self.assertLessEqual(analyzer.quota.nodes, 100)
+        self.assertLessEqual(analyzer.quota.decompressed_bytes, max_decompressed_bytes)
+        self.assertEqual(analyzer.quota.remaining_nodes, 100 - analyzer.quota.nodes)
+
+
+class BlobCacheTest(TestCase):
+    @staticmethod
+    def _roots(matcher: Matcher, data: bytes) -> List[Match]:
+        return [match for match in matcher.match(data) if match.parent is None]
+
+    def test_same_tree(self):
+        # members 0 and 3 are identical, as are all of the text members
+        data = _archive(4)
+        expected = _tree(self._roots(Matcher(), data))
+        matcher = Matcher(deduplicate=True)
+        actual = _tree(self._roots(matcher, data))
+        self.assertGreater(matcher.blob_cache.hits, 0)
+        self.assertEqual(actual, expected)
+
+    def test_offsets_are_relocated(self):
+        matcher = Matcher(deduplicate=True)
+        first = Match("first", None, 100, matcher=matcher)
+        second = Match("second", None, 5000, matcher=matcher)
+        expected = [(m.name, m.relative_offset, m.length) for m in matcher.match(SAMPLES["sample.zip"], parent=first)]
+        hits = matcher.blob_cache.hits
+        grafted = list(matcher.match(SAMPLES["sample.zip"], parent=second))
+        self.assertEqual(matcher.blob_cache.hits, hits + 1)
+        self.assertEqual([(m.name, m.relative_offset, m.length) for m in grafted], expected)
+        originals = QuotaTest._all_matches(first)
+        copies = QuotaTest._all_matches(second)
+        self.assertEqual([m.offset + 4900 for m in originals], [m.offset for m in copies])
+        self.assertEqual([m.name for m in originals], [m.name for m in copies])
+        self.assertEqual(grafted[0].offset, 5000)
+
+    def test_quota(self):
+        data = _archive(4)
+        expected = Matcher(quota=Quota(max_nodes=150))
+        expected_tree = _tree(self._roots(expected, data))
+        matcher = Matcher(deduplicate=True, quota=Quota(max_nodes=150))
+        self.assertEqual(_tree(self._roots(matcher, data)), expected_tree)
+        self.assertEqual(matcher.quota.nodes, expected.quota.nodes)
+
+    def test_max_nodes(self):
+        self.assertIsNone(Matcher().blob_cache)
+        data = _archive(4)
+        expected = _tree(self._roots(Matcher(), data))
+        matcher = Matcher(deduplicate=True)
+        matcher.blob_cache = BlobCache(max_nodes=20)
+        self.assertEqual(_tree(self._roots(matcher, data)), expected)
+        self.assertGreater(len(matcher.blob_cache), 0)
+        self.assertLessEqual(matcher.blob_cache.nodes, 20)
+        self.assertEqual(matcher.blob_cache.nodes, sum(len(e.nodes) for e in matcher.blob_cache._entries.values()))
+
+
+class AsyncAnalyzerTest(TestCase):
+    def setUp(self):
+        self._tmpdir = TemporaryDirectory()
+        self.path = Path(self._tmpdir.name) / "archive.zip"
+        self.path.write_bytes(_archive(1))
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    @staticmethod
+    async def _amatches(analyzer: AsyncAnalyzer) -> List[Match]:
+        return [match async for match in analyzer.amatches()]
+
+    def test_thread_executor(self):
+        expected = _tree(list(Analyzer(self.path).matches()))
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            analyzer = AsyncAnalyzer(self.path, executor=executor)
+            matches = asyncio.run(self._amatches(analyzer))
+        self.assertEqual(_tree(matches), expected)
+        self.assertEqual(analyzer.matches_so_far, matches)
+
+    def test_process_executor(self):
+        expected = _tree(list(Analyzer(self.path).matches()))
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            matches = asyncio.run(self._amatches(AsyncAnalyzer(self.path, executor=executor)))
+        self.assertEqual(_tree(matches), expected)
+
+    def test_quota(self):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            analyzer = AsyncAnalyzer(self.path, executor=executor, quota=Quota(max_depth=0))
+            matches = asyncio.run(self._amatches(analyzer))
+        self.assertEqual(max(m.embedding_depth for m in QuotaTest._all_matches(matches)), 0)
+        self.assertIn("max_depth", analyzer.quota.limits_reached)
+        # a worker process gets the same node quota as an analysis in this process
+        expected = Analyzer(self.path, quota=Quota(max_nodes=5))
+        expected_matches = list(expected.matches())
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            analyzer = AsyncAnalyzer(self.path, executor=executor, quota=Quota(max_nodes=5))
+            matches = asyncio.run(self._amatches(analyzer))
+        self.assertEqual(_tree(matches), _tree(expected_matches))
+        self.assertEqual(analyzer.quota.limits_reached, expected.quota.limits_reached)
+
+    def test_bounded_concurrency(self):
+        running = 0
+        max_running = 0
+
+        path = Path(self._tmpdir.name) / "sample.zip"
+        path.write_bytes(SAMPLES["sample.zip"])
+
+        async def analyze(limiter: asyncio.Semaphore):
+            nonlocal running, max_running
+            async for _ in AsyncAnalyzer(path, limiter=limiter).amatches():
+                running += 1
+                max_running = max(max_running, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+
+        async def analyze_all():
+            limiter = asyncio.Semaphore(2)
+            await asyncio.gather(*(analyze(limiter) for _ in range(4)))
+
+        asyncio.run(analyze_all())
+        self.assertEqual(max_running, 2)
+
+    def test_cancellation(self):
+        async def cancel():
+            task = asyncio.create_task(self._amatches(AsyncAnalyzer(self.path)))
+            await asyncio.sleep(0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancel())
+
+
+class BatchTest(TestCase):
+    def setUp(self):
+        self._tmpdir = TemporaryDirectory()
+        self.root = Path(self._tmpdir.name) / "corpus"
+        for i, (name, content) in enumerate(SAMPLES.items()):
+            path = self.root / f"dir{i % 2}" / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(content)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def test_inputs(self):
+        list_path = Path(self._tmpdir.name) / "list.txt"
+        list_path.write_text(f"{self.root / 'dir0'}\n\n{self.root / 'dir1' / 'sample.sh'}\n")
+        inputs = batch_inputs([str(self.root), f"@{list_path}"])
+        self.assertEqual([i.name for i in inputs], [
+            "dir0/sample.png", "dir0/sample.zip", "dir1/sample.sh", "dir1/sample.txt",
+            "sample.png", "sample.zip", "sample.sh"
+        ])
+        self.assertEqual(inputs[1].size, len(SAMPLES["sample.zip"]))
+
+    def test_same_results(self):
+        inputs = batch_inputs([str(self.root)])
+        expected = {
+            i.path: [mimetype for mimetype, _ in Analyzer(i.path).mime_types()] for i in inputs
+        }
+        for jobs in (1, 3):
+            with BatchAnalyzer(formats=("mime", "json"), jobs=jobs) as batch:
+                results = list(batch.run(inputs))
+            self.assertEqual({result["path"]: result["mime"] for result in results}, expected)
+            for result in results:
+                self.assertEqual(result["json"]["fileName"], result["path"])
+            # the largest file is scheduled first
+            if jobs == 1:
+                self.assertEqual(results[0]["path"], max(inputs, key=lambda i: i.size).path)
+
+    def test_cache(self):
+        (self.root / "dir1" / "copy.zip").write_bytes(SAMPLES["sample.zip"])
+        inputs = batch_inputs([str(self.root)])
+        formats = ("mime", "json", "ndjson")
+        with BatchAnalyzer(formats=formats, jobs=1) as batch:
+            expected = {result["path"]: result for result in batch.run(inputs)}
+        with ResultCache(Path(self._tmpdir.name) / "cache.db") as cache:
+            for jobs in (1, 2):
+                with BatchAnalyzer(formats=formats, jobs=jobs, cache=cache) as batch:
+                    results = {result["path"]: result for result in batch.run(inputs)}
+                self.assertEqual(results.keys(), expected.keys())
+                for path, result in results.items():
+                    self.assertEqual(result.pop("cached", False), jobs > 1 or path.endswith("copy.zip"))
+                    # the values of unprintable objects include their addresses
+                    self.assertEqual(
+                        re.sub(r" at 0x[0-9a-f]+", "", json.dumps(result)),
+                        re.sub(r" at 0x[0-9a-f]+", "", json.dumps(expected[path]))
+                    )
+            self.assertEqual(len(cache), len(SAMPLES))
+            # a parser that is killed leaves the results partial, so they are not shared across parser limits
+            with BatchAnalyzer(formats=formats, jobs=1, cache=cache, parser_timeout=60.0) as batch:
+                results = list(batch.run(batch_inputs([str(self.root / "dir0")])))
+            self.assertTrue(results)
+            self.assertFalse(any(result.get("cached", False) for result in results))
+
+    def test_incremental(self):
+        with CorpusIndex(Path(self._tmpdir.name) / "index.db") as index:
+            with BatchAnalyzer(formats=("mime",), jobs=2, index=index) as batch:
+                first = {result["path"]: result for result in batch.run(batch_inputs([str(self.root)]))}
+            self.assertEqual(len(index), len(SAMPLES))
+            modified = self.root / "dir1" / "sample.txt"
+            modified.write_bytes(SAMPLES["sample.zip"])
+            deleted = self.root / "dir0" / "sample.png"
+            deleted.unlink()
+            with BatchAnalyzer(formats=("mime",), jobs=2, index=index) as batch:
+                second = {result["path"]: result for result in batch.run(batch_inputs([str(self.root)]))}
+            self.assertEqual(second.pop(str(deleted)), {"path": str(deleted), "deleted": True})
+            self.assertNotIn("unchanged", second.pop(str(modified)))
+            self.assertEqual(second.keys(), first.keys() - {str(deleted), str(modified)})
+            for path, result in second.items():
+                self.assertTrue(result.pop("unchanged"))
+                self.assertEqual(result, first[path])
+            self.assertEqual(len(index), len(SAMPLES) - 1)
+            self.assertNotIn(str(deleted), list(index.paths()))
+            # results recorded with different parser limits are not reused
+            with BatchAnalyzer(formats=("mime",), jobs=1, index=index, parser_timeout=60.0) as batch:
+                third = list(batch.run(batch_inputs([str(self.root)])))
+            self.assertEqual(len(third), len(SAMPLES) - 1)
+            self.assertFalse(any(result.get("unchanged", False) for result in third))
+
+    def test_output_dir(self):
+        output_dir = Path(self._tmpdir.name) / "output"
+        with BatchAnalyzer(formats=("mime",), jobs=2, output_dir=str(output_dir)) as batch:
+            results = list(batch.run(batch_inputs([str(self.root)])))
+        self.assertEqual(len(results), len(SAMPLES))
+        expected = "".join(f"{mimetype}\n" for mimetype, _ in Analyzer(self.root / "dir0" / "sample.zip").mime_types())
+        self.assertEqual((output_dir / "dir0" / "sample.zip.mime").read_text(), expected)
+        for result in results:
+            self.assertNotIn("error", result)
+            self.assertEqual(len(result["outputs"]), 1)
+
+    def test_ndjson_output_dir(self):
+        output_dir = Path(self._tmpdir.name) / "output"
+        with BatchAnalyzer(formats=("ndjson", "mime"), jobs=1, output_dir=str(output_dir)) as batch:
+            results = list(batch.run(batch_inputs([str(self.root / "dir0")])))
+        for result in results:
+            self.assertNotIn("error", result)
+            self.assertEqual(len(result["outputs"]), 2)
+        path = self.root / "dir0" / "sample.zip"
+        expected: List[Dict] = []
+        for _ in Analyzer(path).stream(expected.append):
+            pass
+        # the values of unprintable objects include their addresses
+        actual = re.sub(r" at 0x[0-9a-f]+", "", (output_dir / "sample.zip.ndjson").read_text())
+        self.assertEqual(actual, re.sub(r" at 0x[0-9a-f]+", "", "".join(f"{json.dumps(e)}\n" for e in expected)))
+
+    def test_restore_sbud(self):
+        path = str(self.root / "dir0" / "sample.zip")
+        sbud = Analyzer(path).sbud()
+        with patch("polyfile.batch.SBUD_CHUNK_SIZE", 30):
+            self.assertEqual(_restore_sbud(_strip_sbud(sbud), path, ContentsMode.EMBED), sbud)
+
+    def test_error(self):
+        path = self.root / "dir0" / "sample.zip"
+        inputs = batch_inputs([str(path)])
+        path.unlink()
+        with BatchAnalyzer(jobs=1) as batch:
+            results = list(batch.run(inputs))
+        self.assertEqual(len(results), 1)
+        self.assertIn("error", results[0])
+
+
+class ResultCacheTest(TestCase):
+    def test_lru_eviction(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "cache.db"
+            value = {"data": base64.b64encode(bytes(range(256)) * 4).decode("utf-8")}
+            with ResultCache(path) as cache:
+                cache.put("first", value)
+                entry_size = cache.size
+            with ResultCache(path, max_size=entry_size * 2, access_interval=0.0) as cache:
+                self.assertEqual(cache.get("first"), value)
+                cache.put("second", value)
+                # reading the first entry makes the second one the least recently used
+                self.assertEqual(cache.get("first"), value)
+                cache.put("third", value)
+                self.assertIn("first", cache)
+                self.assertNotIn("second", cache)
+                self.assertIn("third", cache)
+                self.assertLessEqual(cache.size, cache.max_size)
+                self.assertIsNone(cache.get("second"))
+
+    def test_access_interval(self):
+        with TemporaryDirectory() as tmpdir:
+            with ResultCache(Path(tmpdir) / "cache.db") as cache:
+                cache.put("key", {"value": 1})
+                with patch.object(ResultCache, "_file_lock", new_callable=PropertyMock) as file_lock:
+                    # a hit on a recently used entry does not write to the database
+                    self.assertEqual(cache.get("key"), {"value": 1})
+                    file_lock.assert_not_called()
+                    cache.access_interval = 0.0
+                    self.assertEqual(cache.get("key"), {"value": 1})
+                    file_lock.assert_called_once()
+
+    def test_keys(self):
+        sha256 = hashlib.sha256(b"").hexdigest()
+        key = ResultCache.key(sha256, {"parse": True})
+        self.assertEqual(ResultCache.key(sha256, {"parse": True}), key)
+        self.assertNotEqual(ResultCache.key(sha256, {"parse": False}), key)
+        self.assertNotEqual(ResultCache.key(hashlib.sha256(b"x").hexdigest(), {"parse": True}), key)
+
+
+class ServerTest(TestCase):
+    def setUp(self):
+        self._tmpdir = TemporaryDirectory()
+        self.path = Path(self._tmpdir.name) / "sample.zip"
+        self.path.write_bytes(SAMPLES["sample.zip"])
+        self.server = make_server(
+            AnalysisServer(max_concurrent=2, allowed_paths=(self._tmpdir.name,)), host="127.0.0.1", port=0
+        )
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._tmpdir.cleanup()
+
+    def _request(self, method: str, url: str, body: bytes = None):
+        connection = http.client.HTTPConnection("127.0.0.1", self.server.server_address[1], timeout=60)
+        try:
+            connection.request(method, url, body=body)
+            response = connection.getresponse()
+            return response.status, response.read()
+        finally:
+            connection.close()
+
+    def _analyze(self, url: str, body: bytes = None) -> List[dict]:
+        status, data = self._request("POST", url, body)
+        self.assertEqual(status, 200)
+        return [json.loads(line) for line in data.splitlines()]
+
+    def test_health(self):
+        status, data = self._request("GET", "/health")
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(data)["status"], "ok")
+
+    def test_upload(self):
+        expected = [mimetype for mimetype, _ in Analyzer(self.path).mime_types()]
+        results = self._analyze("/analyze?format=mime&format=sbud&name=sample.zip", SAMPLES["sample.zip"])
+        self.assertEqual([r["mimetype"] for r in results if r.get("format") == "mime"], expected)
+        sbud = [r["sbud"] for r in results if r.get("format") == "sbud"]
+        self.assertEqual(len(sbud), 1)
+        self.assertEqual(sbud[0]["SHA256"], hashlib.sha256(SAMPLES["sample.zip"]).hexdigest())
+        self.assertTrue(results[-1]["done"])
+        self.assertNotIn("error", results[-1])
+
+    def test_path(self):
+        results = self._analyze(f"/analyze?format=ndjson&max_depth=0&path={self.path}")
+        events = [r["event"] for r in results if r.get("format") == "ndjson"]
+        self.assertEqual(events[0]["type"], "application/zip")
+        self.assertEqual(results[-1]["limitsReached"], {"max_depth": 0})
+
+    def test_invalid_requests(self):
+        status, _ = self._request("POST", "/analyze?path=/etc/passwd")
+        self.assertEqual(status, 403)
+        status, _ = self._request("POST", "/analyze?format=bogus", b"data")
+        self.assertEqual(status, 400)
+        status, _ = self._request("GET", "/bogus")
+        self.assertEqual(status, 404)
+
+    def test_parse_query(self):
+        request = AnalysisRequest.parse_query("format=file&format=mime&max_nodes=10&deadline=1.5&only_match=1")
+        self.assertEqual(request.formats, ("file", "mime"))
+        self.assertEqual(request.quota_limits["max_nodes"], 10)
+        self.assertIsNone(request.quota_limits["max_depth"])
+        self.assertEqual(request.deadline, 1.5)
+        self.assertFalse(request.parse)
+        for query in ("max_nodes=x", "deadline=-1", "name=../x", "path=a&path=b"):
+            with self.assertRaises(RequestError):
+                AnalysisRequest.parse_query(query)
+
+    def test_max_body_size(self):
+        self.server.analysis_server.max_body_size = 16
+        status, data = self._request("POST", "/analyze", b"x" * 17)
+        self.assertEqual(status, 413)
+        self.assertIn("error", json.loads(data))
+        results = self._analyze("/analyze", b"x" * 16)
+        self.assertTrue(results[-1]["done"])
+        self.assertNotIn("error", results[-1])
+
+    def test_unix_socket_path(self):
+        # a file that is not a socket is never replaced by the server's socket
+        path = Path(self._tmpdir.name) / "not-a-socket"
+        path.write_bytes(b"data")
+        with self.assertRaises(ValueError):
+            make_server(AnalysisServer(), unix_socket=str(path))
+        self.assertEqual(path.read_bytes(), b"data")
+
+
+class MatchTreeTest(TestCase):
+    def test_incremental_lengths(self):
+        root = Match("root", None, 100, matcher=Matcher(parse=False))
+        dynamic = Submatch("dynamic", None, relative_offset=10, parent=root)
+        self.assertEqual(root.length, 10)
+        self.assertEqual(dynamic.length, 0)
+        Submatch("fixed", None, relative_offset=5, length=5, parent=dynamic)
+        self.assertEqual(dynamic.offset, 110)
+        self.assertEqual(dynamic.length, 10)
+        self.assertEqual(root.length, 20)
+        nested = Submatch("nested", None, relative_offset=2, parent=dynamic)
+        Submatch("leaf", None, relative_offset=30, length=8, parent=nested)
+        self.assertEqual(nested.offset, 112)
+        self.assertEqual(nested.length, 38)
+        self.assertEqual(dynamic.length, 40)
+        self.assertEqual(root.length, 50)
+        # a match with a fixed length is unaffected by its children
+        fixed = Submatch("fixed", None, relative_offset=0, length=1, parent=root)
+        Submatch("leaf", None, relative_offset=0, length=1000, parent=fixed)
+        self.assertEqual(fixed.length, 1)
+        self.assertEqual(root.length, 50)
+        self.assertEqual(root.children, (dynamic, fixed))
+        self.assertEqual(nested.root_offset, 12)
+
+    def test_lazy_extension(self):
+        match = Match("application/pdf", None, matcher=Matcher(parse=False))
+        self.assertEqual(match.extension, "pdf")
+        self.assertEqual(match.display_name, "application/pdf")
+        self.assertIsNone(Match("file_name", None, matcher=Matcher(parse=False)).extension)
+
+
+class MatchStreamTest(TestCase):
+    @staticmethod
+    def _tree():
+        root = Match("root", "root", 10, matcher=Matcher(parse=False))
+        child = Submatch("child", "child", relative_offset=2, parent=root)
+        leaf1 = Submatch("leaf", 1, relative_offset=0, length=4, parent=child)
+        leaf2 = Submatch("leaf", 2, relative_offset=6, length=4, parent=child)
+        return root, child, leaf1, leaf2
+
+    def test_events(self):
+        events = []
+        root, child, leaf1, leaf2 = self._tree()
+        with MatchStream(events.append) as stream:
+            stream.add_tree(root)
+        self.assertEqual(len(events), 4)
+        by_id = {event["id"]: event for event in events}
+        self.assertEqual(len(by_id), 4)
+        roots = [event for event in events if event["parent"] is None]
+        self.assertEqual(len(roots), 1)
+        self.assertEqual(roots[0]["offset"], 10)
+        self.assertEqual(roots[0]["size"], 12)
+        # leaves have a fixed length, so they are reported before their dynamically sized ancestors
+        self.assertEqual([event["value"] for event in events[:2]], ["1", "2"])
+        for event in events:
+            if event["parent"] is not None:
+                self.assertIn(event["parent"], by_id)
+
+    def test_release(self):
+        events = []
+        root, child, leaf1, leaf2 = self._tree()
+        with MatchStream(events.append, release=True) as stream:
+            for match in (root, child, leaf1, leaf2):
+                stream.add(match)
+        self.assertEqual(len(events), 4)
+        self.assertEqual(len(root), 0)
+        self.assertEqual(len(child), 0)
+        self.assertEqual(root.length, 12)
+
+    def test_late_children(self):
+        for release in (False, True):
+            with self.subTest(release=release):
+                events = []
+                root, child, leaf1, leaf2 = self._tree()
+                with MatchStream(events.append, release=release) as stream:
+                    for match in (root, child, leaf1, leaf2):
+                        stream.add(match)
+                    stream.add(Match("next", "next", 100, length=1, matcher=root.matcher))
+                    # matches added to subtrees that were already reported reference their parents' reported ids
+                    late_child = Submatch("late", 3, relative_offset=0, length=1, parent=root)
+                    stream.add(late_child)
+                    stream.add(Submatch("late", 4, relative_offset=0, length=1, parent=child))
+                    stream.add(Submatch("later", 5, relative_offset=0, length=1, parent=late_child))
+                ids = {event["value"]: event["id"] for event in events}
+                self.assertEqual(len(ids), len(events))
+                parents = {event["value"]: event["parent"] for event in events}
+                self.assertEqual(parents["3"], ids["root"])
+                self.assertEqual(parents["4"], ids["child"])
+                self.assertEqual(parents["5"], ids["3"])
+
+    def test_analyzer_stream(self):
+        with TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "sample.zip"
+            path.write_bytes(SAMPLES["sample.zip"])
+            events = []
+            top_level = list(Analyzer(path).stream(events.append))
+            expected = Analyzer(path)
+            expected_matches = list(expected.matches())
+        self.assertEqual(len(top_level), len(expected_matches))
+
+        def num_matches(match: Match) -> int:
+            return 1 + sum(num_matches(c) for c in match)
+
+        self.assertEqual(len(events), sum(num_matches(m) for m in expected_matches))
+
+
+class MatchIndexTest(TestCase):
+    def test_queries(self):
+        root, child, leaf1, leaf2 = MatchStreamTest._tree()
+        empty = Submatch("empty", "", relative_offset=1, length=0, parent=leaf1)
+        index = MatchIndex([root])
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.at(13), [root, child, leaf1])
+        self.assertEqual(index.at(17), [root, child])
+        self.assertEqual(index.at(22), [])
+        self.assertEqual(index.overlapping(15, 19), [root, child, leaf1, leaf2])
+        self.assertEqual(index.within(12, 17), [leaf1])
+        self.assertEqual(index.within(0, 100), [root, child, leaf1, leaf2])
+        self.assertNotIn(empty, index.at(13))
+
+    def test_analyzer_index(self):
+        analyzer = Analyzer(SAMPLES["sample.zip"])
+        index = analyzer.index()
+        self.assertIs(analyzer.index(), index)
+        matches = [match for match in QuotaTest._all_matches(analyzer.matches_so_far) if match.length > 0]
+        self.assertEqual(len(index), len(matches))
+        self.assertEqual(index.at(0)[0], analyzer.matches_so_far[0])
+        for offset in (0, 10, len(SAMPLES["sample.zip"]) - 1):
+            self.assertEqual(
+                set(index.at(offset)), {m for m in matches if m.offset <= offset < m.offset + m.length}
+            )
+
+
+class ColumnarTest(TestCase):
+    def setUp(self):
+        self.analyzer = Analyzer(SAMPLES["sample.zip"])
+        self.matches = list(self.analyzer.matches())
+        output = BytesIO()
+        dump(self.analyzer, output)
+        self.loaded = ColumnarSBUD.loads(output.getvalue())
+
+    def test_round_trip(self):
+        self.assertEqual(self.loaded.to_sbud(), self.analyzer.sbud())
+        self.assertEqual(_tree(list(self.loaded.matches())), _tree(self.matches))
+
+    def test_queries(self):
+        self.assertEqual(len(self.loaded), len(QuotaTest._all_matches(self.matches)))
+        roots = list(self.loaded.roots)
+        self.assertEqual(len(roots), len(self.matches))
+        self.assertEqual(self.loaded.type(roots[0]), self.matches[0].name)
+        self.assertEqual(
+            [self.loaded.name(child) for child in self.loaded.children(roots[0])],
+            [child.display_name for child in self.matches[0]]
+        )
+        zips = list(self.loaded.find("application/zip"))
+        self.assertIn(roots[0], zips)
+        for index in self.loaded.at(0):
+            self.assertEqual(self.loaded.offset(index), 0)
+            self.assertGreater(self.loaded.size(index), 0)
+        self.assertEqual(list(self.loaded.find("application/x-not-a-type")), [])
+
+    def test_invalid(self):
+        with self.assertRaises(ColumnarFormatError):
+            ColumnarSBUD.loads(b"PK\x03\x04")
+        output = BytesIO()
+        dump(self.analyzer, output)
+        with self.assertRaises(ColumnarFormatError):
+            ColumnarSBUD.loads(output.getvalue()[:-1])
+
+
+def _pcap(num_packets: int, first_packet: int = 0) -> bytes:
+    """A capture of `num_packets` UDP packets, with the pcap header only if `first_packet` is zero"""
+    if first_packet:
+        data = b""
+    else:
+        data = struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1)
+    for i in range(first_packet, first_packet + num_packets):
+        frame = b"\xff" * 6 + b"\x00\x11\x22\x33\x44\x55\x08\x00" + \
+            bytes((0x45, 0, 0, 47, 0, 0x61 + i % 26, 0, 0, 64, 17, 0, 0, 10, 0, 0, 1, 10, 0, 0, 2)) + \
+            struct.pack(">HHHH", 1234, 5678, 27, 0) + b"a" * 19
+        data += struct.pack("<IIII", 0x11111111, 0, len(frame), len(frame)) + frame
+    return data
+
+
+class ResumeTest(TestCase):
+    def setUp(self):
+        self._tmpdir = TemporaryDirectory()
+        self.path = Path(self._tmpdir.name) / "input"
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _snapshot(self, data: bytes) -> bytes:
+        self.path.write_bytes(data)
+        output = BytesIO()
+        Analyzer(self.path).snapshot(output)
+        return output.getvalue()
+
+    def _resume(self, snapshot: bytes, appended: bytes) -> Analyzer:
+        with open(self.path, "ab") as f:
+            f.write(appended)
+        analyzer = Analyzer(self.path)
+        analyzer.resume(BytesIO(snapshot))
+        return analyzer
+
+    def _assert_same_as_full_analysis(self, resumed: Analyzer):
+        expected = Analyzer(self.path)
+        expected_matches = list(expected.matches())
+        self.assertEqual(_tree(list(resumed.matches())), _tree(expected_matches))
+        self.assertEqual(resumed.quota.nodes, expected.quota.nodes)
+
+    def test_pcap(self):
+        snapshot = self._snapshot(_pcap(3))
+        resumed = self._resume(snapshot, _pcap(2, first_packet=3))
+        self.assertIsNone(resumed._match_iterator)
+        self.assertEqual([m.name for m in resumed.matches()], ["application/vnd.tcpdump.pcap"])
+        packets = resumed.matches_so_far[0][0][-1]
+        self.assertEqual([packet.name for packet in packets], [f"packets[{i}]" for i in range(5)])
+        self._assert_same_as_full_analysis(resumed)
+
+    def test_text(self):
+        snapshot = self._snapshot(b"a line of a log\n" * 10)
+        resumed = self._resume(snapshot, b"another line\n")
+        self.assertIsNotNone(resumed._matches)
+        self._assert_same_as_full_analysis(resumed)
+        # binary data is not text, so the file has to be analyzed from scratch
+        self.path.write_bytes(b"a line of a log\n" * 10)
+        analyzer = self._resume(snapshot, b"\x00\x01\x02")
+        self.assertIsNone(analyzer._matches)
+        # appended data can change the type of the file, in which case it also has to be analyzed from scratch
+        self.path.write_bytes(b"a line of a log\n" * 10)
+        analyzer = self._resume(snapshot, b"<html><body>hi</body></html>")
+        self.assertIsNone(analyzer._matches)
+        self.assertIn("text/html", [m.name for m in analyzer.matches()])
+        self._assert_same_as_full_analysis(analyzer)
+
+    def test_unresumable(self):
+        snapshot = self._snapshot(_pcap(3))
+        # a modified file
+        self.path.write_bytes(b"\x00" + _pcap(3)[1:] + _pcap(1, first_packet=3))
+        self.assertFalse(Analyzer(self.path).resume(BytesIO(snapshot)))
+        # a truncated file
+        self.path.write_bytes(_pcap(2))
+        self.assertFalse(Analyzer(self.path).resume(BytesIO(snapshot)))
+        # different options
+        self.path.write_bytes(_pcap(3))
+        self.assertFalse(Analyzer(self.path, parse=False).resume(BytesIO(snapshot)))
+        # a partial packet
+        analyzer = Analyzer(self.path)
+        nodes = analyzer.quota.nodes
+        with open(self.path, "ab") as f:
+            f.write(_pcap(1, first_packet=3)[:-1])
+        self.assertFalse(analyzer.resume(BytesIO(snapshot)))
+        self.assertEqual(analyzer.quota.nodes, nodes)
+        # an unchanged file
+        self.path.write_bytes(_pcap(3))
+        analyzer = Analyzer(self.path)
+        self.assertTrue(analyzer.resume(BytesIO(snapshot)))
+        self._assert_same_as_full_analysis(analyzer)
+
+
+
+class SpillTest(TestCase):
+    def _assert_same_as_in_memory(self, data: bytes, max_nodes_in_memory: int) -> Analyzer:
+        expected = Analyzer(data)
+        expected_tree = _tree(list(expected.matches()))
+        analyzer = Analyzer(data, max_nodes_in_memory=max_nodes_in_memory)
+        for _ in analyzer.matches():
+            pass
+        self.assertEqual(_tree(analyzer.matches_so_far), expected_tree)
+        self.assertEqual(analyzer.quota.nodes, expected.quota.nodes)
+        output = StringIO()
+        analyzer.write_sbud(output)
+        self.assertEqual(json.loads(output.getvalue()), analyzer.sbud())
+        return analyzer
+
+    def test_archive(self):
+        analyzer = self._assert_same_as_in_memory(_archive(4), 10)
+        self.assertIsInstance(analyzer.matches_so_far[0], StoredMatch)
+        self.assertEqual(analyzer._spill.num_spilled, analyzer.quota.nodes)
+        self.assertTrue(any(isinstance(m, StoredSubmatch) for m in QuotaTest._all_matches(analyzer.matches_so_far)))
+        path = analyzer._spill.path
+        self.assertTrue(path.exists())
+        analyzer.close()
+        self.assertFalse(path.exists())
+
+    def test_pcap(self):
+        # each packet's records are complete as soon as the next packet is found
+        analyzer = self._assert_same_as_in_memory(_pcap(50), 20)
+        packets = analyzer.matches_so_far[0][0][-1]
+        self.assertEqual(len(packets), 50)
+        self.assertEqual([packet.name for packet in packets][-2:], ["packets[48]", "packets[49]"])
+        analyzer.close()
+
+    def test_in_memory(self):
+        analyzer = Analyzer(SAMPLES["sample.zip"], max_nodes_in_memory=1000000)
+        matches = list(analyzer.matches())
+        self.assertIs(analyzer.matches_so_far[0], matches[0])
+        self.assertIsNone(analyzer._spill.path)
+        # the streamed JSON is the same as the SBUD, even without spilling
+        output = StringIO()
+        analyzer.write_sbud(output, contents=ContentsMode.OMIT)
+        self.assertEqual(output.getvalue(), json.dumps(analyzer.sbud(contents=ContentsMode.OMIT)))
+        with self.assertRaises(ValueError):
+            Analyzer(SAMPLES["sample.zip"], max_nodes_in_memory=10, scheduler=EmbeddedScheduler())
+
+    def test_stop(self):
+        analyzer = Analyzer(_archive(4), max_nodes_in_memory=10)
+        first = next(iter(analyzer.matches()))
+        analyzer.stop()
+        self.assertEqual(list(analyzer.matches()), analyzer.matches_so_far)
+        self.assertEqual(len(analyzer.matches_so_far), 1)
+        self.assertEqual(analyzer.matches_so_far[0].name, first.name)
+        analyzer.close()
+
+class ProfilerTest(TestCase):
+    def test_nested_pause(self):
+        with Profiler() as parent:
+            with Profiler() as child:
+                self.assertIs(child.parent, parent)
+                with Unprofiled():
+                    self.assertTrue(child.is_paused)
+                    self.assertTrue(parent.is_paused)
+                self.assertFalse(parent.is_paused)
+
+    def test_profilers_are_thread_local(self):
+        with Profiler() as outer:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                inner = executor.submit(lambda: Profiler().__enter__()).result()
+        self.assertIsNone(inner.parent)
+        self.assertIsNone(outer.parent)
+
+
+class PluginsTest(TestCase):
+    def test_import_is_lazy(self):
+        script = (
+            "import sys\n"
+            "import polyfile\n"
+            "from polyfile.magic import DefaultMagicMatcher\n"
+            "print(DefaultMagicMatcher.is_loaded())\n"
+            "print(sorted(m for m in ('fickling', 'pdfminer', 'polyfile.kaitai.parser', 'polyfile.zipmatcher') "
+            "if m in sys.modules))\n"
+        )
+        output = subprocess.check_output([sys.executable, "-c", script], text=True)
+        self.assertEqual(output.splitlines(), ["False", "[]"])
+
+    def test_builtin_magic(self):
+        mimetypes = MagicMatcher.DEFAULT_INSTANCE.mimetypes
+        for mimetype in (
+                "application/zip", "application/java-archive", "application/vnd.nitf", HTTP_11_MIME_TYPE,
+                "application/x-brainfuck", "application/x-python-pickle"
+        ):
+            self.assertIn(mimetype, mimetypes)
+        self.assertIs(zipmatcher.relaxed_zip_matcher, RELAXED_ZIP_MAGIC.tests[0])
+        self.assertIn(zipmatcher.relaxed_zip_matcher, MagicMatcher.DEFAULT_INSTANCE)
+
+    def test_lazy_parsers(self):
+        parsers = PARSERS["application/zip"]
+        self.assertEqual([str(parser) for parser in parsers], ["parse_zip"])
+        self.assertIs(next(iter(parsers)), next(iter(PARSERS["application/java-archive"])))
+        zip_match = _tree(list(Analyzer(SAMPLES["sample.zip"]).matches()))[0]
+        self.assertEqual(zip_match["type"], "application/zip")
+        self.assertIn("LocalFileHeader", [child["type"] for child in zip_match["subEls"]])